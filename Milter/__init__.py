@@ -10,10 +10,17 @@
 
 __version__ = "1.0.5"
 
+import mmap
+import os
 import re
+import signal
 import sys
+import tempfile
+import time
+import traceback
+from concurrent import futures
 from functools import wraps
-from threading import Lock  # libmilter uses posix threads
+from threading import Lock, Thread  # libmilter uses posix threads
 
 import milter
 from milter import *
@@ -44,6 +51,31 @@ OPTIONAL_CALLBACKS = {
     "header": (P_NR_HDR, P_NOHDRS),
 }
 
+## @private
+# Methods called for each milter module callback, in the order of
+# milterContext.setdispatch().  Close and negotiate go through
+# close_callback and negotiate_callback.
+DISPATCH_CALLBACKS = (
+    "connect",
+    "hello",
+    "envfrom",
+    "envrcpt",
+    "header",
+    "eoh",
+    "body",
+    "eom",
+    "abort",
+    None,
+    "headers",
+    "unknown",
+    "data",
+    None,
+)
+
+## @private
+# Callbacks passed bytes, which are decoded according to error_strategy.
+DECODE_CALLBACKS = ("envfrom", "envrcpt", "header", "headers")
+
 MACRO_CALLBACKS = {
     "connect": M_CONNECT,
     "hello": M_HELO,
@@ -57,6 +89,20 @@ MACRO_CALLBACKS = {
 ## @private
 R = re.compile(r"%+")
 
+## Default bytes of the message kept in memory by @@spool_body.
+BODY_MAX_SIZE = 1024 * 1024
+
+## Seconds between progress notifications to the MTA while eom
+# waits for a future or coroutine.
+PROGRESS_INTERVAL = 30
+
+## Worker threads in the executor created by executor().
+EXECUTOR_WORKERS = 8
+
+_executor = None
+_event_loop = None
+_async_lock = Lock()
+
 
 ## @private
 def decode_mask(bits, names):
@@ -139,6 +185,110 @@ def header_leading_space(klass):
     return enable_protocols(klass, P_HDR_LEADSPC)
 
 
+## Batch header delivery. A class decorator that has the milter
+# module collect header fields without calling into python, and
+# pass them all to the @link Base#headers headers method @endlink
+# once, at the end of the header.  This saves a callback for each
+# header field, which adds up for messages with many Received, DKIM,
+# and ARC headers.  Since individual headers can no longer be
+# rejected, the MTA is told not to wait for a reply to each header
+# field if it supports that, and the headers method returns the reply
+# for the header as a whole.  The eoh callback is called after headers.
+# <pre>
+# @@Milter.batch_headers
+# class myMilter(Milter.Base):
+#   def headers(self,hdrs):
+#     for fld,val in hdrs:
+#       ...
+#     return Milter.CONTINUE
+# </pre>
+# @since 1.0.6
+# @param klass the %milter application class to modify
+# @return the modified %milter class
+def batch_headers(klass):
+    klass._batch_headers = True
+    p = klass.protocol_mask() | P_NOHDRS | P_NOEOH | P_NR_EOH
+    klass._protocol_mask = p & ~P_NR_HDR
+    return klass
+
+
+## Message spooling. A class decorator that has Milter.Base collect
+# the message for the application in a BodyBuffer, available as
+# <code>self.body_file</code> in the eom callback.  The message
+# stays in memory up to max_size bytes, then spills to a temporary file.
+# With headers true (the default), header fields are written first,
+# as the MTA sends them, followed by a blank line, so that the message
+# can be parsed straight from the file without another full copy.
+# The header and body callbacks are still called, but need not be
+# overridden.  If not overridden, the MTA is told not to wait for
+# a reply to each header and body chunk, if it supports that.
+# <pre>
+# @@Milter.spool_body(max_size=256*1024)
+# class myMilter(Milter.Base):
+#   def eom(self):
+#     msg = email.message_from_binary_file(self.body_file)
+#     ...
+#     return Milter.CONTINUE
+# </pre>
+# The BodyBuffer is closed when eom or abort returns.
+# @since 1.0.6
+# @param klass the %milter application class to modify, or None
+#   to return a decorator with the other options
+# @param max_size bytes kept in memory before spilling to disk
+# @param headers include header fields in the spooled message
+# @param dir directory for the temporary file, None for the default
+# @return the modified %milter class
+def spool_body(klass=None, max_size=BODY_MAX_SIZE, headers=True, dir=None):
+    def setspool(klass):
+        klass._spool_options = (max_size, headers, dir)
+        p = klass.protocol_mask() | P_NOBODY
+        if getattr(klass.body, "milter_protocol", 0) & P_NOBODY:
+            p &= ~P_NR_BODY
+        if headers:
+            p |= P_NOHDRS
+            if getattr(klass.header, "milter_protocol", 0) & P_NOHDRS:
+                p &= ~P_NR_HDR
+        klass._protocol_mask = p
+        return klass
+
+    if klass is None:
+        return setspool
+    return setspool(klass)
+
+
+## A message spooled in memory, and then in a temporary file when
+# larger than max_size.  This is a tempfile.SpooledTemporaryFile
+# that also keeps the size, and can return the contents without a copy.
+# @since 1.0.6
+class BodyBuffer(tempfile.SpooledTemporaryFile):
+    def __init__(self, max_size=BODY_MAX_SIZE, dir=None):
+        super(BodyBuffer, self).__init__(max_size=max_size, dir=dir)
+        ## Total bytes written.
+        self.size = 0
+
+    def write(self, s):
+        n = super(BodyBuffer, self).write(s)
+        self.size += len(s)
+        return n
+
+    ## True if the contents have spilled to disk.
+    @property
+    def rolled(self):
+        return self._rolled
+
+    ## Return the contents without copying them.
+    # The buffer is a memoryview while in memory, and an mmap
+    # of the temporary file after spilling to disk.  It must be released
+    # (or closed, for mmap) before writing more or closing the BodyBuffer.
+    def getbuffer(self):
+        if not self._rolled:
+            return self._file.getbuffer()
+        if not self.size:
+            return memoryview(b"")
+        self.flush()
+        return mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 ## Function decorator to disable callback methods.
 # If the MTA supports it, tells the MTA not to invoke this callback,
 # increasing efficiency.  All the callbacks (except negotiate)
@@ -212,6 +362,20 @@ def noreply(func):
 # <li> ignore   - illegal bytes are removed
 # <li> replace  - illegal bytes are replaced with a unicode error symbol
 # </ul>
+# Applied to the body callback, the <code>buffer</code> strategy
+# passes each body chunk as a read-only milter.BodyChunk over the
+# libmilter buffer instead of a bytes copy.  The chunk is released when
+# the callback returns, so the callback must copy any data it needs
+# later, for example by writing it to a file.  A chunk or slice kept
+# past the callback raises ValueError when used
+# (see milter.set_body_buffer()).
+# <pre>
+# class myMilter(Milter.Base):
+#   @@Milter.decode('buffer')
+#   def body(self,chunk):
+#     self.digest.update(chunk)
+#     return Milter.CONTINUE
+# </pre>
 def decode(strategy):
     def setstrategy(func):
         func.error_strategy = strategy
@@ -281,6 +445,11 @@ class DisabledAction(RuntimeError):
 class Base(object):
     "The core class interface to the %milter module."
 
+    ## The message collected for the eom callback when the class is
+    # decorated with @@spool_body, a BodyBuffer positioned at the start.
+    # @since 1.0.6
+    body_file = None
+
     ## Attach this Milter to the low level milter.milterContext object.
     def _setctx(self, ctx):
 
@@ -325,6 +494,10 @@ class Base(object):
         self._protocol = 0  # no protocol options by default
         if ctx:
             ctx.setpriv(self)
+            # the milter module calls our methods directly
+            setdispatch = getattr(ctx, "setdispatch", None)
+            if setdispatch:
+                setdispatch([n and getattr(self, n) for n in self.dispatch_table()])
 
     ## Defined by subclasses to write log messages.
     def log(self, *msg):
@@ -378,9 +551,8 @@ class Base(object):
     # or trap utf-8 conversion exception, etc.
     def envfrom_bytes(self, *b):
         try:
-            e = getattr(self.envfrom, "error_strategy", "surrogateescape")
+            e = self.error_strategies()["envfrom"]
             if e == "bytes":
-                # self.envfrom_bytes = self.envfrom
                 return self.envfrom(*b)
             s = [v.decode(encoding="utf-8", errors=e) for v in b]
         except UnicodeDecodeError:
@@ -407,9 +579,8 @@ class Base(object):
     # or trap utf-8 conversion exception, etc.
     def envrcpt_bytes(self, *b):
         try:
-            e = getattr(self.envrcpt, "error_strategy", "surrogateescape")
+            e = self.error_strategies()["envrcpt"]
             if e == "bytes":
-                # self.envrcpt_bytes = self.envrcpt
                 return self.envrcpt(*b)
             s = [v.decode(encoding="utf-8", errors=e) for v in b]
         except UnicodeDecodeError:
@@ -450,9 +621,8 @@ class Base(object):
     # The <code>@decode('bytes')</code> decorator will also do this.
     def header_bytes(self, fld, val):
         try:
-            e = getattr(self.header, "error_strategy", "surrogateescape")
+            e = self.error_strategies()["header"]
             if e == "bytes":
-                self.header_bytes = self.header
                 return self.header(fld, val)
             s = val.decode(encoding="utf-8", errors=e)
         except UnicodeDecodeError:
@@ -466,6 +636,37 @@ class Base(object):
     def header(self, field, value):
         return CONTINUE
 
+    ## Called with bytes by default global headers callback.
+    # Converts values like header_bytes(), using the error strategy
+    # of the headers method.
+    # @param hdrs list of (field, value) tuples with values as bytes
+    # @since 1.0.6
+    def headers_bytes(self, hdrs):
+        e = self.error_strategies()["headers"]
+        if e == "bytes":
+            return self.headers(hdrs)
+        s = []
+        for fld, val in hdrs:
+            try:
+                val = val.decode(encoding="utf-8", errors=e)
+            except UnicodeDecodeError:
+                pass
+            s.append((fld, val))
+        return self.headers(s)
+
+    ## Called once at the end of the header with all header fields
+    # when the class is decorated with @@batch_headers.
+    # The default calls @link #header the header callback @endlink
+    # for each field, and returns the first result other than CONTINUE.
+    # @param hdrs list of (field, value) tuples as passed to header
+    # @since 1.0.6
+    def headers(self, hdrs):
+        for fld, val in hdrs:
+            rc = self.header(fld, val)
+            if rc not in (CONTINUE, NOREPLY):
+                return rc
+        return CONTINUE
+
     ## Called at the blank line that terminates the header fields.
     @nocallback
     def eoh(self):
@@ -523,6 +724,121 @@ class Base(object):
             klass._protocol_mask = p
             return p
 
+    ## Return the decoding error strategy of each callback passed bytes.
+    # The strategies set with the @@decode decorator are looked up once
+    # for each class, rather than on every callback.
+    # @return dictionary of strategy by callback name
+    # @since 1.0.6
+    @classmethod
+    def error_strategies(klass):
+        try:
+            return klass.__dict__["_error_strategies"]
+        except KeyError:
+            d = {}
+            for name in DECODE_CALLBACKS:
+                func = getattr(klass, name)
+                d[name] = getattr(func, "error_strategy", "surrogateescape")
+            klass._error_strategies = d
+            return d
+
+    ## Return the method names called for each milter module callback.
+    # Computed once for each class, this is passed to
+    # milterContext.setdispatch() as bound methods for each connection,
+    # so that libmilter callbacks invoke the methods directly.
+    # Callbacks that decode bytes are dispatched to the *_bytes method,
+    # unless the strategy is <code>bytes</code>, in which case
+    # the method is called directly.
+    # @return a tuple of method names, or None for the default callback
+    # @since 1.0.6
+    @classmethod
+    def dispatch_table(klass):
+        try:
+            return klass.__dict__["_dispatch_table"]
+        except KeyError:
+            e = klass.error_strategies()
+            t = []
+            for func in DISPATCH_CALLBACKS:
+                if func in e and e[func] != "bytes" and sys.version >= "3.0.0":
+                    func += "_bytes"
+                t.append(func)
+            spool = getattr(klass, "_spool_options", None)
+            if spool:
+                # route message callbacks through the spooling methods
+                names = ["body", "eom", "abort"]
+                if spool[1]:
+                    names += ["header", "headers"]
+                nxt = {}
+                for func in names:
+                    i = DISPATCH_CALLBACKS.index(func)
+                    nxt[func] = t[i]
+                    t[i] = "_spool_" + func
+                klass._spool_next = nxt
+            klass._dispatch_table = t = tuple(t)
+            return t
+
+    ## @private
+    # Return the BodyBuffer for the current message, creating it if needed.
+    def _spool_file(self):
+        f = self.body_file
+        if f is None:
+            max_size, headers, dir = self._spool_options
+            self.body_file = f = BodyBuffer(max_size, dir)
+            self._spool_eoh = headers
+        return f
+
+    ## @private
+    def _spool_end_headers(self):
+        f = self._spool_file()
+        if self._spool_eoh:
+            f.write(b"\r\n")
+            self._spool_eoh = False
+        return f
+
+    ## @private
+    def _spool_close(self):
+        f = self.body_file
+        if f is not None:
+            self.body_file = None
+            f.close()
+
+    ## @private
+    def _spool_reply(self, rc, nr_mask):
+        if rc == CONTINUE and self._protocol & nr_mask:
+            return NOREPLY
+        return rc
+
+    ## @private
+    def _spool_header(self, fld, val):
+        self._spool_file().write(b"%s: %s\r\n" % (fld.encode(), val))
+        rc = getattr(self, self._spool_next["header"])(fld, val)
+        return self._spool_reply(rc, P_NR_HDR)
+
+    ## @private
+    def _spool_headers(self, hdrs):
+        f = self._spool_file()
+        for fld, val in hdrs:
+            f.write(b"%s: %s\r\n" % (fld.encode(), val))
+        return getattr(self, self._spool_next["headers"])(hdrs)
+
+    ## @private
+    def _spool_body(self, chunk):
+        self._spool_end_headers().write(chunk)
+        rc = getattr(self, self._spool_next["body"])(chunk)
+        return self._spool_reply(rc, P_NR_BODY)
+
+    ## @private
+    def _spool_eom(self):
+        self._spool_end_headers().seek(0)
+        try:
+            return getattr(self, self._spool_next["eom"])()
+        finally:
+            self._spool_close()
+
+    ## @private
+    def _spool_abort(self):
+        self._spool_close()
+        return getattr(self, self._spool_next["abort"])()
+
     ## Negotiate milter protocol options.  Called by the
     # <a href="milter_api/xxfi_negotiate.html">
     # xffi_negotiate</a> callback.  This is an advanced callback,
@@ -744,6 +1060,25 @@ class Base(object):
     def progress(self):
         return self._ctx.progress()
 
+    ## Run a blocking function in the executor shared by all connections.
+    # A callback can return the future, or a coroutine, instead of
+    # a result code.  The connection then waits for the result without
+    # holding the interpreter, and progress() is called every
+    # PROGRESS_INTERVAL seconds while eom waits.  This limits the threads
+    # talking to slow backends to the executor workers, however many
+    # connections are waiting.
+    # <pre>
+    # def eom(self):
+    #   return self.submit(self.check_message)
+    # </pre>
+    # The function may call actions such as addheader(), since the
+    # connection waits for it to finish.
+    # @param fn the function, called as fn(*args,**kw) in a worker thread
+    # @return a concurrent.futures.Future for the result
+    # @since 1.0.6
+    def submit(self, fn, *args, **kw):
+        return executor().submit(fn, *args, **kw)
+
 
 ## A logging but otherwise do nothing Milter base class.
 # This is included for compatibility with previous versions of pymilter.
@@ -850,6 +1185,75 @@ def close_callback(ctx):
     return rc
 
 
+## Return the executor shared by all connections for blocking work.
+# It is a ThreadPoolExecutor with EXECUTOR_WORKERS threads, created
+# on first use, unless replaced with set_executor().
+# @since 1.0.6
+def executor():
+    global _executor
+    with _async_lock:
+        if _executor is None:
+            _executor = futures.ThreadPoolExecutor(EXECUTOR_WORKERS, "milter-work")
+        return _executor
+
+
+## Replace the executor used by Base.submit().
+# @param ex a concurrent.futures.Executor
+# @since 1.0.6
+def set_executor(ex):
+    global _executor
+    with _async_lock:
+        _executor = ex
+
+
+## @private
+# @brief Return the event loop running coroutines returned by callbacks.
+def event_loop():
+    global _event_loop
+    with _async_lock:
+        if _event_loop is None:
+            import asyncio
+
+            _event_loop = asyncio.new_event_loop()
+            t = Thread(target=_event_loop.run_forever, name="milter-async")
+            t.daemon = True
+            t.start()
+        return _event_loop
+
+
+async def _awaitable(aw):
+    return await aw
+
+
+## Wait for a future or coroutine returned by a callback.
+# Coroutines are run on an event loop in a daemon thread
+# shared by all connections.
+# @param result a concurrent.futures.Future, or an awaitable
+# @param name the callback name, for errors
+# @param progress called every PROGRESS_INTERVAL seconds while waiting
+# @return the result code
+# @since 1.0.6
+def wait_result(result, name, progress=None):
+    if hasattr(result, "__await__"):
+        import asyncio
+
+        result = asyncio.run_coroutine_threadsafe(_awaitable(result), event_loop())
+    elif not isinstance(result, futures.Future):
+        raise error(f"The {name} callback must return int")
+    while True:
+        try:
+            return result.result(PROGRESS_INTERVAL)
+        except futures.TimeoutError:
+            if progress:
+                progress()
+
+
+## @private
+# @brief Wait for a result that is not int, with progress at eom.
+def future_callback(ctx, result, name):
+    return wait_result(result, name, ctx.progress if name == "eom" else None)
+
+
 ## Convert ESMTP parameters with values to a keyword dictionary.
 # @deprecated You probably want Milter.param2dict instead.
 def dictfromlist(args):
@@ -891,15 +1295,100 @@ def envcallback(c, args):
     return c(*pargs, **kw)
 
 
+## @private
+# @brief Fork worker processes running main(), and restart them when they die.
+# The workers inherit the listening socket, so the kernel spreads MTA
+# connections between them.  SIGTERM or SIGINT to the supervisor stops
+# all workers.  A restarted worker keeps the number of the one it replaces.
+# @param workers the number of worker processes
+# @param main the function each worker runs, passed the worker number
+def prefork(workers, main):
+    children = {}
+    stopping = []
+
+    def spawn(worker):
+        # stop() must not run between the fork and recording the child
+        mask = signal.pthread_sigmask(
+            signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT}
+        )
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+            rc = 0
+            try:
+                main(worker)
+            except BaseException:
+                traceback.print_exc()
+                rc = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            os._exit(rc)
+        children[pid] = (worker, time.time())
+        if stopping:
+            os.kill(pid, signal.SIGTERM)
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    oldterm = signal.signal(signal.SIGTERM, stop)
+    oldint = signal.signal(signal.SIGINT, stop)
+    try:
+        for i in range(workers):
+            spawn(i)
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            child = children.pop(pid, None)
+            if child is None or stopping:
+                continue
+            worker, started = child
+            # don't spin if workers die as soon as they start
+            if time.time() - started < 1:
+                time.sleep(1)
+                if stopping:
+                    continue
+            spawn(worker)
+    finally:
+        signal.signal(signal.SIGTERM, oldterm)
+        signal.signal(signal.SIGINT, oldint)
+
+
 ## Run the %milter.
+# With <code>workers</code> set, the socket is opened once, and
+# that many worker processes are forked to share it, each running
+# libmilter with its own python interpreter.  This lets CPU bound
+# milters use more than one core.  Worker processes are restarted
+# if they die.  Since each worker is a separate process, global
+# state such as caches is not shared between workers.
 # @param name the name of the %milter known to the MTA
 # @param socketname the socket to be passed to milter.setconn()
 # @param timeout the time in secs the MTA should wait for a response before
 # 	considering this %milter dead
-def runmilter(name, socketname, timeout=0, rmsock=True):
+# @param rmsock remove an existing unix domain socket first if true
+# @param workers the number of worker processes to fork, or 0 to
+#       run in the current process
+# @param metrics if set, a socket name like <code>inet:9100@127.0.0.1</code>
+#       on which to serve stats() in OpenMetrics text format.  With
+#       <code>workers</code>, each worker serves its own statistics,
+#       on consecutive ports (see Milter.metrics.worker_socketname).
+def runmilter(name, socketname, timeout=0, rmsock=True, workers=0, metrics=None):
 
     # The default flags set include everything
     # milter.set_flags(milter.ADDHDRS)
+    # Base._setctx() gives each connection a dispatch table of bound methods,
+    # which the milter module calls directly.  These functions are only
+    # used for factories that do not derive from Base.
     milter.set_connect_callback(connect_callback)
     milter.set_helo_callback(lambda ctx, host: ctx.getpriv().hello(host))
 
@@ -915,11 +1404,20 @@ def runmilter(name, socketname, timeout=0, rmsock=True):
         milter.set_envfrom_callback(lambda ctx, *b: ctx.getpriv().envfrom_bytes(*b))
         milter.set_envrcpt_callback(lambda ctx, *b: ctx.getpriv().envrcpt_bytes(*b))
         milter.set_header_callback(lambda ctx, f, v: ctx.getpriv().header_bytes(f, v))
+    if not getattr(factory, "_batch_headers", False):
+        milter.set_headers_callback(None)
+    elif sys.version < "3.0.0":
+        milter.set_headers_callback(lambda ctx, h: ctx.getpriv().headers(h))
+    else:
+        milter.set_headers_callback(lambda ctx, h: ctx.getpriv().headers_bytes(h))
     milter.set_eoh_callback(lambda ctx: ctx.getpriv().eoh())
     milter.set_body_callback(lambda ctx, chunk: ctx.getpriv().body(chunk))
+    body = getattr(factory, "body", None)
+    milter.set_body_buffer(getattr(body, "error_strategy", None) == "buffer")
     milter.set_eom_callback(lambda ctx: ctx.getpriv().eom())
     milter.set_abort_callback(lambda ctx: ctx.getpriv().abort())
     milter.set_close_callback(close_callback)
+    milter.set_future_callback(future_callback)
 
     milter.setconn(socketname)
     if timeout > 0:
@@ -943,18 +1441,104 @@ def runmilter(name, socketname, timeout=0, rmsock=True):
     # processed.  It's safer to shutdown sendmail, kill the filter process,
     # restart the filter, and then restart sendmail.
     milter.opensocket(rmsock)
-    start_seq = _seq
-    try:
-        milter.main()
-    except milter.error:
-        if start_seq == _seq:
-            raise  # couldn't start
-        # milter has been running for a while, but now it can't start new threads
-        raise milter.error("out of thread resources")
+
+    def main(worker=None):
+        if metrics:
+            import Milter.metrics
+
+            sockname = metrics
+            if worker is not None:
+                sockname = Milter.metrics.worker_socketname(metrics, worker)
+            Milter.metrics.start(sockname)
+        start_seq = _seq
+        try:
+            milter.main()
+        except milter.error:
+            if start_seq == _seq:
+                raise  # couldn't start
+            # milter has been running for a while, but now it can't start new threads
+            raise milter.error("out of thread resources")
+
+    # smfi_main() uses the socket already opened, so forked workers share it
+    if workers > 0:
+        prefork(workers, main)
+    else:
+        main()
+
+
+## @private
+REPLY_NAMES = {
+    CONTINUE: "continue",
+    REJECT: "reject",
+    DISCARD: "discard",
+    ACCEPT: "accept",
+    TEMPFAIL: "tempfail",
+    NOREPLY: "noreply",
+    SKIP: "skip",
+    ALL_OPTS: "all_opts",
+}
+
+
+## Return runtime statistics gathered by the milter module.
+# The result is a dictionary with:
+# <dl>
+# <dt>contexts</dt><dd>counts of connection contexts created, deleted,
+#     and still active</dd>
+# <dt>thread_states</dt><dd>new contexts that reused the python thread
+#     state of a libmilter thread (hit) or had to create one (miss)</dd>
+# <dt>callbacks</dt><dd>statistics for each callback, keyed by name:
+#     calls, errors (untrapped exceptions), gil_wait and time (total
+#     seconds waiting for and holding the interpreter lock), replies
+#     (count of each return code by lower case name), and histogram
+#     (count of calls for each time bucket)</dd>
+# <dt>buckets</dt><dd>upper bound in seconds of each histogram bucket,
+#     the last is infinite</dd>
+# </dl>
+# Counters are only updated while the interpreter is locked,
+# so gathering them adds no locking to callbacks.
+# Find the slow stage under load by comparing time/calls,
+# and gil_wait shows when callbacks are queued waiting for the interpreter.
+def stats():
+    diag = milter.getdiag()
+    created, deleted = diag[:2]
+    callbacks = milter.getstats()
+    for cb in callbacks.values():
+        cb["replies"] = dict(
+            (REPLY_NAMES.get(rc, str(rc)), n) for rc, n in cb["replies"].items()
+        )
+    n = len(next(iter(callbacks.values()))["histogram"]) if callbacks else 0
+    buckets = tuple(2**i / 1e6 for i in range(n - 1)) + (float("inf"),)
+    return {
+        "contexts": {
+            "created": created,
+            "deleted": deleted,
+            "active": created - deleted,
+        },
+        "thread_states": {"hit": diag[2], "miss": diag[3]},
+        "callbacks": callbacks,
+        "buckets": buckets,
+    }
 
 
 __all__ = globals().copy()
-for priv in ("milter", "factory", "_seq", "_seq_lock", "__version__"):
+for priv in (
+    "milter",
+    "factory",
+    "_seq",
+    "_seq_lock",
+    "_executor",
+    "_event_loop",
+    "_async_lock",
+    "_awaitable",
+    "futures",
+    "__version__",
+    "mmap",
+    "os",
+    "signal",
+    "tempfile",
+    "time",
+    "traceback",
+):
     del __all__[priv]
 __all__ = __all__.keys()
 
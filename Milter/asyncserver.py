@@ -0,0 +1,649 @@
+## @package Milter.asyncserver
+# A pure python %milter protocol server running on asyncio.
+#
+# Milter.runmilter() hands the socket to libmilter, which runs one posix
+# thread per MTA connection, and every callback must take the GIL in
+# miltermodule.c.  This module speaks the %milter wire protocol directly
+# on an asyncio event loop instead, so that one process can serve a
+# very large number of MTA connections without a thread for each.
+#
+# The same Milter.Base applications are driven through Milter.factory,
+# and the MTA sees the same negotiation and replies as with libmilter.
+# Since all connections share the event loop thread, callbacks must not
+# block for long.  Replace Milter.runmilter with the version in this module:
+# <pre>
+# Milter.factory = myMilter
+# Milter.asyncserver.runmilter("pythonfilter", "inet:8800@127.0.0.1", 240)
+# </pre>
+# @since 1.0.6
+
+import asyncio
+import os
+import socket
+import struct
+import traceback
+from concurrent import futures
+from socket import AF_INET, AF_INET6, AF_UNIX
+
+import Milter
+from Milter import (
+    ACCEPT,
+    ALL_OPTS,
+    CONTINUE,
+    CURR_ACTS,
+    DISCARD,
+    NOREPLY,
+    REJECT,
+    SETSYMLIST,
+    SKIP,
+    TEMPFAIL,
+    P_NR_BODY,
+    P_NR_CONN,
+    P_NR_DATA,
+    P_NR_EOH,
+    P_NR_HDR,
+    P_NR_HELO,
+    P_NR_MAIL,
+    P_NR_RCPT,
+    P_NR_UNKN,
+    M_CONNECT,
+    M_HELO,
+    M_ENVFROM,
+    M_ENVRCPT,
+    M_DATA,
+    M_EOH,
+    M_EOM,
+)
+
+## Highest %milter protocol version we speak.
+PROT_VERSION = 6
+## Largest packet we accept from the MTA.
+MAX_PACKET = 512 * 1024
+## Largest body chunk we send to the MTA in replacebody().
+CHUNK_SIZE = 65535
+
+# Commands from the MTA
+SMFIC_ABORT = b"A"
+SMFIC_BODY = b"B"
+SMFIC_CONNECT = b"C"
+SMFIC_MACRO = b"D"
+SMFIC_BODYEOB = b"E"
+SMFIC_HELO = b"H"
+SMFIC_QUIT_NC = b"K"
+SMFIC_HEADER = b"L"
+SMFIC_MAIL = b"M"
+SMFIC_EOH = b"N"
+SMFIC_OPTNEG = b"O"
+SMFIC_QUIT = b"Q"
+SMFIC_RCPT = b"R"
+SMFIC_DATA = b"T"
+SMFIC_UNKNOWN = b"U"
+
+# Replies and actions sent to the MTA
+SMFIR_ADDRCPT = b"+"
+SMFIR_DELRCPT = b"-"
+SMFIR_ADDRCPT_PAR = b"2"
+SMFIR_ACCEPT = b"a"
+SMFIR_REPLBODY = b"b"
+SMFIR_CONTINUE = b"c"
+SMFIR_DISCARD = b"d"
+SMFIR_CHGFROM = b"e"
+SMFIR_ADDHEADER = b"h"
+SMFIR_INSHEADER = b"i"
+SMFIR_CHGHEADER = b"m"
+SMFIR_PROGRESS = b"p"
+SMFIR_QUARANTINE = b"q"
+SMFIR_REJECT = b"r"
+SMFIR_SKIP = b"s"
+SMFIR_TEMPFAIL = b"t"
+SMFIR_REPLYCODE = b"y"
+
+## @private
+# Index of each callback in Milter.Base.dispatch_table()
+DISPATCH_INDEX = {n: i for i, n in enumerate(Milter.DISPATCH_CALLBACKS) if n}
+
+## @private
+REPLY_CODES = {
+    CONTINUE: SMFIR_CONTINUE,
+    REJECT: SMFIR_REJECT,
+    DISCARD: SMFIR_DISCARD,
+    ACCEPT: SMFIR_ACCEPT,
+    TEMPFAIL: SMFIR_TEMPFAIL,
+    SKIP: SMFIR_SKIP,
+}
+
+## @private
+# Macro stage for each command, in the order the MTA sends them.
+MACRO_STAGES = {
+    SMFIC_CONNECT: M_CONNECT,
+    SMFIC_HELO: M_HELO,
+    SMFIC_MAIL: M_ENVFROM,
+    SMFIC_RCPT: M_ENVRCPT,
+    SMFIC_DATA: M_DATA,
+    SMFIC_EOH: M_EOH,
+    SMFIC_BODYEOB: M_EOM,
+}
+STAGE_ORDER = list(MACRO_STAGES.values())
+
+## @private
+# No reply protocol bit for each command.
+NOREPLY_BITS = {
+    SMFIC_CONNECT: P_NR_CONN,
+    SMFIC_HELO: P_NR_HELO,
+    SMFIC_MAIL: P_NR_MAIL,
+    SMFIC_RCPT: P_NR_RCPT,
+    SMFIC_DATA: P_NR_DATA,
+    SMFIC_UNKNOWN: P_NR_UNKN,
+    SMFIC_EOH: P_NR_EOH,
+    SMFIC_BODY: P_NR_BODY,
+    SMFIC_HEADER: P_NR_HDR,
+}
+
+_exception_policy = TEMPFAIL
+
+
+## Set the policy for untrapped Python exceptions during a callback.
+# The asyncio equivalent of milter.set_exception_policy().
+# @param code one of TEMPFAIL, REJECT, CONTINUE, ACCEPT
+def set_exception_policy(code):
+    global _exception_policy
+    if code not in (REJECT, TEMPFAIL, CONTINUE, ACCEPT):
+        raise Milter.error("invalid exception policy")
+    _exception_policy = code
+
+
+## @private
+def _bytes(s):
+    if s is None or isinstance(s, bytes):
+        return s
+    return s.encode("utf-8", errors="surrogateescape")
+
+
+## @private
+def _str(b):
+    return b.decode("utf-8", errors="surrogateescape")
+
+
+## @private
+def _cstrings(data):
+    "Split NUL terminated strings in a packet."
+    a = data.split(b"\0")
+    if a and a[-1] == b"":
+        a.pop()
+    return a
+
+
+## Parse a socket name in the format passed to milter.setconn().
+# @param socketname unix:path, local:path, inet:port[@host], inet6:port[@host]
+# @return a tuple (family, address) where address is a path for AF_UNIX or
+#   a (host, port) tuple
+def parse_socketname(socketname):
+    proto, sep, addr = socketname.partition(":")
+    if not sep:
+        return AF_UNIX, socketname
+    if proto in ("unix", "local"):
+        return AF_UNIX, addr
+    if proto not in ("inet", "inet6"):
+        raise ValueError("unknown socket protocol: " + socketname)
+    port, sep, host = addr.partition("@")
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    if not host:
+        host = "::" if proto == "inet6" else "0.0.0.0"
+    return (AF_INET6 if proto == "inet6" else AF_INET), (host, int(port))
+
+
+## Context for a %milter connection served by asyncio.
+# A substitute for milter.milterContext with the same methods,
+# that writes %milter protocol packets to the MTA connection.
+class AsyncContext(object):
+    def __init__(self, conn):
+        self._conn = conn
+        self._priv = None
+        self._macros = {}
+        self._reply = None
+        self._symlist = {}
+        self._stage = None
+        self._dispatch = None
+
+    def getpriv(self):
+        return self._priv
+
+    def setdispatch(self, methods):
+        self._dispatch = methods and tuple(methods)
+
+    def setpriv(self, priv):
+        old = self._priv
+        self._priv = priv
+        return old
+
+    def getsymval(self, sym):
+        alt = sym[1:-1] if sym.startswith("{") else "{" + sym + "}"
+        for stage in STAGE_ORDER:
+            d = self._macros.get(stage)
+            if d:
+                if sym in d:
+                    return d[sym]
+                if alt in d:
+                    return d[alt]
+        return None
+
+    def setreply(self, rcode, xcode=None, *msg):
+        if not rcode or len(rcode) != 3 or rcode[0] not in "45":
+            raise Milter.error("cannot set reply")
+        msg = [m for m in msg if m is not None] or [""]
+        xc = xcode + " " if xcode else ""
+        lines = [f"{rcode}-{xc}{m}" for m in msg[:-1]]
+        lines.append(f"{rcode} {xc}{msg[-1]}")
+        self._reply = (rcode, "\r\n".join(lines))
+
+    def setsymlist(self, stage, macros):
+        if self._stage != -1:
+            raise Milter.error("cannot set macro list")
+        self._symlist[stage] = _bytes(macros)
+
+    def _action(self, cmd, *args):
+        if self._stage != M_EOM:
+            raise Milter.error("action not allowed outside eom")
+        self._conn.send(cmd, *args)
+
+    def addheader(self, field, value, idx=-1):
+        data = _bytes(field) + b"\0" + _bytes(value) + b"\0"
+        if idx < 0:
+            self._action(SMFIR_ADDHEADER, data)
+        else:
+            self._action(SMFIR_INSHEADER, struct.pack("!I", idx), data)
+
+    def chgheader(self, field, idx, value):
+        value = _bytes(value) or b""
+        self._action(
+            SMFIR_CHGHEADER, struct.pack("!I", idx), _bytes(field), b"\0", value, b"\0"
+        )
+
+    def addrcpt(self, rcpt, params=None):
+        if params:
+            self._action(
+                SMFIR_ADDRCPT_PAR, _bytes(rcpt), b"\0", _bytes(params), b"\0"
+            )
+        else:
+            self._action(SMFIR_ADDRCPT, _bytes(rcpt), b"\0")
+
+    def delrcpt(self, rcpt):
+        self._action(SMFIR_DELRCPT, _bytes(rcpt), b"\0")
+
+    def replacebody(self, body):
+        body = _bytes(body)
+        for i in range(0, len(body), CHUNK_SIZE):
+            self._action(SMFIR_REPLBODY, body[i : i + CHUNK_SIZE])
+
+    def chgfrom(self, sender, params=None):
+        if params:
+            self._action(SMFIR_CHGFROM, _bytes(sender), b"\0", _bytes(params), b"\0")
+        else:
+            self._action(SMFIR_CHGFROM, _bytes(sender), b"\0")
+
+    def quarantine(self, reason):
+        self._action(SMFIR_QUARANTINE, _bytes(reason), b"\0")
+
+    def progress(self):
+        self._action(SMFIR_PROGRESS)
+
+
+## One MTA connection speaking the %milter protocol.
+# Reads command packets from the MTA, invokes the callbacks of the
+# Milter.Base instance created by Milter.factory, and writes replies.
+class MilterConnection(object):
+    def __init__(self, name, reader, writer, timeout=0):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout or None
+        self.ctx = AsyncContext(self)
+        ## Actions and protocol steps negotiated with the MTA
+        self.actions = CURR_ACTS
+        self.protocol = 0
+        ## Header fields collected for Milter.batch_headers
+        self.headers = []
+        self.dispatch = {
+            SMFIC_OPTNEG: self.do_optneg,
+            SMFIC_MACRO: self.do_macro,
+            SMFIC_CONNECT: self.do_connect,
+            SMFIC_HELO: self.do_helo,
+            SMFIC_MAIL: self.do_envfrom,
+            SMFIC_RCPT: self.do_envrcpt,
+            SMFIC_DATA: self.do_data,
+            SMFIC_HEADER: self.do_header,
+            SMFIC_EOH: self.do_eoh,
+            SMFIC_BODY: self.do_body,
+            SMFIC_BODYEOB: self.do_eom,
+            SMFIC_UNKNOWN: self.do_unknown,
+            SMFIC_ABORT: self.do_abort,
+        }
+
+    def send(self, cmd, *args):
+        data = cmd + b"".join(args)
+        self.writer.write(struct.pack("!I", len(data)) + data)
+
+    async def read_packet(self):
+        hdr = await asyncio.wait_for(self.reader.readexactly(4), self.timeout)
+        (n,) = struct.unpack("!I", hdr)
+        if n < 1 or n > MAX_PACKET:
+            raise ValueError(f"invalid packet length: {n}")
+        data = await asyncio.wait_for(self.reader.readexactly(n), self.timeout)
+        return data[:1], data[1:]
+
+    ## Report an untrapped exception and apply the exception policy.
+    def _report_exception(self):
+        traceback.print_exc()
+        msg = "pymilter: untrapped exception in " + self.name[:40]
+        if _exception_policy == REJECT:
+            self.ctx._reply = ("554", "554 5.3.0 " + msg)
+        elif _exception_policy == TEMPFAIL:
+            self.ctx._reply = ("451", "451 4.3.0 " + msg)
+        return _exception_policy
+
+    ## Invoke a callback with the %milter context stage set for getsymval.
+    # If the callback returns a future or coroutine, return a coroutine
+    # for the result.
+    def call(self, stage, func, *args):
+        self.ctx._stage = stage
+        try:
+            rc = func(*args)
+            if not isinstance(rc, int):
+                if isinstance(rc, futures.Future) or hasattr(rc, "__await__"):
+                    return self.resolve(stage, rc, func.__name__)
+                raise Milter.error("The %s callback must return int" % func.__name__)
+        except Exception:
+            rc = self._report_exception()
+        finally:
+            self.ctx._stage = None
+        return rc
+
+    ## Wait for a future or coroutine returned by a callback without
+    # blocking other connections.  While eom waits, progress is sent
+    # to the MTA every Milter.PROGRESS_INTERVAL seconds.
+    async def resolve(self, stage, rc, name):
+        if isinstance(rc, futures.Future):
+            task = asyncio.wrap_future(rc)
+        else:
+            task = asyncio.ensure_future(rc)
+        self.ctx._stage = stage
+        try:
+            while True:
+                done, _ = await asyncio.wait((task,), timeout=Milter.PROGRESS_INTERVAL)
+                if done:
+                    break
+                if stage == M_EOM:
+                    self.send(SMFIR_PROGRESS)
+                    await self.writer.drain()
+            rc = task.result()
+            if not isinstance(rc, int):
+                raise Milter.error("The %s callback must return int" % name)
+        except Exception:
+            rc = self._report_exception()
+        finally:
+            self.ctx._stage = None
+        return rc
+
+    ## Return the result of call(), waiting for it if necessary.
+    async def result(self, rc):
+        if asyncio.iscoroutine(rc):
+            return await rc
+        return rc
+
+    def reply(self, cmd, rc):
+        if rc == NOREPLY or self.protocol & NOREPLY_BITS.get(cmd, 0):
+            return
+        reply = self.ctx._reply
+        self.ctx._reply = None
+        # like libmilter, use the reply only when it agrees with the result
+        if reply and (
+            rc == REJECT and reply[0][0] == "5" or rc == TEMPFAIL and reply[0][0] == "4"
+        ):
+            self.send(SMFIR_REPLYCODE, _bytes(reply[1]), b"\0")
+        else:
+            self.send(REPLY_CODES.get(rc, SMFIR_TEMPFAIL))
+
+    def priv(self):
+        m = self.ctx.getpriv()
+        if not m:
+            m = Milter.factory()
+            m._setctx(self.ctx)
+            m._actions = self.actions
+            m._protocol = self.protocol
+        return m
+
+    ## Return the method to call for a callback.  This is from the
+    # dispatch table set by Milter.Base, like the milter module,
+    # or else the method named default.
+    def method(self, name, default=None):
+        m = self.priv()
+        d = self.ctx._dispatch
+        return d and d[DISPATCH_INDEX[name]] or getattr(m, default or name)
+
+    def do_optneg(self, data):
+        version, actions, protocol = struct.unpack("!III", data[:12])
+        opts = [actions, protocol, 0, 0]
+        self.ctx._stage = -1
+        try:
+            rc = Milter.negotiate_callback(self.ctx, opts)
+        except Exception:
+            traceback.print_exc()
+            rc = ALL_OPTS
+        finally:
+            self.ctx._stage = None
+        if rc == CONTINUE:
+            self.actions = opts[0] & actions
+            self.protocol = opts[1] & protocol
+        else:
+            self.actions = CURR_ACTS & actions
+            self.protocol = 0
+            self.ctx._symlist.clear()
+        syms = b""
+        if self.actions & SETSYMLIST:
+            for stage, macros in sorted(self.ctx._symlist.items()):
+                syms += struct.pack("!I", stage) + macros + b"\0"
+        self.send(
+            SMFIC_OPTNEG,
+            struct.pack("!III", min(version, PROT_VERSION), self.actions, self.protocol),
+            syms,
+        )
+
+    def do_macro(self, data):
+        stage = MACRO_STAGES.get(data[:1])
+        if stage is None:
+            return
+        # macros for later stages no longer apply
+        for s in STAGE_ORDER[STAGE_ORDER.index(stage) :]:
+            self.ctx._macros.pop(s, None)
+        a = _cstrings(data[1:])
+        self.ctx._macros[stage] = {
+            _str(a[i]): _str(a[i + 1]) for i in range(0, len(a) - 1, 2)
+        }
+
+    def do_connect(self, data):
+        i = data.index(b"\0")
+        hostname = _str(data[:i])
+        family = data[i + 1 : i + 2]
+        if family in (b"4", b"6"):
+            (port,) = struct.unpack("!H", data[i + 2 : i + 4])
+            addr = _str(_cstrings(data[i + 4 :])[0])
+            if family == b"4":
+                family, hostaddr = AF_INET, (addr, port)
+            else:
+                if addr[:5].lower() == "ipv6:":
+                    addr = addr[5:]
+                family, hostaddr = AF_INET6, (addr, port, 0, 0)
+        elif family == b"L":
+            family, hostaddr = AF_UNIX, _str(_cstrings(data[i + 4 :])[0])
+        else:
+            family, hostaddr = 0, None
+        self.priv()
+        return self.call(
+            M_CONNECT, Milter.connect_callback, self.ctx, hostname, family, hostaddr
+        )
+
+    def do_helo(self, data):
+        return self.call(M_HELO, self.method("hello"), _str(_cstrings(data)[0]))
+
+    def do_envfrom(self, data):
+        m = self.method("envfrom", "envfrom_bytes")
+        return self.call(M_ENVFROM, m, *_cstrings(data))
+
+    def do_envrcpt(self, data):
+        m = self.method("envrcpt", "envrcpt_bytes")
+        return self.call(M_ENVRCPT, m, *_cstrings(data))
+
+    def do_data(self, data):
+        return self.call(M_DATA, self.method("data"))
+
+    def do_header(self, data):
+        a = data.split(b"\0")
+        m = self.priv()
+        if getattr(m, "_batch_headers", False):
+            self.headers.append((_str(a[0]), a[1]))
+            return CONTINUE
+        return self.call(None, self.method("header", "header_bytes"), _str(a[0]), a[1])
+
+    async def do_eoh(self, data):
+        m = self.priv()
+        if getattr(m, "_batch_headers", False):
+            hdrs, self.headers = self.headers, []
+            rc = self.call(None, self.method("headers", "headers_bytes"), hdrs)
+            rc = await self.result(rc)
+            if rc not in (CONTINUE, NOREPLY):
+                return rc
+        return await self.result(self.call(M_EOH, self.method("eoh")))
+
+    def do_body(self, data):
+        return self.call(None, self.method("body"), data)
+
+    async def do_eom(self, data):
+        if data:
+            rc = await self.result(self.call(None, self.method("body"), data))
+            if rc not in (CONTINUE, NOREPLY, SKIP):
+                return rc
+        return await self.result(self.call(M_EOM, self.method("eom")))
+
+    def do_unknown(self, data):
+        return self.call(None, self.method("unknown"), _str(_cstrings(data)[0]))
+
+    def do_abort(self, data):
+        if self.ctx.getpriv():
+            self.call(None, self.method("abort"))
+        self.headers = []
+        for s in STAGE_ORDER[STAGE_ORDER.index(M_ENVFROM) :]:
+            self.ctx._macros.pop(s, None)
+        self.ctx._reply = None
+
+    def close(self):
+        if self.ctx.getpriv():
+            self.call(None, Milter.close_callback, self.ctx)
+        self.ctx = AsyncContext(self)
+        self.headers = []
+
+    ## Process commands from the MTA until it quits.
+    async def run(self):
+        try:
+            while True:
+                cmd, data = await self.read_packet()
+                if cmd == SMFIC_QUIT:
+                    break
+                if cmd == SMFIC_QUIT_NC:
+                    # MTA reuses the %milter connection for a new SMTP session
+                    self.close()
+                    continue
+                func = self.dispatch.get(cmd)
+                if func is None:
+                    continue
+                rc = await self.result(func(data))
+                if rc is not None:
+                    self.reply(cmd, rc)
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.close()
+            self.writer.close()
+
+
+## Start serving the %milter protocol on an asyncio event loop.
+# @param name the name of the %milter known to the MTA
+# @param socketname the socket in the format passed to milter.setconn()
+# @param timeout the time in secs to wait for the MTA before
+#       dropping the connection
+# @param rmsock remove an existing unix domain socket first if true
+# @param backlog the socket listen queue size
+# @param sock an already listening socket to use instead of socketname
+# @param reuse_port set SO_REUSEPORT so that several processes can
+#       listen on the same inet port
+# @return the asyncio.Server
+async def start_server(
+    name, socketname, timeout=0, rmsock=True, backlog=100, sock=None, reuse_port=False
+):
+    async def handle(reader, writer):
+        await MilterConnection(name, reader, writer, timeout).run()
+
+    if sock is not None:
+        if sock.family == AF_UNIX:
+            return await asyncio.start_unix_server(handle, sock=sock)
+        return await asyncio.start_server(handle, sock=sock)
+    family, addr = parse_socketname(socketname)
+    if family == AF_UNIX:
+        if rmsock and os.path.exists(addr):
+            os.remove(addr)
+        return await asyncio.start_unix_server(handle, addr, backlog=backlog)
+    host, port = addr
+    return await asyncio.start_server(
+        handle,
+        host,
+        port,
+        family=family,
+        backlog=backlog,
+        reuse_address=True,
+        reuse_port=reuse_port or None,
+    )
+
+
+## Run the %milter on an asyncio event loop.
+# A drop in replacement for Milter.runmilter() that does not use
+# libmilter, and does not run a thread for each connection.
+# With <code>workers</code> set, that many worker processes are forked,
+# each running its own event loop.  The socket is opened once, before
+# forking, and inherited by the workers, so that an error such as the
+# port being in use is raised to the caller.
+# @param name the name of the %milter known to the MTA
+# @param socketname the socket in the format passed to milter.setconn()
+# @param timeout the time in secs to wait for the MTA before
+#       dropping the connection
+# @param rmsock remove an existing unix domain socket first if true
+# @param workers the number of worker processes to fork, or 0 to
+#       run in the current process
+def runmilter(name, socketname, timeout=0, rmsock=True, workers=0):
+    sock = None
+    family, addr = parse_socketname(socketname)
+    if workers > 0 and family == AF_UNIX:
+        if rmsock and os.path.exists(addr):
+            os.remove(addr)
+        sock = socket.socket(AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(addr)
+        sock.listen(100)
+    elif workers > 0:
+        sock = socket.create_server(addr, family=family, backlog=100)
+
+    async def serve():
+        server = await start_server(name, socketname, timeout, rmsock, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+    def main():
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+
+    if workers > 0:
+        # workers are alike, so the worker number is not needed
+        Milter.prefork(workers, lambda worker: main())
+    else:
+        main()
@@ -9,6 +9,18 @@
 # Entries with other values are not persistent.  This is used to hold failed
 # CBV results.
 #
+# With snapshot=True, the persistent store is instead a binary snapshot,
+# fname.snap, of epoch timestamps and addresses, which loads in a few bulk
+# operations, and an append-only binary journal, fname.journal, of changes
+# since the snapshot.  The journal is compacted into a new snapshot in the
+# background once it has compact_after records.  The text file, if present,
+# is an inbox for manual entries: they are added permanently at the next
+# load, and the file is renamed to fname.old.
+#
+# With flush_interval > 0, new persistent entries are queued, and written
+# by a background thread every flush_interval seconds with one write for
+# all of them.  Call flush() to write them now, and close() when done.
+#
 # $Log$
 # Revision 1.9  2008/05/08 21:35:57  customdesigned
 # Allow explicitly whitelisted email from banned_users.
@@ -42,30 +54,177 @@
 # Move AddrCache to Milter package.
 #
 
+# Entries with a timestamp are indexed by hour in a wheel of buckets, and
+# each change to the cache reaps a few entries from buckets that have
+# expired, so that entries that are never looked up again do not stay
+# in memory.  Non-persistent entries are also limited to max_size, evicting
+# the least recently used.
+#
+# Domain entries are also kept in a trie of labels from the top level
+# domain down.  An entry of *.example.com matches any domain under
+# example.com, and has_key(), match() and [] find the address, its domain,
+# or the nearest such parent domain, in one walk of the labels.
+#
+# An AddrCache is not thread safe: lookups delete expired entries and
+# reorder the LRU.  Use ConcurrentAddrCache to share a cache between
+# threads.  Its lookups take no lock, and changes are serialized.
+#
 # Author: Stuart D. Gathman <stuart@bmsi.com>
 # Copyright 2001,2002,2003,2004,2005 Business Management Systems, Inc.
 # This code is under the GNU General Public License.  See COPYING for details.
 
+import mmap
+import os
+import struct
+import sys
 import time
+from array import array
+from collections import OrderedDict, deque
+from itertools import repeat
+from threading import Event, Lock, RLock, Thread
 
 from Milter.plock import PLock
 
+# Seconds of timestamps in an expiry bucket
+BUCKET = 3600
+# Entries reaped or indexed for each change
+REAP_BATCH = 100
+
+# Start of a snapshot, followed by the entry count, the timestamps as little
+# endian int64 (0 for permanent), and the addresses in utf-8 separated by
+# newlines.
+SNAP_MAGIC = b"AddrCache snapshot 2\n"
+SNAP_COUNT = struct.Struct("<I")
+# A journal record: timestamp (0 for permanent), length of the address.
+JOURNAL = struct.Struct("<qH")
+
+
+def write_snapshot(fp, items):
+    "Write (address, timestamp) pairs to a binary snapshot file."
+    keys = []
+    times = array("q")
+    for key, ts in items:
+        if "\n" not in key:
+            keys.append(key)
+            times.append(int(ts or 0))
+    if sys.byteorder != "little":
+        times.byteswap()
+    fp.write(SNAP_MAGIC + SNAP_COUNT.pack(len(keys)))
+    fp.write(times.tobytes())
+    fp.write("\n".join(keys).encode("utf-8"))
+
+
+def read_snapshot(fname):
+    "Return a cache dictionary from a binary snapshot file."
+    with open(fname, "rb") as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            return {}
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = len(SNAP_MAGIC)
+        if data[:start] != SNAP_MAGIC:
+            raise ValueError("not an AddrCache snapshot: " + fname)
+        (n,) = SNAP_COUNT.unpack_from(data, start)
+        start += SNAP_COUNT.size
+        times = array("q")
+        end = start + times.itemsize * n
+        times.frombytes(data[start:end])
+        if sys.byteorder != "little":
+            times.byteswap()
+        keys = n and data[end:].decode("utf-8").split("\n") or []
+    finally:
+        data.close()
+    return dict(zip(keys, zip(times, repeat(None))))
+
+
+def read_journal(fname, cache):
+    "Apply the records of a binary journal file to a cache dictionary."
+    try:
+        with open(fname, "rb") as fp:
+            data = fp.read()
+    except OSError:
+        return 0
+    pos = cnt = 0
+    end = len(data) - JOURNAL.size
+    while pos <= end:
+        ts, n = JOURNAL.unpack_from(data, pos)
+        pos += JOURNAL.size
+        if pos + n > len(data):
+            break  # torn write
+        cache[data[pos : pos + n].decode("utf-8")] = (ts, None)
+        pos += n
+        cnt += 1
+    return cnt
+
+
+class Writer(Thread):
+    "Call flush() on an AddrCache every interval seconds until stopped."
+
+    def __init__(self, cache, interval):
+        Thread.__init__(self, name="addrcache-write")
+        self.daemon = True
+        self.cache = cache
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.cache.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
 
 class AddrCache(object):
     time_format = "%Y%b%d %H:%M:%S %Z"
 
-    def __init__(self, renew=7, fname=None):
+    def __init__(
+        self,
+        renew=7,
+        fname=None,
+        snapshot=False,
+        compact_after=100000,
+        flush_interval=0,
+        max_size=100000,
+    ):
         self.age = renew
         self.cache = {}
+        self.max_size = max_size
+        self.lru = OrderedDict()  # keys of non-persistent entries
+        self.buckets = {}  # BUCKET number -> set of keys with timestamps in it
+        self.trie = {}  # label -> node, None -> True for an entry
+        self.next_reap = float("inf")  # when the oldest bucket expires
+        self.unindexed = []  # loaded keys not yet in a bucket
+        self.expired = 0
+        self.evictions = 0
         self.fname = fname
+        self.snapshot = snapshot
+        self.compact_after = compact_after
+        self.journal = None  # open journal file
+        self.journal_len = 0  # records in journal
+        self.compactor = None
+        self.lock = Lock()
+        self.pending = deque()  # (sender, timestamp) not yet written
+        self.writer = None
+        if flush_interval > 0:
+            self.writer = Writer(self, flush_interval)
+            self.writer.start()
 
     def load(self, fname, age=0):
         "Load address cache from persistent store."
         if not age:
             age = self.age
+        self.flush()
         self.fname = fname
+        if self.snapshot:
+            self._load_snapshot(age)
+        else:
+            self._load_text(age)
+
+    def _load_text(self, age):
+        "Load the text store, and rewrite it without expired entries."
         cache = {}
-        self.cache = cache
         now = time.time()
         lock = PLock(self.fname)
         wfp = lock.lock()
@@ -98,6 +257,285 @@ class AddrCache(object):
                 lock.unlock()
         except IOError:
             lock.unlock()
+        self._reindex(cache)
+
+    def _load_snapshot(self, age):
+        "Load the snapshot and journal, and any manual entries."
+        self._close_journal()
+        fname = self.fname
+        try:
+            cache = read_snapshot(fname + ".snap")
+        except OSError:
+            cache = {}
+        # a journal being compacted when we stopped
+        n = read_journal(fname + ".journal.1", cache)
+        n += read_journal(fname + ".journal", cache)
+        too_old = time.time() - age * 24 * 60 * 60  # max age in days
+        manual = []
+        try:
+            fp = open(fname)
+        except OSError:
+            fp = None
+        if fp is not None:
+            with fp:
+                for ln in fp:
+                    a = ln.split(None, 1)
+                    if len(a) == 1:
+                        manual.append(a[0].lower())
+                    elif a:
+                        # text store being converted
+                        try:
+                            l = time.strptime(a[1].strip(), self.time_format)
+                        except ValueError:
+                            continue
+                        t = time.mktime(l)
+                        if t >= too_old:
+                            cache[a[0].lower()] = (int(t), None)
+                            n += 1
+        for key in manual:
+            cache[key] = (0, None)
+        self._reindex(cache)
+        self.journal_len = n + len(manual)
+        if fp is not None:
+            # persist the conversion before setting the text file aside
+            self.compact()
+            os.rename(fname, fname + ".old")
+
+    def _log(self, sender, ts):
+        "Write or queue a persistent entry, permanent if ts is None."
+        if self.writer:
+            self.pending.append((sender, ts))
+        else:
+            self._write([(sender, ts)])
+
+    def _write(self, entries):
+        "Append (sender, timestamp) entries to the journal or text store."
+        if not self.snapshot:
+            lines = []
+            for sender, ts in entries:
+                if ts is None:
+                    lines.append(sender + "\n")
+                else:
+                    s = time.strftime(AddrCache.time_format, time.localtime(ts))
+                    lines.append(sender + " " + s + "\n")  # log refreshed senders
+            with self.lock:
+                with open(self.fname, "a") as fp:
+                    fp.writelines(lines)
+            return
+        records = []
+        for sender, ts in entries:
+            key = sender.lower().encode("utf-8")
+            records.append(JOURNAL.pack(int(ts or 0), len(key)) + key)
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.fname + ".journal", "ab")
+            self.journal.write(b"".join(records))
+            self.journal.flush()
+            self.journal_len += len(records)
+            if self.journal_len >= self.compact_after and not self.compactor:
+                self.compactor = Thread(target=self.compact, name="addrcache-compact")
+                self.compactor.daemon = True
+                self.compactor.start()
+
+    def compact(self):
+        """Write a new snapshot of the persistent entries that have not
+        expired, and discard the journal."""
+        fname = self.fname
+        journal = fname + ".journal"
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            # records since the last snapshot, until this one is written
+            if os.path.exists(journal):
+                if os.path.exists(journal + ".1"):
+                    with open(journal + ".1", "ab") as out, open(journal, "rb") as fp:
+                        out.write(fp.read())
+                    os.remove(journal)
+                else:
+                    os.rename(journal, journal + ".1")
+            self.journal_len = 0
+            items = list(self.cache.items())
+        try:
+            too_old = time.time() - self.age * 24 * 60 * 60  # max age in days
+            lock = PLock(fname + ".snap")
+            wfp = lock.lock()
+            try:
+                write_snapshot(
+                    wfp.buffer,
+                    (
+                        (key, ts)
+                        for key, (ts, res) in items
+                        if not res and (not ts or ts > too_old)
+                    ),
+                )
+                wfp.flush()
+                os.fsync(wfp.fileno())
+            except:
+                lock.unlock()
+                raise
+            lock.commit()
+            try:
+                os.remove(journal + ".1")
+            except OSError:
+                pass
+        finally:
+            self.compactor = None
+
+    def flush(self):
+        "Write queued entries."
+        entries = []
+        pending = self.pending
+        while pending:
+            entries.append(pending.popleft())
+        if entries:
+            self._write(entries)
+
+    def _close_journal(self):
+        "Wait for a compaction in progress, and close the journal."
+        compactor = self.compactor
+        if compactor:
+            compactor.join()
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def close(self):
+        "Stop the writer thread, write queued entries, and close the journal."
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        self.flush()
+        self._close_journal()
+
+    def _reindex(self, cache):
+        """Replace the cache with loaded entries, and start indexing them.
+        The new trie is built first, so that lookups during a load see
+        either the old entries or the new ones."""
+        trie = {}
+        for key in cache:
+            if "@" not in key:
+                self._trie_add(key, trie)
+        self.lru = OrderedDict()
+        self.buckets = {}
+        self.next_reap = float("inf")
+        # indexed a few at a time by reap, so that load stays fast
+        self.unindexed = list(cache)
+        self.cache = cache
+        self.trie = trie
+
+    def _trie_add(self, domain, trie=None):
+        "Add a domain entry to the trie, or to another trie."
+        node = self.trie if trie is None else trie
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node[None] = True
+
+    def _trie_remove(self, domain):
+        "Remove a domain entry from the trie, and any nodes left empty."
+        path = []
+        node = self.trie
+        for label in reversed(domain.split(".")):
+            path.append((node, label))
+            node = node.get(label)
+            if node is None:
+                return
+        node.pop(None, None)
+        for parent, label in reversed(path):
+            if parent[label]:
+                break
+            del parent[label]
+
+    def _remove(self, key):
+        "Remove an entry and its index entries.  Returns the entry, or None."
+        e = self.cache.pop(key, None)
+        if e is not None:
+            self._index(key, e[0], None)
+            self.lru.pop(key, None)
+            if "@" not in key:
+                self._trie_remove(key)
+        return e
+
+    def _index(self, key, old, ts):
+        "Move key from the bucket for timestamp old to the one for ts."
+        if old:
+            b = self.buckets.get(int(old // BUCKET))
+            if b is not None:
+                b.discard(key)
+        if ts:
+            n = int(ts // BUCKET)
+            b = self.buckets.get(n)
+            if b is None:
+                b = self.buckets.setdefault(n, set())
+                expires = (n + 1) * BUCKET + self.age * 24 * 60 * 60
+                if expires < self.next_reap:
+                    self.next_reap = expires
+            b.add(key)
+
+    def _evictable(self, key):
+        "Return whether the least recently used key can be evicted."
+        return True
+
+    def _delete(self, key):
+        "Delete an expired entry."
+        if self._remove(key) is not None:
+            self.expired += 1
+
+    def _put(self, key, ts, res):
+        "Set an entry, keeping the indexes current."
+        old = self.cache.get(key)
+        self.cache[key] = (ts, res)
+        self._index(key, old and old[0], ts)
+        if old is None and "@" not in key:
+            self._trie_add(key)
+        if res is None:
+            self.lru.pop(key, None)
+        else:
+            self.lru[key] = None
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.max_size:
+                k, v = self.lru.popitem(last=False)
+                if not self._evictable(k):
+                    self.lru[k] = None
+                elif self._remove(k) is not None:
+                    self.evictions += 1
+        self.reap()
+
+    def reap(self, batch=REAP_BATCH, now=None):
+        """Delete up to batch entries from buckets that have expired,
+        after indexing up to batch loaded entries.  Returns the number deleted."""
+        unindexed = self.unindexed
+        for i in range(min(batch, len(unindexed))):
+            key = unindexed.pop()
+            e = self.cache.get(key)
+            if e is not None:
+                self._index(key, None, e[0])
+        if now is None:
+            now = time.time()
+        if now < self.next_reap:
+            return 0
+        too_old = now - self.age * 24 * 60 * 60
+        cnt = 0
+        while self.buckets and cnt < batch:
+            n = min(self.buckets)
+            if (n + 1) * BUCKET > too_old:
+                break
+            b = self.buckets[n]
+            while b and cnt < batch:
+                key = b.pop()
+                e = self.cache.get(key)
+                if e is not None and e[0] and e[0] <= too_old:
+                    self._delete(key)
+                    cnt += 1
+            if not b:
+                del self.buckets[n]
+        if self.buckets:
+            n = min(self.buckets)
+            self.next_reap = (n + 1) * BUCKET + self.age * 24 * 60 * 60
+        else:
+            self.next_reap = float("inf")
+        return cnt
 
     def has_precise_key(self, sender):
         """True if precise sender is cached and has not expired.  Don't
@@ -109,60 +547,136 @@ class AddrCache(object):
             too_old = time.time() - self.age * 24 * 60 * 60  # max age in days
             if not ts or ts > too_old:
                 return True
-            del self.cache[lsender]
+            self._delete(lsender)
         except KeyError:
             pass
         return False
 
+    def match(self, sender):
+        """Return the key of the entry for sender that has not expired:
+        the address, else its domain, else the nearest *.parent domain.
+        Return None if there is none."""
+        if not sender:
+            return None
+        lsender = sender.lower()
+        if self.has_precise_key(lsender):
+            return lsender
+        host = lsender.split("@", 1)[-1]
+        labels = host.split(".")
+        wild = []
+        node = self.trie
+        i = len(labels)
+        while i:
+            w = node.get("*")
+            if w is not None and None in w:
+                wild.append(i)
+            i -= 1
+            node = node.get(labels[i])
+            if node is None:
+                break
+        else:
+            if host != lsender and None in node and self.has_precise_key(host):
+                return host
+        # the nearest parent first
+        for i in reversed(wild):
+            key = ".".join(["*"] + labels[i:])
+            if self.has_precise_key(key):
+                return key
+        return None
+
     def has_key(self, sender):
         "True if sender is cached and has not expired."
-        if self.has_precise_key(sender):
-            return True
-        try:
-            user, host = sender.split("@", 1)
-            return self.has_precise_key(host)
-        except:
-            pass
-        return False
+        return self.match(sender) is not None
 
     __contains__ = has_key
 
     def __getitem__(self, sender):
-        try:
-            lsender = sender.lower()
-            ts, res = self.cache[lsender]
-            too_old = time.time() - self.age * 24 * 60 * 60  # max age in days
-            if not ts or ts > too_old:
-                return res
-            del self.cache[lsender]
+        key = self.match(sender)
+        e = key and self.cache.get(key)
+        if not e:
             raise KeyError(sender)
-        except KeyError as x:
-            try:
-                user, host = sender.split("@", 1)
-                return self.__getitem__(host)
-            except ValueError:
-                raise x
+        ts, res = e
+        if res is not None and key in self.lru:
+            self.lru.move_to_end(key)
+        return res
 
     def addperm(self, sender, res=None):
         "Add a permanent sender."
         lsender = sender.lower()
-        if self.has_key(lsender):
+        if self.has_precise_key(lsender):
             ts, res = self.cache[lsender]
             if not ts:
                 return  # already permanent
-        self.cache[lsender] = (None, res)
-        if not res:
-            with open(self.fname, "a") as fp:
-                print(sender, file=fp)
+        self._put(lsender, None, res)
+        if not res and self.fname:
+            self._log(sender, None)
 
     def __setitem__(self, sender, res):
         lsender = sender.lower()
         now = time.time()
-        self.cache[lsender] = (now, res)
+        self._put(lsender, now, res)
         if not res and self.fname:
-            s = time.strftime(AddrCache.time_format, time.localtime(now))
-            with open(self.fname, "a") as fp:
-                print(sender, s, file=fp)  # log refreshed senders
+            self._log(sender, now)
 
     def __len__(self):
         return len(self.cache)
+
+
+class ConcurrentAddrCache(AddrCache):
+    """An AddrCache for many threads.  Lookups take no lock: each is a few
+    dictionary gets, which are atomic in CPython, and they leave expired
+    entries for the reaper instead of deleting them.  Changes take a lock.
+    Lookups of non-persistent entries add the key to a used set instead of
+    reordering the LRU, and a used entry gets a second chance at the end
+    instead of being evicted."""
+
+    def __init__(self, *args, **kw):
+        AddrCache.__init__(self, *args, **kw)
+        self.wlock = RLock()
+        self.used = set()
+
+    def has_precise_key(self, sender):
+        e = sender and self.cache.get(sender.lower())
+        if not e:
+            return False
+        ts = e[0]
+        return not ts or ts > time.time() - self.age * 24 * 60 * 60
+
+    def __getitem__(self, sender):
+        key = self.match(sender)
+        e = key and self.cache.get(key)
+        if not e:
+            raise KeyError(sender)
+        if e[1] is not None:
+            self.used.add(key)
+        return e[1]
+
+    def _reindex(self, cache):
+        AddrCache._reindex(self, cache)
+        self.used = set()
+
+    def _evictable(self, key):
+        if key in self.used:
+            self.used.discard(key)
+            return False
+        return True
+
+    def _remove(self, key):
+        self.used.discard(key)
+        return AddrCache._remove(self, key)
+
+    def load(self, fname, age=0):
+        with self.wlock:
+            AddrCache.load(self, fname, age)
+
+    def reap(self, batch=REAP_BATCH, now=None):
+        with self.wlock:
+            return AddrCache.reap(self, batch, now)
+
+    def addperm(self, sender, res=None):
+        with self.wlock:
+            AddrCache.addperm(self, sender, res)
+
+    def __setitem__(self, sender, res):
+        with self.wlock:
+            AddrCache.__setitem__(self, sender, res)
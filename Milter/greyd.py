@@ -0,0 +1,233 @@
+## @package Milter.greyd
+# A greylist daemon shared by the %milter processes on a host.
+#
+# A shelve greylist is not safe to open from more than one process, and
+# sqlite serializes writers between processes with file locks.  This
+# daemon keeps one greylist, normally with a hot cache and write-behind,
+# and answers checks from any number of Client objects over a unix socket.
+# <pre>
+# python -m Milter.greyd /run/greyd.sock /var/lib/milter/greylist.db \
+#     --backend=binary --cache-size=100000 --flush=5
+# </pre>
+# Workers then use a Client in place of a Greylist:
+# <pre>
+# grey = Milter.greyd.Client("/run/greyd.sock")
+# cnt = grey.check(ip, sender, recipient)
+# </pre>
+# @since 1.0.6
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import struct
+from threading import Lock
+
+from Milter.greylist import BACKENDS, open_greylist
+
+log = logging.getLogger("milter.greylist")
+
+## A request: operation, timeinc, and the lengths of ip, sender and
+# recipient, which follow in utf-8.  The only operation is b"C", check.
+REQUEST = struct.Struct("!cdHHH")
+## A response: the count returned by check, or -1 if it failed.
+RESPONSE = struct.Struct("!i")
+
+
+class GreydError(Exception):
+    "The daemon could not check a triple."
+    pass
+
+
+def pack_request(ip, sender, recipient, timeinc=0):
+    "Return a check request as bytes."
+    a = ip.encode("utf-8")
+    b = sender.encode("utf-8", "surrogateescape")
+    c = recipient.encode("utf-8", "surrogateescape")
+    return REQUEST.pack(b"C", timeinc, len(a), len(b), len(c)) + a + b + c
+
+
+class Server(object):
+    """Answer check requests for a greylist.  All checks run on the event
+    loop thread, in the order received, so the greylist needs no locks
+    against other processes.  Requests on a connection may be pipelined,
+    and are answered in order.
+
+    A check blocks every connection while it runs.  That includes a write
+    of queued updates when a shard reaches max_pending, or a slow disk.
+    Give the greylist a flush_interval large enough that the flusher
+    thread writes most updates, and a hot cache so that most checks
+    do not read the database."""
+
+    def __init__(self, grey):
+        self.grey = grey
+        self.requests = 0
+        self.writers = set()  # open connections
+
+    async def handle(self, reader, writer):
+        check = self.grey.check
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    hdr = await reader.readexactly(REQUEST.size)
+                except asyncio.IncompleteReadError:
+                    break
+                op, timeinc, a, b, c = REQUEST.unpack(hdr)
+                data = await reader.readexactly(a + b + c)
+                try:
+                    if op != b"C":
+                        raise GreydError("unknown operation %r" % op)
+                    rc = check(
+                        data[:a].decode("utf-8"),
+                        data[a : a + b].decode("utf-8", "surrogateescape"),
+                        data[a + b :].decode("utf-8", "surrogateescape"),
+                        timeinc,
+                    )
+                except Exception:
+                    log.exception("greyd check failed")
+                    rc = -1
+                self.requests += 1
+                writer.write(RESPONSE.pack(rc))
+                # returns at once unless the client is not reading replies
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def start(self, path, rmsock=True):
+        "Listen on a unix socket, and return the asyncio server."
+        if rmsock and os.path.exists(path):
+            os.remove(path)
+        return await asyncio.start_unix_server(self.handle, path)
+
+    def run(self, path, rmsock=True):
+        """Serve on a unix socket until SIGTERM or SIGINT, then close the
+        greylist, writing queued updates, and remove the socket."""
+
+        async def serve():
+            loop = asyncio.get_running_loop()
+            stop = asyncio.Event()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            server = await self.start(path, rmsock)
+            await stop.wait()
+            server.close()
+            # clients keep idle connections open
+            for writer in list(self.writers):
+                writer.close()
+            await server.wait_closed()
+
+        try:
+            asyncio.run(serve())
+        finally:
+            self.grey.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class Client(object):
+    """Check greylist triples with a greylist daemon, with the same check()
+    API as a Greylist.  Up to pool_size idle connections are kept, so that
+    threads do not connect for each check, or wait for each other.
+    check_many() pipelines up to pipeline checks at a time on one
+    connection."""
+
+    def __init__(self, path, pool_size=8, timeout=10, pipeline=64):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pipeline = pipeline
+        self.pool = []
+        self.lock = Lock()
+
+    def _connect(self):
+        with self.lock:
+            if self.pool:
+                return self.pool.pop()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            return sock.makefile("rwb")
+        finally:
+            # the file keeps the socket open until it is closed
+            sock.close()
+
+    def _release(self, conn):
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(conn)
+                return
+        conn.close()
+
+    def check_many(self, triples, timeinc=0):
+        """Return a list of counts for (ip, sender, recipient) triples.
+        Requests are sent pipeline at a time, and their replies read
+        before sending more, so that neither side blocks writing while
+        the other is not reading."""
+        reqs = [pack_request(ip, s, r, timeinc) for ip, s, r in triples]
+        res = []
+        conn = self._connect()
+        try:
+            for i in range(0, len(reqs), self.pipeline):
+                batch = reqs[i : i + self.pipeline]
+                conn.write(b"".join(batch))
+                conn.flush()
+                data = conn.read(RESPONSE.size * len(batch))
+                if len(data) != RESPONSE.size * len(batch):
+                    raise GreydError("connection closed by greyd")
+                res.extend(rc for rc, in RESPONSE.iter_unpack(data))
+        except:
+            conn.close()
+            raise
+        self._release(conn)
+        if -1 in res:
+            raise GreydError("check failed")
+        return res
+
+    def check(self, ip, sender, recipient, timeinc=0):
+        "Return number of allowed messages for greylist triple."
+        return self.check_many(((ip, sender, recipient),), timeinc)[0]
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for conn in pool:
+            conn.close()
+
+
+def main(argv):
+    "Run a greylist daemon."
+    import argparse
+
+    p = argparse.ArgumentParser("python -m Milter.greyd", description=main.__doc__)
+    p.add_argument("socket")
+    p.add_argument("dbname")
+    p.add_argument("-b", "--backend", choices=BACKENDS, default="binary")
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--cache-size", type=int, default=100000)
+    p.add_argument("--flush", type=float, default=5, help="write-behind, seconds")
+    p.add_argument("--retain", type=int, default=36, help="days")
+    opts = p.parse_args(argv)
+    logging.basicConfig()
+    grey = open_greylist(
+        opts.backend,
+        opts.dbname,
+        grey_retain=opts.retain,
+        shards=opts.shards,
+        cache_size=opts.cache_size,
+        flush_interval=opts.flush,
+    )
+    Server(grey).run(opts.socket)
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
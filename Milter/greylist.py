@@ -1,9 +1,22 @@
 import csv
+import dbm
 import time
 import shelve
+import socket
+import struct
 import logging
-import urllib
-from threading import Lock
+import zlib
+from binascii import hexlify
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Event, Lock, RLock, Thread
+
+from Milter.utils import MASK, MASK6, addr2bin, cidr, inet_ntop
+
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote
 
 log = logging.getLogger("milter.greylist")
 
@@ -13,7 +26,7 @@ def quoteAddress(s):
     Address can either be a domain name, or local part.
     Returns the quoted address."""
 
-    s = urllib.quote(s, "@_-+~!.%")
+    s = quote(s, "@_-+~!.%")
     if s.startswith("."):
         s = "%2e" + s[1:]
     return s
@@ -38,93 +51,753 @@ class Record(object):
         )
 
 
-class Greylist(object):
-    def __init__(self, dbname, grey_time=10, grey_expire=4, grey_retain=36):
-        self.ignoreLastByte = False
+## Fixed part of a binary record: firstseen, lastseen, cnt.
+# Times are whole seconds.  Umis, if any, follows in utf-8.
+RECORD = struct.Struct("!III")
+
+
+def pack_ip(ip):
+    "Return an IP address packed into 4 or 16 bytes."
+    try:
+        n = addr2bin(ip)
+    except socket.error:
+        # not an address, keep the text
+        return ip.encode("utf-8")
+    if ":" in ip:
+        return struct.pack("!QQ", n >> 64, n & 0xFFFFFFFFFFFFFFFF)
+    return struct.pack("!L", n)
+
+
+def unpack_ip(b):
+    "Return the text of an IP address packed by pack_ip."
+    if len(b) == 4:
+        return socket.inet_ntoa(b)
+    if len(b) == 16:
+        return inet_ntop(b)
+    return b.decode("utf-8")
+
+
+def hash_address(s):
+    "Return an 8 byte hash of an email address."
+    return blake2b(s.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+
+
+def pack_record(r):
+    "Return a record tuple packed into bytes."
+    b = RECORD.pack(int(r[0]), int(r[1]), r[2])
+    if r[3] is not None:
+        b += r[3].encode("utf-8")
+    return b
+
+
+def unpack_record(b):
+    "Return the record tuple for bytes packed by pack_record."
+    firstseen, lastseen, cnt = RECORD.unpack_from(b)
+    umis = b[RECORD.size :].decode("utf-8") or None
+    return (firstseen, lastseen, cnt, umis)
+
+
+def write_csv(fp, records):
+    "Write records as yielded by records() to a csv file."
+    csv.writer(fp).writerows(records)
+
+
+def read_csv(fp):
+    "Yield records from a csv file written by write_csv."
+    for ip, sender, recipient, firstseen, lastseen, cnt, umis in csv.reader(fp):
+        yield (
+            ip,
+            sender,
+            recipient,
+            float(firstseen),
+            float(lastseen),
+            int(cnt),
+            umis or None,
+        )
+
+
+## Start of a binary greylist dump.
+DUMP_MAGIC = b"pymilter greylist dump 1\n"
+## A record in a binary dump: firstseen, lastseen, cnt, and the lengths
+# of ip, sender, recipient and umis that follow in utf-8.
+# A umis length of 0xFFFF is None.
+DUMP = struct.Struct("!ddIHHHH")
+
+
+def write_dump(fp, records):
+    "Write records as yielded by records() to a binary file."
+    fp.write(DUMP_MAGIC)
+    pack = DUMP.pack
+    for ip, sender, recipient, firstseen, lastseen, cnt, umis in records:
+        a = ip.encode("utf-8")
+        b = sender.encode("utf-8", "surrogateescape")
+        c = recipient.encode("utf-8", "surrogateescape")
+        d = b"" if umis is None else umis.encode("utf-8")
+        n = 0xFFFF if umis is None else len(d)
+        fp.write(pack(firstseen, lastseen, cnt, len(a), len(b), len(c), n))
+        fp.write(a + b + c + d)
+
+
+def read_dump(fp):
+    "Yield records from a binary file written by write_dump."
+    if fp.read(len(DUMP_MAGIC)) != DUMP_MAGIC:
+        raise ValueError("not a greylist dump")
+    size = DUMP.size
+    unpack = DUMP.unpack
+    while True:
+        h = fp.read(size)
+        if not h:
+            break
+        firstseen, lastseen, cnt, a, b, c, d = unpack(h)
+        data = fp.read(a + b + c + (d if d != 0xFFFF else 0))
+        yield (
+            data[:a].decode("utf-8"),
+            data[a : a + b].decode("utf-8", "surrogateescape"),
+            data[a + b : a + b + c].decode("utf-8", "surrogateescape"),
+            firstseen,
+            lastseen,
+            cnt,
+            None if d == 0xFFFF else data[a + b + c :].decode("utf-8"),
+        )
+
+
+def progress(records, out, interval=5):
+    """Pass records through, writing the count and rate to out
+    every interval seconds, and when done."""
+    start = last = time.time()
+    cnt = 0
+    for r in records:
+        yield r
+        cnt += 1
+        if not cnt % 1000:
+            now = time.time()
+            if now >= last + interval:
+                last = now
+                out.write("%d records, %.0f/sec\n" % (cnt, cnt / (now - start)))
+    elapsed = time.time() - start
+    out.write(
+        "%d records in %.1f sec, %.0f/sec\n"
+        % (cnt, elapsed, elapsed and cnt / elapsed or 0)
+    )
+
+
+def shard_names(dbname, shards):
+    """Return the database file names for a greylist split into shards.
+    A single shard uses dbname unchanged."""
+    if shards > 1:
+        return ["%s.%d" % (dbname, i) for i in range(shards)]
+    return [dbname]
+
+
+def shard_index(key, shards):
+    "Return the shard for a key.  This must not change between runs."
+    if shards > 1:
+        return zlib.crc32(key.encode("utf-8", "surrogateescape")) % shards
+    return 0
+
+
+class Flusher(Thread):
+    "Call flush() on a greylist every interval seconds until stopped."
+
+    def __init__(self, grey, interval):
+        Thread.__init__(self, name="greylist-flush")
+        self.daemon = True
+        self.grey = grey
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.grey.flush()
+            except Exception:
+                log.exception("greylist flush failed")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Cleaner(Thread):
+    """Delete expired records from a greylist until stopped, examining
+    at most rate records a second.  After each pass over all shards,
+    wait interval seconds before starting the next."""
+
+    def __init__(self, grey, rate, interval):
+        Thread.__init__(self, name="greylist-clean")
+        self.daemon = True
+        self.grey = grey
+        self.rate = rate
+        self.interval = interval
+        self.deleted = 0
+        self.stopped = Event()
+
+    def run(self):
+        pause = float(self.grey.clean_batch) / self.rate
+        while True:
+            try:
+                cnt, done = self.grey.clean_step()
+                self.deleted += cnt
+            except Exception:
+                log.exception("greylist clean failed")
+                done = True
+            if self.stopped.wait(done and self.interval or pause):
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class HotCache(object):
+    """LRU cache of active triples for one greylist shard.
+    Entries are lists of [firstseen, lastseen, cnt, umis, written],
+    where written is the lastseen last written to the database.
+    Entries expire ttl seconds after lastseen."""
+
+    def __init__(self, size, ttl):
+        self.entries = OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, now):
+        "Count a check for a cached triple and return its entry, or None."
+        e = self.entries.get(key)
+        if e is None or now > e[1] + self.ttl:
+            if e is not None:
+                # the database has expired it too
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        e[1] = now
+        e[2] += 1
+        return e
+
+    def add(self, key, r):
+        """Cache a record just written.
+        Returns evicted (key, entry) pairs with lastseen not written."""
+        self.entries[key] = list(r) + [r[1]]
+        self.entries.move_to_end(key)
+        evicted = []
+        while len(self.entries) > self.size:
+            k, e = self.entries.popitem(last=False)
+            if e[1] != e[4]:
+                evicted.append((k, e))
+        return evicted
+
+    def unwritten(self):
+        "Return (key, entry) pairs with lastseen not written, marking them written."
+        stale = [(k, e) for k, e in self.entries.items() if e[1] != e[4]]
+        for k, e in stale:
+            e[4] = e[1]
+        return stale
+
+
+class BaseGreylist(object):
+    """Greylist logic shared by the shelve and sqlite greylists.
+    Records are tuples of (firstseen, lastseen, cnt, umis).
+    Subclasses open the shards, and implement _load and _write.
+
+    With shards > 1, triples are spread by hash over that many databases,
+    each with its own lock, so that checks for unrelated triples
+    do not wait for each other.
+
+    With flush_interval > 0, updates are kept in memory and written
+    by a background thread every flush_interval seconds, with one
+    sync or transaction for all of them.  A shard is also written when it
+    has max_pending/shards updates waiting, so that a crash loses at most
+    max_pending updates.  Other processes do not see queued updates.
+
+    With cache_size > 0, up to that many active triples are kept in memory,
+    and checks for them are answered without reading the database.
+    The new lastseen is written only when it is cache_writeback seconds
+    newer than the last one written, when the triple is evicted,
+    and on flush.
+
+    Expired records are deleted in batches of clean_batch, holding
+    the shard lock for one batch at a time, by clean() or clean_step().
+    With clean_rate > 0, a background thread deletes them at no more
+    than clean_rate records a second, starting a new pass over the
+    shards clean_interval seconds after the last one finished.
+
+    Triples are keyed by the network of the IP with prefix length prefix4
+    for IPv4, and prefix6 for IPv6, so that retries from other addresses
+    of a mail farm are not greylisted again.  The default keys by the
+    exact IP.  Setting ignoreLastByte keys by /24 and /64."""
+
+    def __init__(
+        self,
+        grey_time=10,
+        grey_expire=4,
+        grey_retain=36,
+        shards=1,
+        flush_interval=0,
+        max_pending=1000,
+        cache_size=0,
+        cache_writeback=3600,
+        clean_batch=1000,
+        clean_rate=0,
+        clean_interval=3600,
+        prefix4=32,
+        prefix6=128,
+    ):
+        self.prefix4 = prefix4
+        self.prefix6 = prefix6
         self.greylist_time = grey_time * 60  # minutes
         self.greylist_expire = grey_expire * 3600  # hours
         self.greylist_retain = grey_retain * 24 * 3600  # days
-        self.dbp = shelve.open(dbname, "c", protocol=2)
-        self.lock = Lock()
+        self.shards = shards
+        self.locks = [Lock() for i in range(shards)]
+        # the first shard, for compatibility
+        self.lock = self.locks[0]
+        # updates not yet written, by shard
+        self.dirty = [{} for i in range(shards)]
+        self.max_pending = max(1, max_pending // shards)
+        self.caches = [None] * shards
+        if cache_size > 0:
+            n = max(1, cache_size // shards)
+            self.caches = [HotCache(n, self.greylist_retain) for i in range(shards)]
+        self.cache_writeback = cache_writeback
+        self.flusher = None
+        if flush_interval > 0:
+            self.flusher = Flusher(self, flush_interval)
+            self.flusher.start()
+        # where clean_step stopped: shard and backend position
+        self.clean_lock = RLock()
+        self.clean_batch = clean_batch
+        self.clean_cursor = (0, None)
+        self.cleaner = None
+        if clean_rate > 0:
+            self.cleaner = Cleaner(self, clean_rate, clean_interval)
+            self.cleaner.start()
 
-    def export_csv(self, fp, timeinc=0):
-        "Export records to csv."
+    @property
+    def ignoreLastByte(self):
+        return self.prefix4 <= 24
 
-        dbp = self.dbp
-        w = csv.writer(fp)
-        now = time.time() + timeinc
-        for key, r in dbp.iteritems():
-            if now > r.lastseen + self.greylist_retain:
-                continue
-            ip, sender, recipient = key.rsplit(":", 2)
-            w.writerow([ip, sender, recipient, r.firstseen, r.lastseen, r.cnt, r.umis])
+    @ignoreLastByte.setter
+    def ignoreLastByte(self, ignore):
+        self.prefix4, self.prefix6 = ignore and (24, 64) or (32, 128)
 
-    def clean(self, timeinc=0):
-        "Delete records past the retention limit."
-        now = time.time() + timeinc
+    def network(self, ip):
+        "Return the network of an IP with the configured prefix length, as text."
+        if self.prefix4 >= 32 and self.prefix6 >= 128:
+            return ip
+        try:
+            n = addr2bin(ip)
+        except socket.error:
+            return ip
+        if ":" not in ip:
+            return socket.inet_ntoa(struct.pack("!L", cidr(n, self.prefix4)))
+        if n >> 32 == 0xFFFF:
+            # IPv4 mapped, or the IPv4 internet would be one /64
+            n = cidr(n & MASK, self.prefix4)
+            return "::ffff:" + socket.inet_ntoa(struct.pack("!L", n))
+        n = cidr(n, self.prefix6, MASK6)
+        return inet_ntop(struct.pack("!QQ", n >> 64, n & (MASK6 >> 64)))
+
+    def _key(self, ip, sender, recipient):
+        "Return the database key for a triple."
+        return (ip, sender, recipient)
+
+    def _shard(self, ip, sender, recipient):
+        return shard_index(ip + ":" + sender + ":" + recipient, self.shards)
+
+    def _load(self, i, key):
+        "Return the record for key from shard i, or None."
+        raise NotImplementedError
+
+    def _write(self, i, records):
+        "Write (key, record) pairs to shard i, and sync or commit."
+        raise NotImplementedError
+
+    def _rollback(self, i):
+        "Undo a partial update of shard i after an error."
+        pass
+
+    def records(self):
+        """Yield (ip, sender, recipient, firstseen, lastseen, cnt, umis)
+        for every record."""
+        raise NotImplementedError
+
+    def import_records(self, records, batch=1000):
+        """Write records as yielded by records(), for instance those of
+        another greylist to migrate to this one.  Returns the number written."""
+        pending = [[] for i in range(self.shards)]
         cnt = 0
-        dbp = self.dbp
-        for key, r in dbp.iteritems():
-            # print(key,r,time.ctime(now))
-            if now > r.lastseen + self.greylist_retain:
-                self.lock.acquire()
-                try:
-                    r = dbp[key]
-                    now = time.time() + timeinc
-                    if now > r.lastseen + self.greylist_retain:
-                        del dbp[key]
-                        cnt += 1
-                finally:
-                    self.lock.release()
+        for ip, sender, recipient, firstseen, lastseen, n, umis in records:
+            i = self._shard(ip, sender, recipient)
+            key = self._key(ip, sender, recipient)
+            pending[i].append((key, (firstseen, lastseen, n, umis)))
+            if len(pending[i]) >= batch:
+                with self.locks[i]:
+                    self._write(i, pending[i])
+                pending[i] = []
+            cnt += 1
+        for i, p in enumerate(pending):
+            if p:
+                with self.locks[i]:
+                    self._write(i, p)
         return cnt
 
+    def _clean_start(self, i):
+        """Return the backend position to start cleaning shard i from.
+        The shard lock is not held, so this may scan the shard."""
+        return None
+
+    def _clean(self, i, pos, batch, before):
+        """Delete records of shard i last seen before a time, examining
+        about batch records starting at backend position pos, as returned
+        by _clean_start or the last call.  The shard lock is held.
+        Returns the number deleted and the position to resume from,
+        or None when the shard is done."""
+        raise NotImplementedError
+
+    def _store(self, i, key, r):
+        "Write or queue a record.  The shard lock must be held."
+        if self.flusher:
+            dirty = self.dirty[i]
+            dirty[key] = r
+            if len(dirty) >= self.max_pending:
+                self._flush(i)
+        else:
+            self._write(i, [(key, r)])
+
+    def _flush(self, i):
+        "Write queued records for a shard.  The shard lock must be held."
+        cache = self.caches[i]
+        if cache is not None:
+            dirty = self.dirty[i]
+            for key, e in cache.unwritten():
+                dirty[key] = tuple(e[:4])
+        dirty = self.dirty[i]
+        if dirty:
+            self._write(i, list(dirty.items()))
+            dirty.clear()
+
+    def flush(self):
+        "Write queued records."
+        for i, lock in enumerate(self.locks):
+            with lock:
+                self._flush(i)
+
+    def cache_stats(self):
+        "Return a dictionary of hot cache statistics."
+        hits = sum(c.hits for c in self.caches if c)
+        misses = sum(c.misses for c in self.caches if c)
+        size = sum(len(c.entries) for c in self.caches if c)
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "size": size,
+            "hit_rate": total and float(hits) / total,
+        }
+
     def check(self, ip, sender, recipient, timeinc=0):
         "Return number of allowed messages for greylist triple."
-        sender = quoteAddress(sender)
-        recipient = quoteAddress(recipient)
-        key = ip + ":" + sender + ":" + recipient
-        self.lock.acquire()
+        ip = self.network(ip)
+        key = self._key(ip, sender, recipient)
+        i = self._shard(ip, sender, recipient)
+        lock = self.locks[i]
+        lock.acquire()
         try:
-            dbp = self.dbp
-            try:
-                r = dbp[key]
-                now = time.time() + timeinc
-                if now > r.lastseen + self.greylist_retain:
-                    # expired
-                    log.debug(f"Expired greylist: {key}")
-                    r = Record(timeinc)
-                elif now < r.firstseen + self.greylist_time + 5:
-                    # still greylisted
-                    log.debug(f"Early greylist: {key}")
-                    # r = Record(timeinc)
-                    r.lastseen = now
-                elif r.cnt or now < r.firstseen + self.greylist_expire:
-                    # in greylist window or active
-                    r.lastseen = now
-                    r.cnt += 1
-                    log.debug(f"Active greylist({r.cnt}): {key}")
-                else:
-                    # passed greylist window
-                    log.debug(f"Late greylist: {key}")
-                    r = Record(timeinc)
-                dbp[key] = r
-            except:
-                r = Record(timeinc)
-                dbp[key] = r
-            dbp.sync()
+            now = time.time() + timeinc
+            cache = self.caches[i]
+            if cache is not None:
+                e = cache.lookup(key, now)
+                if e is not None:
+                    # active triple, write lastseen lazily
+                    if e[1] > e[4] + self.cache_writeback:
+                        e[4] = e[1]
+                        self._store(i, key, tuple(e[:4]))
+                    return e[2]
+            r = self.dirty[i].get(key) or self._load(i, key)
+            if not r:
+                r = (now, now, 0, None)
+            elif now > r[1] + self.greylist_retain:
+                # expired
+                log.debug("Expired greylist: %s:%s:%s", ip, sender, recipient)
+                r = (now, now, 0, None)
+            elif now < r[0] + self.greylist_time + 5:
+                # still greylisted
+                log.debug("Early greylist: %s:%s:%s", ip, sender, recipient)
+                r = (r[0], now, r[2], r[3])
+            elif r[2] or now < r[0] + self.greylist_expire:
+                # in greylist window or active
+                r = (r[0], now, r[2] + 1, r[3])
+                log.debug("Active greylist(%d): %s:%s:%s", r[2], ip, sender, recipient)
+            else:
+                # passed greylist window
+                log.debug("Late greylist: %s:%s:%s", ip, sender, recipient)
+                r = (now, now, 0, None)
+            self._store(i, key, r)
+            if r[2] and cache is not None:
+                for k, e in cache.add(key, r):
+                    self._store(i, k, tuple(e[:4]))
+        except:
+            self._rollback(i)
+            raise
         finally:
-            self.lock.release()
-        return r.cnt
+            lock.release()
+        return r[2]
+
+    def clean_step(self, batch=None, timeinc=0):
+        """Delete a batch of records past the retention limit, continuing
+        from where the last step stopped.  Returns the number deleted, and
+        whether the step finished a pass over all shards."""
+        with self.clean_lock:
+            i, pos = self.clean_cursor
+            before = time.time() + timeinc - self.greylist_retain
+            if pos is None:
+                with self.locks[i]:
+                    # write lastseen of queued and cached triples first
+                    self._flush(i)
+                # without the shard lock, so checks are not held up
+                pos = self._clean_start(i)
+            with self.locks[i]:
+                cnt, pos = self._clean(i, pos, batch or self.clean_batch, before)
+            done = False
+            if pos is None:
+                i += 1
+                if i >= self.shards:
+                    i, done = 0, True
+            self.clean_cursor = (i, pos)
+            return cnt, done
+
+    def clean(self, timeinc=0):
+        "Delete records past the retention limit.  Returns the number deleted."
+        cnt = 0
+        with self.clean_lock:
+            # a full pass, not the rest of one in progress
+            self.clean_cursor = (0, None)
+            done = False
+            while not done:
+                n, done = self.clean_step(timeinc=timeinc)
+                cnt += n
+        return cnt
 
     def close(self):
-        self.dbp.close()
+        if self.cleaner:
+            self.cleaner.stop()
+            self.cleaner = None
+        if self.flusher:
+            self.flusher.stop()
+            self.flusher = None
+        self.flush()
 
 
-if __name__ == "__main__":
+class Greylist(BaseGreylist):
+    "Greylist triples in shelve databases.  See BaseGreylist for options."
+
+    def __init__(self, dbname, grey_time=10, grey_expire=4, grey_retain=36, **kw):
+        shards = kw.get("shards", 1)
+        names = shard_names(dbname, shards)
+        self.dbs = [shelve.open(n, "c", protocol=2) for n in names]
+        # the first shard, for compatibility
+        self.dbp = self.dbs[0]
+        BaseGreylist.__init__(self, grey_time, grey_expire, grey_retain, **kw)
+
+    def _key(self, ip, sender, recipient):
+        return ip + ":" + quoteAddress(sender) + ":" + quoteAddress(recipient)
+
+    def _load(self, i, key):
+        try:
+            r = self.dbs[i][key]
+        except:
+            # missing or unreadable
+            return None
+        return (r.firstseen, r.lastseen, r.cnt, r.umis)
+
+    def _write(self, i, records):
+        dbp = self.dbs[i]
+        for key, (firstseen, lastseen, cnt, umis) in records:
+            r = Record()
+            r.firstseen = firstseen
+            r.lastseen = lastseen
+            r.cnt = cnt
+            r.umis = umis
+            dbp[key] = r
+        self._sync(i)
+
+    def _sync(self, i):
+        db = self.dbs[i]
+        # not all dbm modules have sync
+        if hasattr(db, "sync"):
+            db.sync()
+
+    def _keys(self, i):
+        "Iterate over the keys of shard i, without reading them all if dbm can."
+        db = self.dbs[i]
+        # the dbm under a shelf
+        d = getattr(db, "dict", db)
+        if not hasattr(d, "firstkey"):
+            for key in db.keys():
+                yield key
+            return
+        key = d.firstkey()
+        while key is not None:
+            if d is db:
+                yield key
+            else:
+                yield key.decode(db.keyencoding)
+            key = d.nextkey(key)
+
+    def records(self):
+        self.flush()
+        for i in range(self.shards):
+            for key in self._keys(i):
+                r = self._load(i, key)
+                if r is not None:
+                    ip, sender, recipient = key.rsplit(":", 2)
+                    yield (ip, unquote(sender), unquote(recipient)) + r
+
+    def export_csv(self, fp, timeinc=0):
+        "Export records to csv."
+        now = time.time() + timeinc - self.greylist_retain
+        write_csv(fp, (r for r in self.records() if r[4] >= now))
+
+    def _clean_start(self, i):
+        # dbm has no cursor that survives deletes, so walk a snapshot
+        return iter(list(self.dbs[i].keys()))
+
+    def _clean(self, i, pos, batch, before):
+        dbp = self.dbs[i]
+        cnt = n = 0
+        for key in pos:
+            r = self._load(i, key)
+            if r is None:
+                continue
+            if r[1] < before:
+                del dbp[key]
+                cnt += 1
+            n += 1
+            if n >= batch:
+                break
+        else:
+            pos = None
+        if cnt:
+            self._sync(i)
+        return cnt, pos
+
+    def close(self):
+        BaseGreylist.close(self)
+        for dbp in self.dbs:
+            dbp.close()
+
+
+class BinaryGreylist(Greylist):
+    """Greylist triples in dbm databases with compact keys and records.
+    Keys are the IP packed into 4 or 16 bytes, followed by 8 byte hashes
+    of the sender and recipient.  Records are packed with RECORD instead
+    of pickled.  Addresses cannot be recovered from their hashes,
+    so records() yields them as hex digests.
+
+    To migrate an existing greylist, pass its records() to
+    import_records()."""
+
+    def __init__(self, dbname, grey_time=10, grey_expire=4, grey_retain=36, **kw):
+        names = shard_names(dbname, kw.get("shards", 1))
+        self.dbs = [dbm.open(n, "c") for n in names]
+        self.dbp = self.dbs[0]
+        BaseGreylist.__init__(self, grey_time, grey_expire, grey_retain, **kw)
+
+    def _key(self, ip, sender, recipient):
+        return pack_ip(ip) + hash_address(sender) + hash_address(recipient)
+
+    def _load(self, i, key):
+        try:
+            return unpack_record(self.dbs[i][key])
+        except KeyError:
+            return None
+
+    def _write(self, i, records):
+        db = self.dbs[i]
+        for key, r in records:
+            db[key] = pack_record(r)
+        self._sync(i)
+
+    def records(self):
+        self.flush()
+        for i in range(self.shards):
+            for key in self._keys(i):
+                r = self._load(i, key)
+                if r is not None:
+                    sender = hexlify(key[-16:-8]).decode()
+                    recipient = hexlify(key[-8:]).decode()
+                    yield (unpack_ip(key[:-16]), sender, recipient) + r
+
+
+BACKENDS = ("shelve", "binary", "sqlite")
+
+
+def open_greylist(backend, dbname, **kw):
+    "Open a greylist with a backend from BACKENDS."
+    if backend == "sqlite":
+        from Milter import greysql
+
+        return greysql.Greylist(dbname, **kw)
+    return {"shelve": Greylist, "binary": BinaryGreylist}[backend](dbname, **kw)
+
+
+def main(argv):
+    """Export or import greylist records, streaming in constant memory.
+    Binary greylists export hashes instead of addresses, which cannot
+    be imported into another binary greylist."""
+    import argparse
     import sys
 
-    g = Greylist(sys.argv[1], 5, 24, 36)
+    if argv and argv[0] not in ("export", "import", "-h", "--help"):
+        # python -m Milter.greylist dbname exports csv, as it always has
+        argv = ["export"] + argv
+    p = argparse.ArgumentParser(
+        "python -m Milter.greylist",
+        description=main.__doc__,
+        epilog="An import into sqlite locks the databases until it is done.  "
+        "Checks by running milters fail after sqlite's 5 second busy timeout.",
+    )
+    p.add_argument("command", choices=("export", "import"))
+    p.add_argument("dbname")
+    p.add_argument("file", nargs="?", help="default stdout or stdin")
+    p.add_argument("-b", "--backend", choices=BACKENDS, default="shelve")
+    p.add_argument("-f", "--format", choices=("csv", "dump"), default="csv")
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--retain", type=int, default=36, help="days, for export")
+    p.add_argument("--batch", type=int, default=10000, help="records per write")
+    opts = p.parse_args(argv)
+    binary = opts.format == "dump"
+    mode = opts.command == "export" and "w" or "r"
+    if opts.file:
+        fp = binary and open(opts.file, mode + "b") or open(opts.file, mode, newline="")
+    else:
+        fp = mode == "w" and sys.stdout or sys.stdin
+        if binary:
+            fp = fp.buffer
+    g = open_greylist(
+        opts.backend, opts.dbname, grey_retain=opts.retain, shards=opts.shards
+    )
     try:
-        g.export_csv(sys.stdout)
+        if mode == "w":
+            now = time.time() - g.greylist_retain
+            records = progress((r for r in g.records() if r[4] >= now), sys.stderr)
+            if binary:
+                write_dump(fp, records)
+            else:
+                write_csv(fp, records)
+        else:
+            records = binary and read_dump(fp) or read_csv(fp)
+            g.import_records(progress(records, sys.stderr), batch=opts.batch)
     finally:
         g.close()
+        if opts.file:
+            fp.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -1,122 +1,242 @@
 import time
 import logging
 import sqlite3
-from threading import Lock
+from threading import Event
+
+from Milter.greylist import BaseGreylist, read_csv, shard_names
 
 log = logging.getLogger("milter.greylist")
 
-_db_lock = Lock()
 
+INSERT = """insert or replace into
+  greylist(ip,sender,recipient,firstseen,lastseen,cnt,umis)
+  values(?,?,?,?,?,?,?)"""
 
-class Greylist(object):
-    def __init__(self, dbname, grey_time=10, grey_expire=4, grey_retain=36):
-        self.ignoreLastByte = False
-        self.greylist_time = grey_time * 60  # minutes
-        self.greylist_expire = grey_expire * 3600  # hours
-        self.greylist_retain = grey_retain * 24 * 3600  # days
-        self.conn = sqlite3.connect(dbname)
-        self.conn.row_factory = sqlite3.Row
-        try:
-            self.conn.execute(
-                """create table greylist(
+# The greylist state machine of BaseGreylist.check in one statement.
+# All expressions in the update see the old row.
+UPSERT = """insert into
+  greylist(ip,sender,recipient,firstseen,lastseen,cnt,umis)
+  values(:ip,:sender,:recipient,:now,:now,0,null)
+  on conflict(ip,sender,recipient) do update set
+    firstseen = case
+      when :now > lastseen + :retain then :now
+      when :now < firstseen + :time then firstseen
+      when cnt > 0 or :now < firstseen + :expire then firstseen
+      else :now end,
+    cnt = case
+      when :now > lastseen + :retain then 0
+      when :now < firstseen + :time then cnt
+      when cnt > 0 or :now < firstseen + :expire then cnt + 1
+      else 0 end,
+    umis = case
+      when :now > lastseen + :retain then null
+      when :now < firstseen + :time then umis
+      when cnt > 0 or :now < firstseen + :expire then umis
+      else null end,
+    lastseen = :now
+  returning cnt"""
+
+# RETURNING is new in sqlite 3.35
+HAVE_UPSERT = sqlite3.sqlite_version_info >= (3, 35)
+
+
+class Greylist(BaseGreylist):
+    """Greylist triples in sqlite databases.  See BaseGreylist for options.
+    Each shard has its own connection for writes by BaseGreylist.
+
+    Databases use write-ahead logging, so that readers do not wait for
+    writers.  Without a hot cache or write-behind, check() is a single
+    upsert statement on a connection from a pool for the shard,
+    and does not hold the shard lock.  At most pool_size idle
+    connections per shard are kept."""
+
+    def __init__(
+        self, dbname, grey_time=10, grey_expire=4, grey_retain=36, pool_size=8, **kw
+    ):
+        self.names = shard_names(dbname, kw.get("shards", 1))
+        self.conns = []
+        for name in self.names:
+            # each connection is used by one thread at a time, under its lock
+            conn = sqlite3.connect(name, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            try:
+                conn.execute(
+                    """create table greylist(
         ip text , sender text, recipient text,
         firstseen timestamp, lastseen timestamp, cnt integer, umis text,
         primary key (ip,sender,recipient))"""
+                )
+            except:
+                pass
+            conn.execute("pragma journal_mode=wal")
+            # for clean, also added to existing databases
+            conn.execute(
+                "create index if not exists greylist_lastseen on greylist(lastseen)"
             )
+            self.conns.append(conn)
+        # the first shard, for compatibility
+        self.conn = self.conns[0]
+        BaseGreylist.__init__(self, grey_time, grey_expire, grey_retain, **kw)
+        self.pool_size = pool_size
+        self.pools = [[] for name in self.names]
+        self.upsert = HAVE_UPSERT and not self.flusher and self.caches[0] is None
+        # cleared during import_records, which upsert checks wait for
+        self.idle = Event()
+        self.idle.set()
+
+    def check(self, ip, sender, recipient, timeinc=0):
+        "Return number of allowed messages for greylist triple."
+        if not self.upsert:
+            return BaseGreylist.check(self, ip, sender, recipient, timeinc)
+        if not self.idle.is_set():
+            self.idle.wait()
+        ip = self.network(ip)
+        i = self._shard(ip, sender, recipient)
+        pool = self.pools[i]
+        try:
+            conn = pool.pop()
+        except IndexError:
+            # autocommit, so that the statement is its own transaction
+            conn = sqlite3.connect(
+                self.names[i], isolation_level=None, check_same_thread=False
+            )
+        try:
+            # sqlite3 keeps the statement prepared for the connection
+            (cnt,) = conn.execute(
+                UPSERT,
+                {
+                    "ip": ip,
+                    "sender": sender,
+                    "recipient": recipient,
+                    "now": time.time() + timeinc,
+                    "time": self.greylist_time + 5,
+                    "expire": self.greylist_expire,
+                    "retain": self.greylist_retain,
+                },
+            ).fetchall()[0]
         except:
-            pass
+            conn.close()
+            raise
+        if len(pool) < self.pool_size:
+            pool.append(conn)
+        else:
+            conn.close()
+        log.debug("greylist(%d): %s:%s:%s", cnt, ip, sender, recipient)
+        return cnt
 
-    def import_csv(self, fp):
-        import csv
+    def _load(self, i, key):
+        conn = self.conns[i]
+        if not self.flusher and not conn.in_transaction:
+            # keep other processes out until the update is committed
+            conn.execute("begin immediate")
+        return conn.execute(
+            """select firstseen,lastseen,cnt,umis from greylist where
+        ip=? and sender=? and recipient=?""",
+            key,
+        ).fetchone()
 
-        rdr = csv.reader(fp)
-        cur = self.conn.execute("begin immediate")
+    def _write(self, i, records):
+        conn = self.conns[i]
+        if not conn.in_transaction:
+            conn.execute("begin immediate")
         try:
-            for r in rdr:
-                cur.execute(
-                    """insert into 
-          greylist(ip,sender,recipient,firstseen,lastseen,cnt,umis)
-          values(?,?,?,?,?,?,?)""",
-                    r,
-                )
-            self.conn.commit()
-        finally:
-            cur.close()
+            conn.executemany(INSERT, [k + tuple(r) for k, r in records])
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+    def _rollback(self, i):
+        conn = self.conns[i]
+        if conn.in_transaction:
+            conn.rollback()
+
+    def records(self):
+        self.flush()
+        for conn in self.conns:
+            for r in conn.execute(
+                """select ip,sender,recipient,firstseen,lastseen,cnt,umis
+            from greylist"""
+            ):
+                yield tuple(r)
 
-    def clean(self, timeinc=0):
-        "Delete records past the retention limit."
-        now = time.time() + timeinc - self.greylist_retain
-        cur = self.conn.cursor()
+    def import_records(self, records, batch=10000):
+        """Write records with one transaction per shard, and synchronous off.
+        Checks in this process wait until the import is done.  Checks by
+        other processes wait for sqlite's busy timeout, 5 seconds by default,
+        and then fail with "database is locked".  A crash during the import
+        can leave the databases corrupt."""
+        sync = [conn.execute("pragma synchronous").fetchone()[0] for conn in self.conns]
+        pending = [[] for conn in self.conns]
+        cnt = 0
+        # keep checks in this process out of the transactions
+        self.idle.clear()
+        for lock in self.locks:
+            lock.acquire()
         try:
-            cur.execute("delete from greylist where lastseen < ?", (now,))
-            cnt = cur.rowcount
-            self.conn.commit()
+            for conn in self.conns:
+                conn.execute("pragma synchronous=off")
+                if not conn.in_transaction:
+                    conn.execute("begin immediate")
+            for r in records:
+                i = self._shard(*r[:3])
+                pending[i].append(r)
+                if len(pending[i]) >= batch:
+                    self.conns[i].executemany(INSERT, pending[i])
+                    pending[i] = []
+                cnt += 1
+            for conn, p in zip(self.conns, pending):
+                conn.executemany(INSERT, p)
+                conn.commit()
+        except:
+            for conn in self.conns:
+                conn.rollback()
+            raise
         finally:
-            cur.close()
+            for conn, n in zip(self.conns, sync):
+                conn.execute("pragma synchronous=%d" % n)
+            for lock in self.locks:
+                lock.release()
+            self.idle.set()
         return cnt
 
-    def check(self, ip, sender, recipient, timeinc=0):
-        "Return number of allowed messages for greylist triple."
-        _db_lock.acquire()
-        cur = self.conn.execute("begin immediate")
+    def import_csv(self, fp):
+        "Import records from csv."
+        return self.import_records(read_csv(fp))
+
+    def _clean(self, i, pos, batch, before):
+        conn = self.conns[i]
+        # the oldest first, by the lastseen index
+        rows = conn.execute(
+            """select rowid,lastseen from greylist where
+        lastseen >= ? and lastseen < ? order by lastseen limit ?""",
+            (pos or 0, before, batch),
+        ).fetchall()
+        if not rows:
+            return 0, None
+        if not conn.in_transaction:
+            conn.execute("begin immediate")
         try:
-            cur.execute(
-                """select firstseen,lastseen,cnt,umis from greylist where
-        ip=? and sender=? and recipient=?""",
-                (ip, sender, recipient),
-            )
-            r = cur.fetchone()
-            now = time.time() + timeinc
-            cnt = 0
-            if not r:
-                cur.execute(
-                    """insert into 
-          greylist(ip,sender,recipient,firstseen,lastseen,cnt,umis)
-          values(?,?,?,?,?,?,?)""",
-                    (ip, sender, recipient, now, now, 0, None),
-                )
-            elif now > r["lastseen"] + self.greylist_retain:
-                # expired
-                log.debug("Expired greylist: %s:%s:%s", ip, sender, recipient)
-                cur.execute(
-                    """update greylist set firstseen=?,lastseen=?,cnt=?,umis=?
-          where ip=? and sender=? and recipient=?""",
-                    (now, now, 0, None, ip, sender, recipient),
-                )
-            elif now < r["firstseen"] + self.greylist_time + 5:
-                # still greylisted
-                log.debug("Early greylist: %s:%s:%s", ip, sender, recipient)
-                # r = Record()
-                cur.execute(
-                    """update greylist set lastseen=?
-          where ip=? and sender=? and recipient=?""",
-                    (now, ip, sender, recipient),
-                )
-            elif r["cnt"] or now < r["firstseen"] + self.greylist_expire:
-                # in greylist window or active
-                cnt = r["cnt"] + 1
-                cur.execute(
-                    """update greylist set lastseen=?,cnt=?
-          where ip=? and sender=? and recipient=?""",
-                    (now, cnt, ip, sender, recipient),
-                )
-                log.debug("Active greylist(%d): %s:%s:%s", cnt, ip, sender, recipient)
-            else:
-                # passed greylist window
-                log.debug("Late greylist: %s:%s:%s", ip, sender, recipient)
-                cur.execute(
-                    """update greylist set firstseen=?,lastseen=?,cnt=?,umis=?
-          where ip=? and sender=? and recipient=?""",
-                    (now, now, 0, None, ip, sender, recipient),
-                )
-            self.conn.commit()
-        finally:
-            cur.close()
-            _db_lock.release()
-        return cnt
+            # a check may have seen the triple since the select
+            cnt = conn.executemany(
+                "delete from greylist where rowid=? and lastseen < ?",
+                [(r[0], before) for r in rows],
+            ).rowcount
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        if len(rows) < batch:
+            return cnt, None
+        return cnt, rows[-1][1]
 
     def close(self):
-        self.conn.close()
+        BaseGreylist.close(self)
+        for pool in self.pools:
+            while pool:
+                pool.pop().close()
+        for conn in self.conns:
+            conn.close()
 
 
 if __name__ == "__main__":
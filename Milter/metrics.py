@@ -0,0 +1,154 @@
+## @package Milter.metrics
+# Serve %milter statistics in OpenMetrics text format.
+#
+# Milter.runmilter() starts this in a background thread when
+# passed a <code>metrics</code> socket name:
+# <pre>
+# Milter.runmilter("pythonfilter", socketname, 240,
+#     metrics="inet:9100@127.0.0.1")
+# </pre>
+# Any HTTP GET is answered with the current Milter.stats() for
+# this process: connection counts, active contexts, per callback
+# latency histograms, and reply code counts.
+# @since 1.0.6
+
+import os
+import threading
+from socket import AF_INET6, AF_UNIX
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import Milter
+from Milter.asyncserver import parse_socketname
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _float(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v))
+
+
+## Format statistics in OpenMetrics text format.
+# @param stats a dictionary as returned by Milter.stats()
+# @param prefix prepended to each metric family name
+# @return the exposition text, ending with the <code># EOF</code> marker
+def format_metrics(stats, prefix="milter"):
+    out = []
+
+    def family(name, kind, help):
+        out.append("# TYPE %s_%s %s" % (prefix, name, kind))
+        out.append("# HELP %s_%s %s" % (prefix, name, help))
+
+    def sample(name, value, **labels):
+        if labels:
+            lbl = ",".join('%s="%s"' % kv for kv in sorted(labels.items()))
+            out.append("%s_%s{%s} %s" % (prefix, name, lbl, value))
+        else:
+            out.append("%s_%s %s" % (prefix, name, value))
+
+    ctx = stats["contexts"]
+    family("connections", "counter", "Connection contexts created.")
+    sample("connections_total", ctx["created"])
+    family("active_contexts", "gauge", "Connection contexts not yet deleted.")
+    sample("active_contexts", ctx["active"])
+    family("thread_states", "counter", "Python thread state cache lookups.")
+    for result, n in sorted(stats["thread_states"].items()):
+        sample("thread_states_total", n, result=result)
+
+    callbacks = sorted(stats["callbacks"].items())
+    buckets = [_float(b) for b in stats["buckets"]]
+    family("callback_seconds", "histogram", "Time spent in python callbacks.")
+    for name, cb in callbacks:
+        total = 0
+        for le, n in zip(buckets, cb["histogram"]):
+            total += n
+            sample("callback_seconds_bucket", total, callback=name, le=le)
+        sample("callback_seconds_count", cb["calls"], callback=name)
+        sample("callback_seconds_sum", _float(cb["time"]), callback=name)
+    family(
+        "callback_gil_wait_seconds", "counter", "Time callbacks waited for the GIL."
+    )
+    for name, cb in callbacks:
+        sample("callback_gil_wait_seconds_total", _float(cb["gil_wait"]), callback=name)
+    family("callback_errors", "counter", "Untrapped exceptions in callbacks.")
+    for name, cb in callbacks:
+        sample("callback_errors_total", cb["errors"], callback=name)
+    family("replies", "counter", "Callback return codes.")
+    for name, cb in callbacks:
+        for reply, n in sorted(cb["replies"].items()):
+            sample("replies_total", n, callback=name, reply=reply)
+    out.append("# EOF")
+    return "\n".join(out) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = format_metrics(self.server.stats()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ## Don't log scrapes.
+    def log_message(self, format, *args):
+        pass
+
+
+## An HTTP server for the metrics endpoint.
+class MetricsServer(HTTPServer):
+    ## Listen on a socket name.
+    # @param socketname unix:path, inet:port[@host], or inet6:port[@host]
+    # @param stats function returning a dictionary like Milter.stats()
+    def __init__(self, socketname, stats=Milter.stats):
+        family, addr = parse_socketname(socketname)
+        self.address_family = family
+        self.stats = stats
+        if family == AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+        HTTPServer.__init__(self, addr, MetricsHandler)
+
+    def server_bind(self):
+        if self.address_family == AF_UNIX:
+            self.socket.bind(self.server_address)
+            self.server_name = self.server_address
+            self.server_port = 0
+        else:
+            HTTPServer.server_bind(self)
+
+    ## The peer of a unix socket has no address to log.
+    def get_request(self):
+        conn, addr = self.socket.accept()
+        return conn, addr or ("local", 0)
+
+
+## Socket name for a worker process.
+# Each worker process has its own statistics, so each worker
+# listens on the next port, or for unix sockets, on a path
+# ending with the worker number.
+# @param socketname the metrics socket name for the first worker
+# @param worker the worker number, counting from 0
+def worker_socketname(socketname, worker):
+    family, addr = parse_socketname(socketname)
+    if family == AF_UNIX:
+        return "%s.%d" % (addr, worker)
+    host, port = addr
+    proto = "inet6" if family == AF_INET6 else "inet"
+    return "%s:%d@[%s]" % (proto, port + worker, host)
+
+
+## Start the metrics endpoint in a daemon thread.
+# @param socketname unix:path, inet:port[@host], or inet6:port[@host]
+# @param stats function returning a dictionary like Milter.stats()
+# @return the MetricsServer, call shutdown() to stop it
+def start(socketname, stats=Milter.stats):
+    server = MetricsServer(socketname, stats)
+    t = threading.Thread(target=server.serve_forever, name="milter-metrics")
+    t.daemon = True
+    t.start()
+    return server
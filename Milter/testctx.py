@@ -51,6 +51,8 @@ class TestCtx(object):
         self._opts = TestCtx.default_opts
         ## Last activity
         self._activity = time.time()
+        ## Methods set by Milter.Base._setctx
+        self._dispatch = None
 
     def getpriv(self):
         return self._priv
@@ -58,6 +60,23 @@ class TestCtx(object):
     def setpriv(self, priv):
         self._priv = priv
 
+    def setdispatch(self, methods):
+        self._dispatch = methods and tuple(methods)
+
+    ## The method the milter module calls for a callback.
+    def _method(self, name, default=None):
+        d = self._dispatch
+        if d:
+            return d[Milter.DISPATCH_CALLBACKS.index(name)]
+        return getattr(self._priv, default or name)
+
+    ## Wait for a future or coroutine returned by a callback, like
+    # the milter module.
+    def _wait(self, rc, name):
+        if isinstance(rc, int):
+            return rc
+        return Milter.wait_result(rc, name, self.progress if name == "eom" else None)
+
     def getsymval(self, name):
         stage = self._stage
         if stage >= 0:
@@ -144,7 +163,7 @@ class TestCtx(object):
 
     def _abort(self):
         "What Milter sets for abort_callback"
-        self._priv.abort()
+        self._method("abort")()
         self._close()
 
     def _close(self):
@@ -154,6 +173,7 @@ class TestCtx(object):
         self._body = None
         self._bodyreplaced = False
         self._priv = None
+        self._dispatch = None
         self._opts = TestCtx.default_opts
         self._stage = -1
         rc = Milter.negotiate_callback(self, self._opts)
@@ -188,7 +208,7 @@ class TestCtx(object):
         if self._protocol & Milter.P_NOHELO:
             return Milter.CONTINUE
         self._stage = Milter.M_HELO
-        rc = self._priv.hello(helo)
+        rc = self._wait(self._priv.hello(helo), "helo")
         self._stage = None
         if rc != Milter.CONTINUE:
             self._close()
@@ -199,7 +219,7 @@ class TestCtx(object):
         if self._protocol & Milter.P_NOMAIL:
             return Milter.CONTINUE
         self._stage = Milter.M_ENVFROM
-        rc = self._priv.envfrom(*s)
+        rc = self._wait(self._priv.envfrom(*s), "envfrom")
         self._stage = None
         return rc
 
@@ -207,7 +227,7 @@ class TestCtx(object):
         if self._protocol & Milter.P_NORCPT:
             return Milter.CONTINUE
         self._stage = Milter.M_ENVRCPT
-        rc = self._priv.envrcpt(s)
+        rc = self._wait(self._priv.envrcpt(s), "envrcpt")
         self._stage = None
         return rc
 
@@ -215,7 +235,7 @@ class TestCtx(object):
         if self._protocol & Milter.P_NODATA:
             return Milter.CONTINUE
         self._stage = Milter.M_DATA
-        rc = self._priv.data()
+        rc = self._wait(self._priv.data(), "data")
         self._stage = None
         return rc
 
@@ -234,33 +254,56 @@ class TestCtx(object):
                 v += b
         else:
             v = val.encode(encoding="ascii", errors="surrogateescape")
+        if getattr(self._priv, "_batch_headers", False):
+            # like the milter module, save headers for eoh
+            self._headers.append((fld, v))
+            return Milter.CONTINUE
         # invoke the Milter header_callback
-        return self._priv.header_bytes(fld, v)
+        return self._wait(self._method("header", "header_bytes")(fld, v), "header")
 
     def _eoh(self):
+        if getattr(self._priv, "_batch_headers", False):
+            hdrs, self._headers = self._headers, []
+            if VERSION < "3.0.0":
+                rc = self._priv.headers(hdrs)
+            else:
+                rc = self._method("headers", "headers_bytes")(hdrs)
+            rc = self._wait(rc, "headers")
+            if rc not in (Milter.CONTINUE, Milter.NOREPLY):
+                return rc
         if self._protocol & Milter.P_NOEOH:
             return Milter.CONTINUE
         self._stage = Milter.M_EOH
-        rc = self._priv.eoh()
+        rc = self._wait(self._method("eoh")(), "eoh")
         self._stage = None
         return rc
 
     def _feed_body(self, bfp):
         if self._protocol & Milter.P_NOBODY:
             return Milter.CONTINUE
+        strategy = getattr(self._priv.body, "error_strategy", None)
+        body = self._method("body")
         while True:
             buf = bfp.read(8192)
             if len(buf) == 0:
                 break
-            rc = self._priv.body(buf)
-            if rc != Milter.CONTINUE:
+            if strategy == "buffer":
+                # like libmilter, the chunk is only valid during the callback
+                chunk = Milter.milter.BodyChunk(buf)
+                try:
+                    rc = self._wait(body(chunk), "body")
+                finally:
+                    chunk.release()
+            else:
+                rc = self._wait(body(buf), "body")
+            if rc not in (Milter.CONTINUE, Milter.NOREPLY):
                 return rc
         return Milter.CONTINUE
 
     def _eom(self):
         self._body = BytesIO()
         self._stage = Milter.M_EOM
-        rc = self._priv.eom()
+        rc = self._wait(self._method("eom")(), "eom")
         self._stage = None
         return rc
 
@@ -274,6 +317,7 @@ class TestCtx(object):
         self._bodyreplaced = False
         self._headerschanged = False
         self._reply = None
+        self._headers = []
         msg = mime.message_from_file(fp)
         self._msg = msg
         # envfrom
@@ -292,7 +336,7 @@ class TestCtx(object):
         # header
         for h, val in msg.items():
             rc = self._header(h, val)
-            if rc != Milter.CONTINUE:
+            if rc not in (Milter.CONTINUE, Milter.NOREPLY):
                 return rc
         # eoh
         rc = self._eoh()
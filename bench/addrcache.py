@@ -0,0 +1,59 @@
+## @file addrcache.py
+# Wildcard domain lookups in Milter.cache.AddrCache.
+#
+# Compares AddrCache.match(), which walks a trie of domain labels, with
+# probing the cache dictionary for the address, the domain, and then
+# *.parent for every parent domain, as policies did before.
+# Senders have 2 to 6 labels in their domain, and a third of them
+# match a wildcard entry.
+#
+# Usage: python bench/addrcache.py [entries] [lookups]
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Milter.cache import AddrCache
+
+
+## Look up sender by probing every label suffix of its domain.
+def probe(cache, sender):
+    if cache.has_precise_key(sender):
+        return sender
+    host = sender.split("@", 1)[-1]
+    if host != sender and cache.has_precise_key(host):
+        return host
+    labels = host.split(".")
+    for i in range(1, len(labels) + 1):
+        key = ".".join(["*"] + labels[i:])
+        if cache.has_precise_key(key):
+            return key
+    return None
+
+
+def main(entries=100000, lookups=100000):
+    rnd = random.Random(1)
+    cache = AddrCache()
+    for i in range(entries):
+        cache["user%d@example%d.com" % (i, i)] = None
+        if i % 3 == 0:
+            cache["*.example%d.com" % i] = None
+        else:
+            cache["example%d.com" % i] = None
+    senders = []
+    for i in range(lookups):
+        n = rnd.randrange(entries * 2)
+        sub = ".".join("h%d" % j for j in range(rnd.randrange(5)))
+        host = (sub and sub + "." or "") + "example%d.com" % n
+        senders.append("someone@" + host)
+    assert [probe(cache, s) for s in senders] == [cache.match(s) for s in senders]
+    for name, f in (("probe", probe), ("trie", AddrCache.match)):
+        t = min(timeit.repeat(lambda: [f(cache, s) for s in senders], number=1))
+        print("%-6s %6.2f us/lookup" % (name, t / lookups * 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,108 @@
+## @file dispatch.py
+# Microbenchmark of python overhead per %milter callback.
+#
+# Compares the runmilter lambda trampolines with a per call
+# error_strategy lookup, as before 1.0.6, to calling the bound
+# methods from Milter.Base.dispatch_table() as the milter module now does.
+# The time spent in the milter module itself is not included.
+#
+# Usage: python bench/dispatch.py [count]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Milter
+
+
+class benchMilter(Milter.Base):
+    def envfrom(self, f, *s):
+        return Milter.CONTINUE
+
+    def envrcpt(self, to, *s):
+        return Milter.CONTINUE
+
+    def header(self, fld, val):
+        return Milter.CONTINUE
+
+    def eom(self):
+        return Milter.CONTINUE
+
+
+## The *_bytes methods as they were, looking up error_strategy on each call.
+class legacyMilter(benchMilter):
+    def envfrom_bytes(self, *b):
+        try:
+            e = getattr(self.envfrom, "error_strategy", "surrogateescape")
+            if e == "bytes":
+                return self.envfrom(*b)
+            s = [v.decode(encoding="utf-8", errors=e) for v in b]
+        except UnicodeDecodeError:
+            s = b
+        return self.envfrom(s[0], *s[1:])
+
+    def envrcpt_bytes(self, *b):
+        try:
+            e = getattr(self.envrcpt, "error_strategy", "surrogateescape")
+            if e == "bytes":
+                return self.envrcpt(*b)
+            s = [v.decode(encoding="utf-8", errors=e) for v in b]
+        except UnicodeDecodeError:
+            s = b
+        return self.envrcpt(s[0], *s[1:])
+
+    def header_bytes(self, fld, val):
+        try:
+            e = getattr(self.header, "error_strategy", "surrogateescape")
+            if e == "bytes":
+                return self.header(fld, val)
+            s = val.decode(encoding="utf-8", errors=e)
+        except UnicodeDecodeError:
+            s = val
+        return self.header(fld, s)
+
+
+## Stands in for milter.milterContext.
+class benchCtx(object):
+    def __init__(self):
+        self.priv = None
+
+    def getpriv(self):
+        return self.priv
+
+    def setpriv(self, priv):
+        self.priv = priv
+
+
+CALLS = (
+    ("envfrom", 2, (b"<spam@adv.com>", b"SIZE=1000")),
+    ("envrcpt", 3, (b"<victim@lamb.com>",)),
+    ("header", 4, ("Subject", b"Make money fast")),
+    ("eom", 7, ()),
+)
+
+
+def main(count=200000):
+    ctx = benchCtx()
+    legacyMilter()._setctx(ctx)
+    lambdas = {
+        "envfrom": lambda ctx, *b: ctx.getpriv().envfrom_bytes(*b),
+        "envrcpt": lambda ctx, *b: ctx.getpriv().envrcpt_bytes(*b),
+        "header": lambda ctx, f, v: ctx.getpriv().header_bytes(f, v),
+        "eom": lambda ctx: ctx.getpriv().eom(),
+    }
+    m = benchMilter()
+    m._setctx(benchCtx())
+    table = [n and getattr(m, n) for n in m.dispatch_table()]
+    print("%-8s %12s %12s" % ("callback", "lambda ns", "dispatch ns"))
+    for name, i, args in CALLS:
+        before = timeit.timeit(lambda: lambdas[name](ctx, *args), number=count)
+        f = table[i]
+        after = timeit.timeit(lambda: f(*args), number=count)
+        print("%-8s %12.0f %12.0f" % (name, before * 1e9 / count, after * 1e9 / count))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,64 @@
+## @file greylist.py
+# Greylist checks per second against thread count.
+#
+# Each thread checks its own distinct triples against a new
+# Milter.greylist (shelve) or Milter.greysql (sqlite) database in a
+# temporary directory, first unsharded, then split into shards.
+# With a flush interval in milliseconds, updates are written behind.
+#
+# Usage: python bench/greylist.py [shelve|sqlite] [shards] [checks] [flush ms]
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Milter import greylist, greysql
+
+BACKENDS = {"shelve": greylist.Greylist, "sqlite": greysql.Greylist}
+THREADS = (1, 2, 4, 8, 16)
+
+
+## Return checks per second for a number of threads.
+def run(backend, shards, threads, checks, flush=0):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbname = os.path.join(tmpdir, "grey.db")
+        grey = backend(dbname, shards=shards, flush_interval=flush / 1000.0)
+        n = checks // threads
+
+        def work(t):
+            for i in range(n):
+                ip = "10.%d.%d.%d" % (t, i >> 8 & 255, i & 255)
+                grey.check(ip, "foo@example.com", "user%d@example.org" % i)
+
+        tl = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+        start = time.time()
+        for t in tl:
+            t.start()
+        for t in tl:
+            t.join()
+        elapsed = time.time() - start
+        grey.close()
+        return n * threads / elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(name="sqlite", shards=8, checks=4000, flush=0):
+    backend = BACKENDS[name]
+    print("%s checks/sec" % name, "flush every %d ms" % flush if flush else "")
+    print("%-8s %12s %12s" % ("threads", "1 shard", "%d shards" % shards))
+    for threads in THREADS:
+        one = run(backend, 1, threads, checks, flush)
+        many = run(backend, shards, threads, checks, flush)
+        print("%-8d %12.0f %12.0f" % (threads, one, many))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*args[:1], *[int(a) for a in args[1:]])
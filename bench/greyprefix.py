@@ -0,0 +1,54 @@
+## @file greyprefix.py
+# Cost of keying greylist triples by network instead of exact IP.
+#
+# Times BaseGreylist.network() for IPv4 and IPv6 addresses with exact
+# keying and with /24 and /64 prefixes, then checks per second for
+# a Milter.greysql (sqlite) database with each.
+#
+# Usage: python bench/greyprefix.py [checks]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Milter import greylist, greysql
+
+KEYING = (("exact", 32, 128), ("/24 /64", 24, 64))
+IPS = (("IPv4", "192.0.2.77"), ("IPv6", "2001:db8:1:2:3:4:5:6"))
+
+
+def checks(prefix4, prefix6, n):
+    "Return checks per second, half IPv4 and half IPv6."
+    tmpdir = tempfile.mkdtemp()
+    try:
+        grey = greysql.Greylist(
+            os.path.join(tmpdir, "grey.db"), prefix4=prefix4, prefix6=prefix6
+        )
+        start = time.time()
+        for i in range(n // 2):
+            grey.check("10.1.%d.%d" % (i >> 8 & 255, i & 255), "a@b.com", "c@d.com")
+            grey.check("2001:db8::%x" % i, "a@b.com", "c@d.com")
+        elapsed = time.time() - start
+        grey.close()
+        return n / elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(n=4000):
+    for name, prefix4, prefix6 in KEYING:
+        grey = greylist.BaseGreylist(prefix4=prefix4, prefix6=prefix6)
+        for family, ip in IPS:
+            t = min(timeit.repeat(lambda: grey.network(ip), number=100000, repeat=3))
+            print("%-8s network(%s) %6.2f us" % (name, family, t * 10))
+    for name, prefix4, prefix6 in KEYING:
+        print("%-8s %8.0f checks/sec" % (name, checks(prefix4, prefix6, n)))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,148 @@
+## @file greyreplay.py
+# Replay a stream of greylist checks and report throughput and latency.
+#
+# Events are (ip, sender, recipient, timestamp), either read from a csv
+# file in that order, or generated with a skewed popularity so that
+# some triples retry and stay active, like real mail.  Each event is
+# checked with timeinc set to its time since the first event, so a day
+# of mail replays in seconds.  Events are divided between threads by
+# triple, so that the checks for a triple stay in order.
+#
+# Reports checks/sec and the p50, p99 and p999 latency of check() in
+# microseconds for each thread count.  Backends are those of
+# python -m Milter.greylist, or greyd to check with a running
+# Milter.greyd daemon at the --dbname socket.  Each thread count starts
+# with a new database, but a greyd daemon keeps its database between
+# runs, so for greyd the recipients of each run are tagged with its
+# thread count, to check triples the daemon has not seen.
+#
+# Usage: python bench/greyreplay.py [-b sqlite] [-t 1,4,16] [--events N]
+#       [--file events.csv] [--shards N] [--cache-size N] [--flush SECS]
+#       [--dbname greyd.sock]
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Milter import greyd, greylist
+
+
+## Generate events for a number of distinct triples over duration seconds.
+def synthetic(events, triples, duration=86400, seed=1):
+    rnd = random.Random(seed)
+    for i in range(events):
+        n = int(rnd.paretovariate(1.1)) * 7919 % triples
+        ip = "10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255)
+        sender = "s%d@example.com" % (n % 997)
+        yield (ip, sender, "r%d@example.org" % n, i * duration / events)
+
+
+## Read events from a csv file of ip, sender, recipient, timestamp.
+def recorded(fname):
+    with open(fname, newline="") as fp:
+        for ip, sender, recipient, ts in csv.reader(fp):
+            yield (ip, sender, recipient, float(ts))
+
+
+## Return the q quantile of sorted latencies.
+def percentile(lat, q):
+    return lat[min(len(lat) - 1, int(q * len(lat)))]
+
+
+## Replay events against a greylist with a number of threads.
+# Returns checks/sec and the sorted latencies in seconds.
+def replay(grey, events, threads):
+    t0 = events[0][3]
+    parts = [[] for i in range(threads)]
+    for e in events:
+        parts[greylist.shard_index("%s:%s:%s" % e[:3], threads)].append(e)
+    latencies = [[] for i in range(threads)]
+
+    def work(part, lat):
+        clock = time.perf_counter
+        check = grey.check
+        for ip, sender, recipient, ts in part:
+            start = clock()
+            check(ip, sender, recipient, ts - t0)
+            lat.append(clock() - start)
+
+    tl = [
+        threading.Thread(target=work, args=(p, l)) for p, l in zip(parts, latencies)
+    ]
+    start = time.time()
+    for t in tl:
+        t.start()
+    for t in tl:
+        t.join()
+    elapsed = time.time() - start
+    lat = sorted(x for l in latencies for x in l)
+    return len(lat) / elapsed, lat
+
+
+def main(argv):
+    p = argparse.ArgumentParser("greyreplay.py")
+    backends = greylist.BACKENDS + ("greyd",)
+    p.add_argument("-b", "--backend", choices=backends, default="sqlite")
+    p.add_argument("-t", "--threads", default="1,4,16")
+    p.add_argument("--events", type=int, default=20000)
+    p.add_argument("--triples", type=int, default=5000)
+    p.add_argument("--file", help="csv of ip,sender,recipient,timestamp")
+    p.add_argument("--dbname", help="greyd socket")
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--cache-size", type=int, default=0)
+    p.add_argument("--flush", type=float, default=0)
+    opts = p.parse_args(argv)
+    if opts.file:
+        events = list(recorded(opts.file))
+    else:
+        events = list(synthetic(opts.events, opts.triples))
+    if not events:
+        p.error("no events")
+    if opts.backend == "greyd" and not opts.dbname:
+        p.error("greyd needs --dbname")
+    print("%s: %d events" % (opts.backend, len(events)))
+    print("%-8s %10s %9s %9s %9s" % ("threads", "checks/s", "p50", "p99", "p999"))
+    for threads in [int(t) for t in opts.threads.split(",")]:
+        if opts.backend == "greyd":
+            grey = greyd.Client(opts.dbname, pool_size=threads)
+            tagged = [(i, s, "%d.%s" % (threads, r), ts) for i, s, r, ts in events]
+            try:
+                rate, lat = replay(grey, tagged, threads)
+            finally:
+                grey.close()
+        else:
+            tmpdir = tempfile.mkdtemp()
+            try:
+                grey = greylist.open_greylist(
+                    opts.backend,
+                    os.path.join(tmpdir, "grey.db"),
+                    shards=opts.shards,
+                    cache_size=opts.cache_size,
+                    flush_interval=opts.flush,
+                )
+                rate, lat = replay(grey, events, threads)
+                grey.close()
+            finally:
+                shutil.rmtree(tmpdir)
+        print(
+            "%-8d %10.0f %9.0f %9.0f %9.0f"
+            % (
+                threads,
+                rate,
+                percentile(lat, 0.5) * 1e6,
+                percentile(lat, 0.99) * 1e6,
+                percentile(lat, 0.999) * 1e6,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -101,6 +101,17 @@ class milterContext(object):
   def setpriv(self,priv): pass
   ## Return the Python object attached to this connection context.
   def getpriv(self): pass
+  ## Set callables to invoke directly for this connection.
+  # Each libmilter callback calls the corresponding callable, without
+  # the context argument, instead of the function registered with
+  # the set_*_callback functions.  Milter.Base._setctx() passes bound
+  # methods from Milter.Base.dispatch_table().
+  # @param methods a sequence with an item for each callback in the order
+  # connect, helo, envfrom, envrcpt, header, eoh, body, eom, abort, close,
+  # headers, unknown, data, negotiate.  An item of None calls the
+  # registered function.  None clears the table.
+  # @since 1.0.6
+  def setdispatch(self,methods): pass
   ## Calls <a href="milter_api/smfi_quarantine.html">smfi_quarantine</a>.
   def quarantine(self,reason): pass
   ## Calls <a href="milter_api/smfi_progress.html">smfi_progress</a>.
@@ -119,6 +130,23 @@ class milterContext(object):
 
 class error(Exception): pass
 
+## A read-only buffer over a body chunk.
+# Passed to the body callback when set_body_buffer() is enabled.  It
+# supports <code>len()</code>, indexing, and the buffer protocol, so
+# it can be passed to <code>bytes()</code>, <code>hashlib</code> or
+# <code>file.write()</code>.  Slicing returns a BodyChunk over the same
+# buffer without copying, and releasing the chunk passed to the
+# callback releases every slice of it.
+# @since 1.0.6
+class BodyChunk(object):
+  ## Wrap a bytes object, mainly for testing.
+  def __init__(self,data): pass
+  ## Return a copy of the chunk data as bytes.
+  def tobytes(self): pass
+  ## Release the chunk.  Using it afterwards raises ValueError.
+  # @throws BufferError while buffers are exported from the chunk
+  def release(self): pass
+
 ## Enable optional %milter actions.
 # Certain %milter actions need to be enabled before calling main()
 # or they throw an exception.  Pymilter enables them all by
@@ -133,10 +161,51 @@ def set_envfrom_callback(cb): pass
 def set_envrcpt_callback(cb): pass
 def set_header_callback(cb): pass
 def set_eoh_callback(cb): pass
+
+## Set the callback for all header fields at once.
+# When set, the %milter module saves each header field without
+# locking the interpreter or calling the header callback, and at
+# the end of the header calls <code>cb(ctx,headers)</code> with a list of
+# <code>(field,value)</code> tuples, followed by the eoh callback if
+# the result is CONTINUE.  Each header field is answered with NOREPLY
+# if P_NR_HDR was negotiated.  Milter.runmilter() sets this when
+# Milter.factory is decorated with @@Milter.batch_headers.
+# @param cb the callback, or None to call the header callback for each field
+# @since 1.0.6
+def set_headers_callback(cb): pass
 def set_body_callback(cb): pass
+
+## Pass body chunks to the body callback as a BodyChunk.
+# When enabled, the body callback receives each chunk as a read-only
+# BodyChunk over the libmilter buffer, avoiding a copy to a new bytes
+# object for each chunk.  The chunk is released when the
+# callback returns.  Milter.runmilter() enables this when the body
+# method of Milter.factory is decorated with
+# <code>@@Milter.decode('buffer')</code>, and it is off otherwise.
+#
+# libmilter reuses the buffer for the next chunk, so the callback must
+# not keep the chunk, or a slice of it.  Using a chunk or slice kept
+# past the callback raises ValueError.  A buffer still exported from
+# it, for example to a memoryview or numpy array, points at libmilter's
+# buffer and cannot be released, so the callback fails with
+# BufferError and the exception policy.
+# Copy with <code>bytes(chunk)</code> any data needed later.
+# @param flag true to pass a BodyChunk, false to pass bytes
+# @since 1.0.6
+def set_body_buffer(flag): pass
 def set_abort_callback(cb): pass
 def set_close_callback(cb): pass
 
+## Set the callback for callback results that are not int.
+# When a callback returns something else, such as a future or coroutine,
+# the %milter module calls <code>cb(ctx,result,name)</code> in the same
+# libmilter thread, with the name of the callback, and uses the int
+# it returns as the reply.  Milter.runmilter() sets this to wait for
+# futures and coroutines while sending progress notifications at eom.
+# @param cb the callback, or None to reject results that are not int
+# @since 1.0.6
+def set_future_callback(cb): pass
+
 ## Sets the return code for untrapped Python exceptions during a callback.
 # The default is TEMPFAIL.  You should not depend on this handler.  Your
 # application should have its own top level exception handler for each
@@ -232,10 +301,26 @@ def stop(): pass
 ## Retrieve diagnostic info.
 # Return a tuple with diagnostic info gathered by the milter module.
 # The first two fields are counts of milterContext objects created
-# and deleted.  Additional fields may be added later.
+# and deleted.  Python thread states are cached for each libmilter
+# thread, and the next two fields count new milterContext objects
+# that reused a cached thread state (hits) and that had to create
+# one (misses).  Additional fields may be added later.
 # @return a tuple of diagnostic data
 def getdiag(): pass
 
+## Retrieve callback statistics gathered by the milter module.
+# Return a dictionary keyed by callback name.  Each value is a
+# dictionary with the number of <code>calls</code>, untrapped exceptions
+# (<code>errors</code>), total seconds waiting to lock the interpreter
+# (<code>gil_wait</code>), total seconds spent with the interpreter locked
+# (<code>time</code>), a dictionary counting each return code
+# (<code>replies</code>), and a <code>histogram</code> tuple of call times.
+# Histogram bucket i counts calls taking less than 2**i microseconds,
+# and the last bucket counts the rest.  See Milter.stats() for a
+# friendlier summary.
+# @return a dictionary of statistics for each callback
+def getstats(): pass
+
 ## Retrieve the runtime libmilter version.
 # Return the runtime libmilter version. This can be different
 # from the compile time version when sendmail or libmilter is upgraded
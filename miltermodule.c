@@ -45,10 +45,11 @@ $ python setup.py help
 #define _FFR_MULTILINE (MAX_ML_REPLY > 1)
 #define PY_SSIZE_T_CLEAN
 
-//#include <pthread.h>	// shouldn't be needed - use Python API
+#include <pthread.h>		// thread specific python thread states
 #include <Python.h>		// Python C API
 #include <libmilter/mfapi.h>	// libmilter API
 #include <netinet/in.h>		// socket API
+#include <time.h>		// clock_gettime for callback statistics
 
 
 /* See if we have IPv4 and/or IPv6 support in this OS and in
@@ -87,7 +88,7 @@ $ python setup.py help
 #endif
 
 enum callbacks {
-	CONNECT,HELO,ENVFROM,ENVRCPT,HEADER,EOH,BODY,EOM,ABORT,CLOSE,
+	CONNECT,HELO,ENVFROM,ENVRCPT,HEADER,EOH,BODY,EOM,ABORT,CLOSE,HEADERS,
 #ifdef SMFIS_ALL_OPTS
 	UNKNOWN,DATA,NEGOTIATE,
 #endif
@@ -104,16 +105,35 @@ enum callbacks {
 #define eom_callback callback[EOM].cb
 #define abort_callback callback[ABORT].cb
 #define close_callback callback[CLOSE].cb
+#define headers_callback callback[HEADERS].cb
 #define unknown_callback callback[UNKNOWN].cb
 #define data_callback callback[DATA].cb
 #define negotiate_callback callback[NEGOTIATE].cb
 
+/* Callback statistics.  They are only updated and read with the
+   interpreter locked, so no other locking is needed.  Python time is
+   counted in a histogram of power of 2 microsecond buckets: bucket i
+   counts calls taking less than 2**i microseconds, and the last bucket
+   counts the rest. */
+#define STATS_BUCKETS 24
+#define STATS_REPLIES 11	/* SMFIS_CONTINUE .. SMFIS_ALL_OPTS */
+
+typedef struct {
+  unsigned long calls;
+  unsigned long errors;		/* untrapped exceptions */
+  unsigned long long gil_wait;	/* nanoseconds waiting for interpreter */
+  unsigned long long time;	/* nanoseconds with interpreter locked */
+  unsigned long replies[STATS_REPLIES];
+  unsigned long histogram[STATS_BUCKETS];
+} milter_Stats;
+
 /* Yes, these are static.  If you need multiple different callbacks, 
    it's cleaner to use multiple filters, or convert to OO method calls. */
 
 static struct MilterCallback {
   PyObject *cb;
   const char *name;
+  milter_Stats stats;
 } callback[NUMCALLBACKS+1] = {
       { NULL ,"connect" },
       { NULL ,"helo" },
@@ -125,6 +145,7 @@ static struct MilterCallback {
       { NULL ,"eom" },
       { NULL ,"abort" },
       { NULL ,"close" },
+      { NULL ,"headers" },
 #ifdef SMFIS_ALL_OPTS
       { NULL ,"unknown" },
       { NULL ,"data" },
@@ -145,19 +166,101 @@ static PyObject *MilterError;
 /* The interpreter instance that called milter.main */
 static PyInterpreterState *interp;
 typedef struct {
-  unsigned int contextNew;
-  unsigned int contextDel;
+  unsigned long contextNew;
+  unsigned long contextDel;
+  unsigned long threadStateHit;	/* new context reused thread state */
+  unsigned long threadStateMiss;	/* new context created thread state */
 } milter_Diag;
 
 static milter_Diag diag;
 
+/* Python thread state for each libmilter thread */
+static pthread_key_t tstate_key;
+static int tstate_key_created = 0;
+
 typedef struct {
   PyObject_HEAD
   SMFICTX *ctx;		/* libmilter thread state */
   PyObject *priv;	/* user python object */
   PyThreadState *t;	/* python thread state */
+  unsigned long long start;	/* when interpreter was locked for callback */
+  unsigned long long wait;	/* nanoseconds waited to lock interpreter */
+  unsigned long protocol;	/* negotiated protocol steps */
+  char *hdrbuf;		/* batched header name\0value\0 pairs */
+  size_t hdrlen;	/* bytes used in hdrbuf */
+  size_t hdrsize;	/* bytes allocated for hdrbuf */
+  int hdrcount;		/* number of headers in hdrbuf */
+  PyObject *dispatch;	/* tuple of callables indexed by callback, or NULL */
 } milter_ContextObject;
 
+/* Monotonic time in nanoseconds. */
+static unsigned long long
+_now(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (unsigned long long)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+/* Lock the interpreter for a callback, and note how long it took. */
+static void
+_acquire_thread(milter_ContextObject *self, PyThreadState *t) {
+  unsigned long long start = _now();
+  PyEval_AcquireThread(t);
+  self->start = _now();
+  self->wait = self->start - start;
+}
+
+/* Record statistics for a callback.  A negative rc means an untrapped
+   exception.  The interpreter must be locked. */
+static void
+_record_stats(milter_ContextObject *self, int which, int rc) {
+  milter_Stats *s = &callback[which].stats;
+  unsigned long long elapsed, us;
+  int i;
+  elapsed = _now() - self->start;
+  ++s->calls;
+  s->gil_wait += self->wait;
+  s->time += elapsed;
+  if (rc < 0)
+    ++s->errors;
+  else if (rc < STATS_REPLIES)
+    ++s->replies[rc];
+  us = elapsed / 1000;
+  for (i = 0; i < STATS_BUCKETS - 1 && us >= (1ULL << i); ++i);
+  ++s->histogram[i];
+}
+
+/* Destroy the python thread state of a libmilter thread when it exits. */
+static void
+_free_thread_state(void *p) {
+  PyThreadState *t = p;
+  if (interp == NULL) return;	/* python may be finalizing, just leak it */
+  PyEval_AcquireThread(t);
+  PyThreadState_Clear(t);
+  PyThreadState_DeleteCurrent();
+}
+
+/* Return the python thread state for the current libmilter thread.
+   Thread states are cached per posix thread, so that they are not
+   created and destroyed for each connection.  Sets *hit if the
+   thread state was already cached.  The interpreter is not locked. */
+static PyThreadState *
+_get_thread_state(int *hit) {
+  PyThreadState *t = pthread_getspecific(tstate_key);
+  *hit = (t != NULL);
+  if (t == NULL) {
+    t = PyThreadState_New(interp);
+    if (t == NULL) return NULL;
+    if (pthread_setspecific(tstate_key, t) != 0) {
+      PyEval_AcquireThread(t);
+      PyThreadState_Clear(t);
+      PyThreadState_DeleteCurrent();
+      return NULL;
+    }
+  }
+  return t;
+}
+
 /* Return a borrowed reference to the python Context.  Called by callbacks
    invoked by libmilter.  Create a new Context if needed.  The new
    Python Context is owned by the SMFICTX. The python interpreter is locked on
@@ -165,15 +268,23 @@ typedef struct {
 static milter_ContextObject *
 _get_context(SMFICTX *ctx) {
   milter_ContextObject *self = smfi_getpriv(ctx);
+  PyThreadState *t;
+  int hit;
+  /* Can't pass on exception since we are called from libmilter */
+  if (self && self->ctx != ctx) return NULL;
+  t = _get_thread_state(&hit);
+  if (t == NULL) return NULL;
   if (self) {
-    /* Can't pass on exception since we are called from libmilter */
-    if (self->ctx != ctx) return NULL;
-    PyEval_AcquireThread(self->t);
+    _acquire_thread(self, t);	/* lock interp */
+    self->t = t;
   }
   else {
-    PyThreadState *t = PyThreadState_New(interp);
-    if (t == NULL) return NULL;
+    unsigned long long start = _now();
     PyEval_AcquireThread(t);	/* lock interp */
+    if (hit)
+      ++diag.threadStateHit;
+    else
+      ++diag.threadStateMiss;
     self = PyObject_New(milter_ContextObject,&milter_ContextType);
     if (!self) {
       /* Report and clear exception since we are called from libmilter */
@@ -181,14 +292,19 @@ _get_context(SMFICTX *ctx) {
 	PyErr_Print();
 	PyErr_Clear();
       }
-      PyThreadState_Clear(t);
       PyEval_ReleaseThread(t);
-      PyThreadState_Delete(t);
       return NULL;
     }
     ++diag.contextNew;
     self->t = t;
+    self->start = _now();
+    self->wait = self->start - start;
     self->ctx = ctx;
+    self->protocol = 0;
+    self->hdrbuf = NULL;
+    self->hdrlen = self->hdrsize = 0;
+    self->hdrcount = 0;
+    self->dispatch = NULL;
     Py_INCREF(Py_None);
     self->priv = Py_None;	/* User Python object */
     smfi_setpriv(ctx, self);
@@ -223,6 +339,8 @@ milter_Context_dealloc(PyObject *s) {
       reach us anymore. */
     smfi_setpriv(ctx,0);
   }
+  free(self->hdrbuf);
+  Py_XDECREF(self->dispatch);
   Py_DECREF(self->priv);
   PyObject_DEL(self);
   ++diag.contextDel;
@@ -374,6 +492,31 @@ milter_set_eoh_callback(PyObject *self, PyObject *args) {
   return generic_set_callback(args, "O:set_eoh_callback", &eoh_callback);
 }
 
+static const char milter_set_headers_callback__doc__[] =
+"set_headers_callback(Function) -> None\n\
+Sets the Python function invoked once at end of header with all\n\
+header fields.  When set, header fields are collected without calling\n\
+the header callback or locking the interpreter, and the reply to each\n\
+header is NOREPLY if negotiated.  The eoh callback is called after\n\
+the headers callback returns CONTINUE.\n\
+Function takes args (ctx, headers) -> int\n\
+headers -> list of (field, value) tuples, with value as bytes";
+
+static PyObject *
+milter_set_headers_callback(PyObject *self, PyObject *args) {
+#ifndef SMFIP_NR_HDR
+  PyObject *cb;
+  if (!PyArg_ParseTuple(args, "O:set_headers_callback", &cb))
+    return NULL;
+  if (cb != Py_None) {
+    PyErr_SetString(MilterError, "headers callback not supported");
+    return NULL;
+  }
+#endif
+  return generic_set_callback(args, "O:set_headers_callback",
+	&headers_callback);
+}
+
 static const char milter_set_body_callback__doc__[] =
 "set_body_callback(Function) -> None\n\
 Sets the Python function invoked for each body chunk. There may\n\
@@ -387,6 +530,225 @@ milter_set_body_callback(PyObject *self, PyObject *args) {
   return generic_set_callback(args, "O:set_body_callback", &body_callback);
 }
 
+/* Pass body chunks as a read-only BodyChunk over the libmilter buffer. */
+static int body_buffer = 0;
+
+static const char milter_set_body_buffer__doc__[] =
+"set_body_buffer(bool) -> None\n\
+When true, the body callback receives each chunk as a read-only BodyChunk\n\
+over the libmilter buffer instead of a bytes copy.  The chunk is\n\
+released when the callback returns, and must not be kept (or sliced and\n\
+kept) beyond that.  Copy with bytes() if the data is needed later.\n\
+Using a chunk or slice kept past the callback raises ValueError.\n\
+A buffer still exported from it, e.g. to a memoryview, cannot be\n\
+released, and the callback fails with BufferError.";
+
+static PyObject *
+milter_set_body_buffer(PyObject *self, PyObject *args) {
+  int flag;
+  if (!PyArg_ParseTuple(args, "i:set_body_buffer", &flag))
+    return NULL;
+#if PY_VERSION_HEX < 0x03030000
+  if (flag) {
+    PyErr_SetString(MilterError, "body buffer not supported");
+    return NULL;
+  }
+#endif
+  body_buffer = flag;
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+#if PY_VERSION_HEX >= 0x03030000
+/* A read-only buffer over a body chunk.  Slices share the state of the
+ * root chunk, so releasing the root invalidates every slice taken from it. */
+typedef struct milter_BodyChunkObject {
+  PyObject_HEAD
+  struct milter_BodyChunkObject *root;	/* self, or the chunk sliced */
+  PyObject *owner;	/* object owning buf, NULL for libmilter's buffer */
+  const char *buf;
+  Py_ssize_t len;
+  Py_ssize_t exports;	/* buffers exported from this object */
+  Py_ssize_t shared;	/* root only: buffers exported from root and slices */
+  int released;
+} milter_BodyChunkObject;
+
+static PyTypeObject milter_BodyChunkType;
+
+static milter_BodyChunkObject *
+_body_chunk(milter_BodyChunkObject *root, const char *buf, Py_ssize_t len) {
+  milter_BodyChunkObject *self =
+      PyObject_New(milter_BodyChunkObject, &milter_BodyChunkType);
+  if (self == NULL) return NULL;
+  if (root == NULL)
+    root = self;
+  else
+    Py_INCREF(root);
+  self->root = root;
+  self->owner = NULL;
+  self->buf = buf;
+  self->len = len;
+  self->exports = 0;
+  self->shared = 0;
+  self->released = 0;
+  return self;
+}
+
+static int
+_body_chunk_check(milter_BodyChunkObject *self) {
+  if (self->released || self->root->released) {
+    PyErr_SetString(PyExc_ValueError,
+	"operation forbidden on released body chunk");
+    return -1;
+  }
+  return 0;
+}
+
+static PyObject *
+milter_BodyChunk_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+  PyObject *data;
+  milter_BodyChunkObject *self;
+  if (!PyArg_ParseTuple(args, "S:BodyChunk", &data))
+    return NULL;
+  self = _body_chunk(NULL, PyBytes_AS_STRING(data), PyBytes_GET_SIZE(data));
+  if (self == NULL) return NULL;
+  Py_INCREF(data);
+  self->owner = data;
+  return (PyObject *)self;
+}
+
+static void
+milter_BodyChunk_dealloc(milter_BodyChunkObject *self) {
+  if (self->root != self)
+    Py_DECREF(self->root);
+  Py_XDECREF(self->owner);
+  PyObject_Del(self);
+}
+
+static Py_ssize_t
+milter_BodyChunk_length(milter_BodyChunkObject *self) {
+  if (_body_chunk_check(self) < 0) return -1;
+  return self->len;
+}
+
+static PyObject *
+milter_BodyChunk_subscript(milter_BodyChunkObject *self, PyObject *key) {
+  if (_body_chunk_check(self) < 0) return NULL;
+  if (PyIndex_Check(key)) {
+    Py_ssize_t i = PyNumber_AsSsize_t(key, PyExc_IndexError);
+    if (i == -1 && PyErr_Occurred()) return NULL;
+    if (i < 0) i += self->len;
+    if (i < 0 || i >= self->len) {
+      PyErr_SetString(PyExc_IndexError, "index out of range");
+      return NULL;
+    }
+    return PyLong_FromLong((unsigned char)self->buf[i]);
+  }
+  if (PySlice_Check(key)) {
+    Py_ssize_t start, stop, step, n;
+    if (PySlice_GetIndicesEx(key, self->len, &start, &stop, &step, &n) < 0)
+      return NULL;
+    if (step != 1) {
+      PyErr_SetString(PyExc_ValueError, "body chunk slice step must be 1");
+      return NULL;
+    }
+    return (PyObject *)_body_chunk(self->root, self->buf + start, n);
+  }
+  PyErr_Format(PyExc_TypeError,
+      "body chunk indices must be integers or slices, not %.200s",
+      Py_TYPE(key)->tp_name);
+  return NULL;
+}
+
+static int
+milter_BodyChunk_getbuffer(milter_BodyChunkObject *self, Py_buffer *view,
+    int flags) {
+  if (_body_chunk_check(self) < 0) return -1;
+  if (PyBuffer_FillInfo(view, (PyObject *)self, (void *)self->buf, self->len,
+	1, flags) < 0)
+    return -1;
+  self->exports++;
+  self->root->shared++;
+  return 0;
+}
+
+static void
+milter_BodyChunk_releasebuffer(milter_BodyChunkObject *self, Py_buffer *view) {
+  self->exports--;
+  self->root->shared--;
+}
+
+static const char milter_BodyChunk_tobytes__doc__[] =
+"tobytes() -> bytes\n\
+Return a copy of the chunk data.";
+
+static PyObject *
+milter_BodyChunk_tobytes(milter_BodyChunkObject *self, PyObject *args) {
+  if (_body_chunk_check(self) < 0) return NULL;
+  return PyBytes_FromStringAndSize(self->buf, self->len);
+}
+
+static const char milter_BodyChunk_release__doc__[] =
+"release() -> None\n\
+Release the chunk.  Releasing the chunk passed to the body callback\n\
+also releases every slice of it.  Raises BufferError while buffers\n\
+are exported, e.g. to a memoryview.";
+
+static PyObject *
+milter_BodyChunk_release(milter_BodyChunkObject *self, PyObject *args) {
+  if (self->root == self ? self->shared : self->exports) {
+    PyErr_SetString(PyExc_BufferError, "body chunk has exported buffers");
+    return NULL;
+  }
+  self->released = 1;
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+static PyMethodDef body_chunk_methods[] = {
+  { "tobytes", (PyCFunction)milter_BodyChunk_tobytes, METH_NOARGS,
+    milter_BodyChunk_tobytes__doc__ },
+  { "release", (PyCFunction)milter_BodyChunk_release, METH_NOARGS,
+    milter_BodyChunk_release__doc__ },
+  { NULL, NULL }
+};
+
+static PyMappingMethods body_chunk_as_mapping = {
+  (lenfunc)milter_BodyChunk_length,		/* mp_length */
+  (binaryfunc)milter_BodyChunk_subscript,	/* mp_subscript */
+  0,						/* mp_ass_subscript */
+};
+
+static PySequenceMethods body_chunk_as_sequence = {
+  (lenfunc)milter_BodyChunk_length,		/* sq_length */
+};
+
+static PyBufferProcs body_chunk_as_buffer = {
+  (getbufferproc)milter_BodyChunk_getbuffer,
+  (releasebufferproc)milter_BodyChunk_releasebuffer,
+};
+
+static const char milter_BodyChunk__doc__[] =
+"BodyChunk(bytes) -> BodyChunk\n\
+A read-only buffer over a body chunk, passed to the body callback by\n\
+set_body_buffer(True).  It supports len(), indexing, slicing, which\n\
+does not copy, and the buffer protocol, e.g. bytes(chunk).";
+
+static PyTypeObject milter_BodyChunkType = {
+  PyVarObject_HEAD_INIT(&PyType_Type,0)
+  .tp_name = "milter.BodyChunk",
+  .tp_basicsize = sizeof(milter_BodyChunkObject),
+  .tp_dealloc = (destructor)milter_BodyChunk_dealloc,
+  .tp_as_sequence = &body_chunk_as_sequence,
+  .tp_as_mapping = &body_chunk_as_mapping,
+  .tp_as_buffer = &body_chunk_as_buffer,
+  .tp_flags = Py_TPFLAGS_DEFAULT,
+  .tp_doc = milter_BodyChunk__doc__,
+  .tp_methods = body_chunk_methods,
+  .tp_new = milter_BodyChunk_new,
+};
+#endif
+
 static const char milter_set_eom_callback__doc__[] =
 "set_eom_callback(Function) -> None\n\
 Sets the Python function invoked at end of message.\n\
@@ -425,6 +787,22 @@ milter_set_close_callback(PyObject *self, PyObject *args) {
   return generic_set_callback(args, "O:set_close_callback", &close_callback);
 }
 
+/* Called with results of callbacks that are not int, e.g. futures. */
+static PyObject *future_callback = NULL;
+
+static const char milter_set_future_callback__doc__[] =
+"set_future_callback(Function) -> None\n\
+Sets the Python function invoked when a callback returns something\n\
+other than an int, such as a future or coroutine.  It is called in\n\
+the same libmilter thread, and its result is used as the reply.\n\
+Function takes args (ctx, result, name) -> int\n\
+name -> String - the name of the callback that returned result";
+
+static PyObject *
+milter_set_future_callback(PyObject *self, PyObject *args) {
+  return generic_set_callback(args, "O:set_future_callback", &future_callback);
+}
+
 static int exception_policy = SMFIS_TEMPFAIL;
 
 static const char milter_set_exception_policy__doc__[] =
@@ -482,35 +860,66 @@ static int _report_exception(milter_ContextObject *self) {
   return SMFIS_CONTINUE;
 }
 
-/* Return to libmilter.  The ctx must have been initialized or
+/* Call the python callback with index which, and return to libmilter.
+  If the context has a dispatch table with a callable for the callback,
+  call that without the context argument instead of the registered
+  callback.  The ctx must have been initialized or
   checked by a successfull call to _get_context(), thereby locking
   the interpreter. */
 static int
-_generic_wrapper(milter_ContextObject *self, PyObject *cb, PyObject *arglist) {
+_generic_wrapper(milter_ContextObject *self, int which, PyObject *arglist) {
   PyObject *result;
+  PyObject *cb = callback[which].cb;
   int retval;
 
-  if (arglist == NULL) return _report_exception(self);
+  if (arglist == NULL) {
+    _record_stats(self, which, -1);
+    return _report_exception(self);
+  }
+  if (self->dispatch != NULL && which < PyTuple_GET_SIZE(self->dispatch)
+      && PyTuple_GET_ITEM(self->dispatch, which) != Py_None) {
+    PyObject *args = PyTuple_GetSlice(arglist, 1, PyTuple_GET_SIZE(arglist));
+    Py_DECREF(arglist);
+    if (args == NULL) {
+      _record_stats(self, which, -1);
+      return _report_exception(self);
+    }
+    arglist = args;
+    cb = PyTuple_GET_ITEM(self->dispatch, which);
+  }
+  Py_INCREF(cb);	/* in case the callback replaces the dispatch table */
   result = PyObject_CallObject(cb, arglist);
+  Py_DECREF(cb);
   Py_DECREF(arglist);
-  if (result == NULL) return _report_exception(self);
+  if (result == NULL) {
+    _record_stats(self, which, -1);
+    return _report_exception(self);
+  }
+#if PY_MAJOR_VERSION >= 3
+  if (!PyLong_Check(result) && future_callback != NULL) {
+#else
+  if (!PyInt_Check(result) && future_callback != NULL) {
+#endif
+    /* wait for the result, the future callback releases the interpreter */
+    PyObject *r = PyObject_CallFunction(future_callback, "(OOs)",
+	self, result, callback[which].name);
+    Py_DECREF(result);
+    if (r == NULL) {
+      _record_stats(self, which, -1);
+      return _report_exception(self);
+    }
+    result = r;
+  }
 #if PY_MAJOR_VERSION >= 3
   if (!PyLong_Check(result)) {
 #else
   if (!PyInt_Check(result)) {
 #endif
-    const struct MilterCallback *p;
-    const char *cbname = "milter";
     char buf[40];
     Py_DECREF(result);
-    for (p = callback; p->name; ++p) {
-      if (cb == p->cb) {
-        cbname = p->name;
-	break;
-      }
-    }
-    sprintf(buf,"The %s callback must return int",cbname);
+    sprintf(buf,"The %s callback must return int",callback[which].name);
     PyErr_SetString(MilterError,buf);
+    _record_stats(self, which, -1);
     return _report_exception(self);
   }
 #if PY_MAJOR_VERSION >= 3
@@ -519,6 +928,7 @@ _generic_wrapper(milter_ContextObject *self, PyObject *cb, PyObject *arglist) {
   retval = PyInt_AS_LONG(result);
 #endif
   Py_DECREF(result);
+  _record_stats(self, which, retval);
   _release_thread(self->t);
   return retval;
 }
@@ -602,7 +1012,7 @@ milter_wrap_connect(SMFICTX *ctx, char *hostname, _SOCK_ADDR *hostaddr) {
   }
   else
     arglist = Py_BuildValue("(OshO)", c, hostname, 0, Py_None);
-  return _generic_wrapper(c, connect_callback, arglist);
+  return _generic_wrapper(c, CONNECT, arglist);
 }
 
 static int
@@ -614,11 +1024,12 @@ milter_wrap_helo(SMFICTX *ctx, char *helohost) {
   c = _get_context(ctx);
   if (!c) return SMFIS_TEMPFAIL;
   arglist = Py_BuildValue("(Os)", c, helohost);
-  return _generic_wrapper(c, helo_callback, arglist);
+  return _generic_wrapper(c, HELO, arglist);
 }
 
 static int
-generic_env_wrapper(SMFICTX *ctx, PyObject*cb, char **argv) {
+generic_env_wrapper(SMFICTX *ctx, int which, char **argv) {
+   PyObject *cb = callback[which].cb;
    PyObject *arglist;
    milter_ContextObject *self;
    int count = 0;
@@ -654,24 +1065,85 @@ generic_env_wrapper(SMFICTX *ctx, PyObject*cb, char **argv) {
      }
      PyTuple_SetItem(arglist, i + 1, o);
    }
-   return _generic_wrapper(self, cb, arglist);
+   return _generic_wrapper(self, which, arglist);
 }
 
 static int
 milter_wrap_envfrom(SMFICTX *ctx, char **argv) {
-  return generic_env_wrapper(ctx,envfrom_callback,argv);
+  return generic_env_wrapper(ctx,ENVFROM,argv);
 }
 
 static int
 milter_wrap_envrcpt(SMFICTX *ctx, char **argv) {
-  return generic_env_wrapper(ctx,envrcpt_callback,argv);
+  return generic_env_wrapper(ctx,ENVRCPT,argv);
 }    
   
+#ifdef SMFIP_NR_HDR
+/* Save a header for the headers callback.  The interpreter is not
+   locked, but only the libmilter thread for this connection uses hdrbuf. */
+static int
+_batch_header(milter_ContextObject *c, const char *headerf,
+		const char *headerv) {
+  size_t lf = strlen(headerf) + 1;
+  size_t lv = strlen(headerv) + 1;
+  if (c->hdrlen + lf + lv > c->hdrsize) {
+    size_t n = c->hdrsize ? c->hdrsize : 4096;
+    char *p;
+    while (n < c->hdrlen + lf + lv) n *= 2;
+    p = realloc(c->hdrbuf, n);
+    if (p == NULL) return SMFIS_TEMPFAIL;
+    c->hdrbuf = p;
+    c->hdrsize = n;
+  }
+  memcpy(c->hdrbuf + c->hdrlen, headerf, lf);
+  c->hdrlen += lf;
+  memcpy(c->hdrbuf + c->hdrlen, headerv, lv);
+  c->hdrlen += lv;
+  ++c->hdrcount;
+  return (c->protocol & SMFIP_NR_HDR) ? SMFIS_NOREPLY : SMFIS_CONTINUE;
+}
+
+/* Return a new list of (field, value) tuples from the batched headers,
+   and empty the batch.  The interpreter must be locked. */
+static PyObject *
+_header_list(milter_ContextObject *c) {
+  PyObject *list = PyList_New(c->hdrcount);
+  const char *p = c->hdrbuf;
+  int i;
+  if (list == NULL) return NULL;
+  for (i = 0; i < c->hdrcount; ++i) {
+    const char *v = p + strlen(p) + 1;
+#if PY_MAJOR_VERSION >= 3
+    PyObject *o = Py_BuildValue("(sy)", p, v);
+#else
+    PyObject *o = Py_BuildValue("(ss)", p, v);
+#endif
+    if (o == NULL) {
+      Py_DECREF(list);
+      list = NULL;
+      break;
+    }
+    PyList_SET_ITEM(list, i, o);
+    p = v + strlen(v) + 1;
+  }
+  c->hdrlen = 0;
+  c->hdrcount = 0;
+  return list;
+}
+#endif
+
 static int
 milter_wrap_header(SMFICTX *ctx, char *headerf, char *headerv) {
    PyObject *arglist;
    milter_ContextObject *c;
 
+#ifdef SMFIP_NR_HDR
+   if (headers_callback != NULL) {
+     c = smfi_getpriv(ctx);
+     if (c && c->ctx == ctx)
+       return _batch_header(c, headerf, headerv);
+   }
+#endif
    if (header_callback == NULL) return SMFIS_CONTINUE;
    c = _get_context(ctx);
    if (!c) return SMFIS_TEMPFAIL;
@@ -681,23 +1153,46 @@ milter_wrap_header(SMFICTX *ctx, char *headerf, char *headerv) {
 #else
    arglist = Py_BuildValue("(Oss)", c, headerf, headerv);
 #endif
-   return _generic_wrapper(c, header_callback, arglist);
+   return _generic_wrapper(c, HEADER, arglist);
 }
 
 static int
-generic_noarg_wrapper(SMFICTX *ctx,PyObject *cb) {
+generic_noarg_wrapper(SMFICTX *ctx,int which) {
    PyObject *arglist;
    milter_ContextObject *c;
-   if (cb == NULL) return SMFIS_CONTINUE;
+   if (callback[which].cb == NULL) return SMFIS_CONTINUE;
    c = _get_context(ctx);
    if (!c) return SMFIS_TEMPFAIL;
    arglist = Py_BuildValue("(O)", c);
-   return _generic_wrapper(c, cb, arglist);
+   return _generic_wrapper(c, which, arglist);
 }
 
 static int
 milter_wrap_eoh(SMFICTX *ctx) {
-  return generic_noarg_wrapper(ctx,eoh_callback);
+#ifdef SMFIP_NR_HDR
+  if (headers_callback != NULL && smfi_getpriv(ctx) != NULL) {
+    PyObject *arglist, *hdrs;
+    PyThreadState *t;
+    milter_ContextObject *c = _get_context(ctx);
+    int rc;
+    if (!c) return SMFIS_TEMPFAIL;
+    hdrs = _header_list(c);
+    arglist = hdrs ? Py_BuildValue("(ON)", c, hdrs) : NULL;
+    t = c->t;
+    c->t = 0;	// do not release thread in _generic_wrapper
+    rc = _generic_wrapper(c, HEADERS, arglist);
+    c->t = t;
+    if ((rc != SMFIS_CONTINUE && rc != SMFIS_NOREPLY) || eoh_callback == NULL) {
+      _release_thread(t);
+      return rc == SMFIS_NOREPLY ? SMFIS_CONTINUE : rc;
+    }
+    c->start = _now();	/* time eoh separately */
+    c->wait = 0;
+    arglist = Py_BuildValue("(O)", c);
+    return _generic_wrapper(c, EOH, arglist);
+  }
+#endif
+  return generic_noarg_wrapper(ctx,EOH);
 }   
 
 static int
@@ -708,24 +1203,57 @@ milter_wrap_body(SMFICTX *ctx, u_char *bodyp, size_t bodylen) {
    if (body_callback == NULL) return SMFIS_CONTINUE;
    c = _get_context(ctx);
    if (!c) return SMFIS_TEMPFAIL;
+#if PY_VERSION_HEX >= 0x03030000
+   if (body_buffer) {
+     PyThreadState *t = c->t;
+     milter_BodyChunkObject *chunk;
+     int rc, kept;
+     /* avoid copying the chunk, it is only valid during the callback */
+     chunk = _body_chunk(NULL, (const char *)bodyp, (Py_ssize_t)bodylen);
+     if (chunk == NULL) return _report_exception(c);
+     arglist = Py_BuildValue("(OO)", c, chunk);
+     c->t = 0;	// do not release thread in _generic_wrapper
+     rc = _generic_wrapper(c, BODY, arglist);
+     c->t = t;
+     /* libmilter reuses the buffer, so release the chunk and its slices.
+      * A buffer still exported, e.g. to a memoryview, points at the
+      * libmilter buffer and cannot be released, so fail the callback. */
+     kept = chunk->shared > 0;
+     chunk->released = 1;
+     Py_DECREF(chunk);
+     if (kept) {
+       PyErr_SetString(PyExc_BufferError,
+	   "body chunk exported past the callback, copy it with bytes()");
+       return _report_exception(c);
+     }
+     _release_thread(t);
+     return rc;
+   }
+#endif
    /* Unclear whether this should be s#, z#, or t# */
 #if PY_MAJOR_VERSION >= 3
    arglist = Py_BuildValue("(Oy#)", c, bodyp, (Py_ssize_t)bodylen);
 #else
    arglist = Py_BuildValue("(Os#)", c, bodyp, (Py_ssize_t)bodylen);
 #endif
-   return _generic_wrapper(c, body_callback, arglist);
+   return _generic_wrapper(c, BODY, arglist);
 }
 
 static int
 milter_wrap_eom(SMFICTX *ctx) {
-  return generic_noarg_wrapper(ctx,eom_callback);
+  return generic_noarg_wrapper(ctx,EOM);
 }
 
 static int
 milter_wrap_abort(SMFICTX *ctx) {
+  milter_ContextObject *c = smfi_getpriv(ctx);
+  if (c && c->ctx == ctx) {
+    /* discard headers batched for an aborted message */
+    c->hdrlen = 0;
+    c->hdrcount = 0;
+  }
   /* libmilter still calls close after abort */
-  return generic_noarg_wrapper(ctx,abort_callback);
+  return generic_noarg_wrapper(ctx,ABORT);
 }
 
 #ifdef SMFIS_ALL_OPTS
@@ -738,12 +1266,12 @@ milter_wrap_unknown(SMFICTX *ctx, const char *cmd) {
    c = _get_context(ctx);
    if (!c) return SMFIS_TEMPFAIL;
    arglist = Py_BuildValue("(Os)", c, cmd);
-   return _generic_wrapper(c, unknown_callback, arglist);
+   return _generic_wrapper(c, UNKNOWN, arglist);
 }
 
 static int
 milter_wrap_data(SMFICTX *ctx) {
-  return generic_noarg_wrapper(ctx,data_callback);
+  return generic_noarg_wrapper(ctx,DATA);
 }   
 
 static int
@@ -771,7 +1299,7 @@ milter_wrap_negotiate(SMFICTX *ctx,
     arglist = Py_BuildValue("(OO)", c, optlist);
   PyThreadState *t = c->t;
   c->t = 0;	// do not release thread in _generic_wrapper
-  rc = _generic_wrapper(c, negotiate_callback, arglist);
+  rc = _generic_wrapper(c, NEGOTIATE, arglist);
   c->t = t;
   if (rc == SMFIS_CONTINUE) {
     unsigned long *pa[4] = { pf0,pf1,pf2,pf3 };
@@ -792,6 +1320,7 @@ milter_wrap_negotiate(SMFICTX *ctx,
       PyErr_Clear();
       rc = SMFIS_REJECT;
     }
+    c->protocol = *pf1;
   }
   else if (rc != SMFIS_ALL_OPTS)
     rc = SMFIS_REJECT;
@@ -812,21 +1341,23 @@ milter_wrap_close(SMFICTX *ctx) {
   milter_ContextObject *self = smfi_getpriv(ctx);
   int r = SMFIS_CONTINUE;
   if (self != NULL) {
-    PyThreadState *t = self->t;
-    PyEval_AcquireThread(t);
+    int hit;
+    PyThreadState *t = _get_thread_state(&hit);
+    if (t == NULL) return r;
+    _acquire_thread(self, t);
     self->t = 0;
     if (cb != NULL && self->ctx == ctx) {
       PyObject *arglist = Py_BuildValue("(O)", self);
       /* Call python close callback, but do not ReleaseThread, because
        * self->t is NULL */
-      r = _generic_wrapper(self, cb, arglist);
+      r = _generic_wrapper(self, CLOSE, arglist);
     }
+    Py_CLEAR(self->dispatch);	/* release bound methods of priv */
     self->ctx = 0;
     smfi_setpriv(ctx,0);
     Py_DECREF(self);
-    PyThreadState_Clear(t);
+    /* the thread state stays cached for the next connection on this thread */
     PyEval_ReleaseThread(t);
-    PyThreadState_Delete(t);
   }
   return r;
 }
@@ -908,6 +1439,13 @@ milter_main(PyObject *self, PyObject *args) {
   /* called in Py_Initialize beginning with 3.7 */
   PyEval_InitThreads();	
   #endif
+  if (!tstate_key_created) {
+    if (pthread_key_create(&tstate_key, _free_thread_state) != 0) {
+      PyErr_SetString(MilterError,"cannot create thread key");
+      return NULL;
+    }
+    tstate_key_created = 1;
+  }
   /* let other threads run while in smfi_main() */
   interp = PyThreadState_Get()->interp;
   _main = PyEval_SaveThread();	/* must be done before smfi_main() */
@@ -988,11 +1526,74 @@ milter_stop(PyObject *self, PyObject *args) {
 static const char milter_getdiag__doc__[] =
 "getdiag() -> tuple\n\
 Return a tuple of diagnostic data.  The first two items are context new\n\
-count and context del count.  The rest are yet to be defined.";
+count and context del count.  The next two are the number of new contexts\n\
+that reused the cached thread state of a libmilter thread, and the\n\
+number that had to create one.  The rest are yet to be defined.";
 static PyObject *
 milter_getdiag(PyObject *self, PyObject *args) {
   if (!PyArg_ParseTuple(args, ":getdiag")) return NULL;
-  return Py_BuildValue("(kk)", diag.contextNew,diag.contextDel);
+  return Py_BuildValue("(kkkk)", diag.contextNew,diag.contextDel,
+		  diag.threadStateHit,diag.threadStateMiss);
+}
+
+static const char milter_getstats__doc__[] =
+"getstats() -> dict\n\
+Return a dictionary of statistics for each callback, keyed by callback\n\
+name.  Each value is a dictionary with the number of calls, untrapped\n\
+exceptions (errors), seconds waiting to lock the interpreter (gil_wait),\n\
+seconds spent with the interpreter locked (time), a dictionary counting\n\
+each return code (replies), and a histogram tuple of call times.\n\
+Histogram bucket i counts calls taking less than 2**i microseconds, and\n\
+the last bucket counts the rest.";
+
+static PyObject *
+milter_getstats(PyObject *self, PyObject *args) {
+  const struct MilterCallback *p;
+  PyObject *d;
+  if (!PyArg_ParseTuple(args, ":getstats")) return NULL;
+  d = PyDict_New();
+  if (d == NULL) return NULL;
+  for (p = callback; p->name; ++p) {
+    const milter_Stats *s = &p->stats;
+    PyObject *replies = PyDict_New();
+    PyObject *hist = PyTuple_New(STATS_BUCKETS);
+    PyObject *o;
+    int i;
+    if (replies == NULL || hist == NULL) goto error;
+    for (i = 0; i < STATS_REPLIES; ++i) {
+      if (s->replies[i]) {
+	PyObject *k = PyLong_FromLong(i);
+	PyObject *v = PyLong_FromUnsignedLong(s->replies[i]);
+	int rc = (k && v) ? PyDict_SetItem(replies, k, v) : -1;
+	Py_XDECREF(k);
+	Py_XDECREF(v);
+	if (rc < 0) goto error;
+      }
+    }
+    for (i = 0; i < STATS_BUCKETS; ++i) {
+      PyObject *v = PyLong_FromUnsignedLong(s->histogram[i]);
+      if (v == NULL) goto error;
+      PyTuple_SET_ITEM(hist, i, v);
+    }
+    /* N format steals the replies and hist references */
+    o = Py_BuildValue("{s:k,s:k,s:d,s:d,s:N,s:N}",
+	"calls", s->calls, "errors", s->errors,
+	"gil_wait", s->gil_wait / 1e9, "time", s->time / 1e9,
+	"replies", replies, "histogram", hist);
+    if (o == NULL || PyDict_SetItemString(d, p->name, o) < 0) {
+      Py_XDECREF(o);
+      Py_DECREF(d);
+      return NULL;
+    }
+    Py_DECREF(o);
+    continue;
+  error:
+    Py_XDECREF(replies);
+    Py_XDECREF(hist);
+    Py_DECREF(d);
+    return NULL;
+  }
+  return d;
 }
 
 static const char milter_getversion__doc__[] =
@@ -1274,6 +1875,34 @@ milter_setpriv(PyObject *self, PyObject *args) {
   return old;
 }
 
+static const char milter_setdispatch__doc__[] =
+"setdispatch(methods) -> None\n\
+Set callables to call directly for this context, instead of the\n\
+functions set with milter.set_*_callback().  Methods is a sequence\n\
+with an item for each callback in the order connect, helo, envfrom,\n\
+envrcpt, header, eoh, body, eom, abort, close, headers, unknown, data,\n\
+negotiate.  The callables are not passed the context.  An item of None\n\
+calls the registered function.  Pass None to clear the table.";
+
+static PyObject *
+milter_setdispatch(PyObject *self, PyObject *args) {
+  PyObject *o;
+  PyObject *t = NULL;
+  PyObject *old;
+  milter_ContextObject *s = (milter_ContextObject *)self;
+
+  if (!PyArg_ParseTuple(args, "O:setdispatch", &o)) return NULL;
+  if (o != Py_None) {
+    t = PySequence_Tuple(o);
+    if (t == NULL) return NULL;
+  }
+  old = s->dispatch;
+  s->dispatch = t;
+  Py_XDECREF(old);
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
 static const char milter_getpriv__doc__[] =
 "getpriv() -> None\n\
 Returns the Python object associated with the current context (if any).\n\
@@ -1361,6 +1990,7 @@ static PyMethodDef context_methods[] = {
   { "replacebody", milter_replacebody, METH_VARARGS, milter_replacebody__doc__},
   { "setpriv",     milter_setpriv,     METH_VARARGS, milter_setpriv__doc__},
   { "getpriv",     milter_getpriv,     METH_VARARGS, milter_getpriv__doc__},
+  { "setdispatch", milter_setdispatch, METH_VARARGS, milter_setdispatch__doc__},
 #ifdef SMFIF_QUARANTINE
   { "quarantine",  milter_quarantine,  METH_VARARGS, milter_quarantine__doc__},
 #endif
@@ -1412,7 +2042,10 @@ static PyMethodDef milter_methods[] = {
    { "set_envrcpt_callback", milter_set_envrcpt_callback, METH_VARARGS, milter_set_envrcpt_callback__doc__},
    { "set_header_callback",  milter_set_header_callback,  METH_VARARGS, milter_set_header_callback__doc__},
    { "set_eoh_callback",     milter_set_eoh_callback,     METH_VARARGS, milter_set_eoh_callback__doc__},
+   { "set_headers_callback", milter_set_headers_callback, METH_VARARGS, milter_set_headers_callback__doc__},
+   { "set_future_callback",  milter_set_future_callback,  METH_VARARGS, milter_set_future_callback__doc__},
    { "set_body_callback",    milter_set_body_callback,    METH_VARARGS, milter_set_body_callback__doc__},
+   { "set_body_buffer",      milter_set_body_buffer,      METH_VARARGS, milter_set_body_buffer__doc__},
    { "set_eom_callback",     milter_set_eom_callback,     METH_VARARGS, milter_set_eom_callback__doc__},
    { "set_abort_callback",   milter_set_abort_callback,   METH_VARARGS, milter_set_abort_callback__doc__},
    { "set_close_callback",   milter_set_close_callback,   METH_VARARGS, milter_set_close_callback__doc__},
@@ -1426,6 +2059,7 @@ static PyMethodDef milter_methods[] = {
    { "setconn",              milter_setconn,              METH_VARARGS, milter_setconn__doc__},
    { "stop",                 milter_stop,                 METH_VARARGS, milter_stop__doc__},
    { "getdiag",              milter_getdiag,              METH_VARARGS, milter_getdiag__doc__},
+   { "getstats",             milter_getstats,             METH_VARARGS, milter_getstats__doc__},
    { "getversion",           milter_getversion,           METH_VARARGS, milter_getversion__doc__},
    { NULL, NULL }
 };
@@ -1507,6 +2141,8 @@ PyMODINIT_FUNC PyInit_milter(void) {
  
    if (PyType_Ready(&milter_ContextType) < 0)
           return NULL;
+   if (PyType_Ready(&milter_BodyChunkType) < 0)
+          return NULL;
 
    m = PyModule_Create(&moduledef);
    if (m == NULL) return NULL;
@@ -1521,6 +2157,9 @@ void initmilter(void) {
    d = PyModule_GetDict(m);
    MilterError = PyErr_NewException("milter.error", NULL, NULL);
    PyDict_SetItemString(d,"error", MilterError);
+#if PY_VERSION_HEX >= 0x03030000
+   PyDict_SetItemString(d,"BodyChunk", (PyObject *)&milter_BodyChunkType);
+#endif
    setitem(d,"SUCCESS",  MI_SUCCESS);
    setitem(d,"FAILURE",  MI_FAILURE);
    setitem(d,"VERSION",  SMFI_VERSION);
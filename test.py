@@ -1,8 +1,11 @@
 import os
 import unittest
 
+import testasync
 import testcfg
 import testgrey
+import testmetrics
+import testmilter
 import testmime
 import testpolicy
 import testsample
@@ -17,6 +20,9 @@ def suite():
     s.addTest(testgrey.suite())
     s.addTest(testcfg.suite())
     s.addTest(testpolicy.suite())
+    s.addTest(testasync.suite())
+    s.addTest(testmetrics.suite())
+    s.addTest(testmilter.suite())
     return s
 
 
@@ -0,0 +1,263 @@
+import asyncio
+import socket
+import struct
+import unittest
+
+import Milter
+from Milter.asyncserver import MilterConnection, parse_socketname, runmilter
+
+
+class asyncMilter(Milter.Base):
+    def __init__(self):
+        self.rcpts = []
+        self.headers = []
+        self.body_len = 0
+
+    def connect(self, hostname, family, hostaddr):
+        self.hostaddr = hostaddr
+        self.receiver = self.getsymval("j")
+        return Milter.CONTINUE
+
+    @Milter.noreply
+    def envrcpt(self, to, *params):
+        self.rcpts.append(to)
+        return Milter.CONTINUE
+
+    def header(self, fld, val):
+        self.headers.append((fld, val))
+        if fld == "X-Reject":
+            self.setreply("550", "5.7.1", "Go away")
+            return Milter.REJECT
+        return Milter.CONTINUE
+
+    def body(self, chunk):
+        self.body_len += len(chunk)
+        return Milter.CONTINUE
+
+    def eom(self):
+        self.addheader("X-Rcpts", str(len(self.rcpts)))
+        self.chgheader("Subject", 1, "")
+        return Milter.ACCEPT
+
+
+@Milter.batch_headers
+class batchMilter(Milter.Base):
+    def headers(self, hdrs):
+        self.batch = hdrs
+        for fld, val in hdrs:
+            if fld == "X-Reject":
+                return Milter.REJECT
+        return Milter.CONTINUE
+
+
+@Milter.spool_body
+class spoolMilter(Milter.Base):
+    def eom(self):
+        self.message = self.body_file.read()
+        return Milter.CONTINUE
+
+
+class futureMilter(Milter.Base):
+    def envfrom(self, f, *params):
+        return self.submit(lambda: Milter.CONTINUE)
+
+    async def eom(self):
+        await asyncio.sleep(0.05)
+        self.addheader("X-Checked", "yes")
+        return Milter.ACCEPT
+
+
+## A minimal MTA side of the %milter protocol.
+class FakeMTA(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, cmd, data=b""):
+        self.writer.write(struct.pack("!I", len(data) + 1) + cmd + data)
+
+    async def recv(self):
+        (n,) = struct.unpack("!I", await self.reader.readexactly(4))
+        data = await self.reader.readexactly(n)
+        return data[:1], data[1:]
+
+    async def command(self, cmd, data=b""):
+        self.send(cmd, data)
+        await self.writer.drain()
+        return await self.recv()
+
+
+class AsyncServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.factory = Milter.factory
+        Milter.factory = asyncMilter
+
+    def tearDown(self):
+        Milter.factory = self.factory
+
+    def testSocketName(self):
+        self.assertEqual(parse_socketname("/tmp/sock"), (socket.AF_UNIX, "/tmp/sock"))
+        self.assertEqual(
+            parse_socketname("inet:8800@127.0.0.1"),
+            (socket.AF_INET, ("127.0.0.1", 8800)),
+        )
+        self.assertEqual(
+            parse_socketname("inet6:8020@[::1]"), (socket.AF_INET6, ("::1", 8020))
+        )
+
+    def testPortInUse(self):
+        busy = socket.create_server(("127.0.0.1", 0))
+        port = busy.getsockname()[1]
+        try:
+            # raised before forking any workers
+            self.assertRaises(
+                OSError, runmilter, "testfilter", "inet:%d@127.0.0.1" % port, workers=2
+            )
+        finally:
+            busy.close()
+
+    def run_session(self, session):
+        async def main():
+            s1, s2 = socket.socketpair()
+            r1, w1 = await asyncio.open_connection(sock=s1)
+            r2, w2 = await asyncio.open_connection(sock=s2)
+            conn = MilterConnection("testfilter", r1, w1)
+            task = asyncio.ensure_future(conn.run())
+            try:
+                return await session(FakeMTA(r2, w2), conn)
+            finally:
+                w2.close()
+                await task
+
+        return asyncio.run(main())
+
+    def testSession(self):
+        async def session(mta, conn):
+            acts = Milter.CURR_ACTS
+            cmd, data = await mta.command(b"O", struct.pack("!III", 6, acts, 0x1FFFFF))
+            self.assertEqual(cmd, b"O")
+            version, actions, protocol = struct.unpack("!III", data[:12])
+            self.assertEqual(version, 6)
+            self.assertTrue(protocol & Milter.P_NR_RCPT)
+            self.assertTrue(protocol & Milter.P_NOHELO)
+            self.assertFalse(protocol & Milter.P_NOCONNECT)
+            mta.send(b"D", b"Cj\0mailhost\0")
+            cmd, data = await mta.command(
+                b"C", b"mail.example.com\x004" + struct.pack("!H", 25) + b"1.2.3.4\0"
+            )
+            self.assertEqual(cmd, b"c")
+            milter = conn.ctx.getpriv()
+            self.assertEqual(milter.receiver, "mailhost")
+            self.assertEqual(milter.hostaddr, ("1.2.3.4", 25))
+            cmd, data = await mta.command(b"M", b"<spam@adv.com>\0SIZE=100\0")
+            self.assertEqual(cmd, b"c")
+            # no reply negotiated for RCPT
+            mta.send(b"R", b"<victim@lamb.com>\0")
+            cmd, data = await mta.command(b"L", b"Subject\0hello\0")
+            self.assertEqual(cmd, b"c")
+            cmd, data = await mta.command(b"N")
+            self.assertEqual(cmd, b"c")
+            cmd, data = await mta.command(b"B", b"x" * 1000)
+            self.assertEqual(cmd, b"c")
+            replies = []
+            mta.send(b"E")
+            while True:
+                cmd, data = await mta.recv()
+                replies.append((cmd, data))
+                if cmd == b"a":
+                    break
+            self.assertEqual(replies[0], (b"h", b"X-Rcpts\x001\0"))
+            self.assertEqual(replies[1][0], b"m")
+            self.assertEqual(milter.rcpts, ["<victim@lamb.com>"])
+            self.assertEqual(milter.body_len, 1000)
+            # second message is rejected with a custom reply
+            cmd, data = await mta.command(b"M", b"<spam@adv.com>\0")
+            cmd, data = await mta.command(b"L", b"X-Reject\0yes\0")
+            self.assertEqual((cmd, data), (b"y", b"550 5.7.1 Go away\0"))
+            mta.send(b"Q")
+            await mta.writer.drain()
+
+        self.run_session(session)
+
+    def testBatchHeaders(self):
+        Milter.factory = batchMilter
+
+        async def session(mta, conn):
+            cmd, data = await mta.command(
+                b"O", struct.pack("!III", 6, Milter.CURR_ACTS, 0x1FFFFF)
+            )
+            version, actions, protocol = struct.unpack("!III", data[:12])
+            self.assertTrue(protocol & Milter.P_NR_HDR)
+            self.assertFalse(protocol & (Milter.P_NOHDRS | Milter.P_NOEOH))
+            cmd, data = await mta.command(b"M", b"<spam@adv.com>\0")
+            # no reply to each header
+            mta.send(b"L", b"Subject\0hello\0")
+            mta.send(b"L", b"X-Reject\0yes\0")
+            cmd, data = await mta.command(b"N")
+            self.assertEqual(cmd, b"r")
+            milter = conn.ctx.getpriv()
+            self.assertEqual(milter.batch, [("Subject", "hello"), ("X-Reject", "yes")])
+            mta.send(b"Q")
+            await mta.writer.drain()
+
+        self.run_session(session)
+
+    def testSpoolBody(self):
+        Milter.factory = spoolMilter
+
+        async def session(mta, conn):
+            cmd, data = await mta.command(
+                b"O", struct.pack("!III", 6, Milter.CURR_ACTS, 0x1FFFFF)
+            )
+            version, actions, protocol = struct.unpack("!III", data[:12])
+            self.assertTrue(protocol & (Milter.P_NR_HDR | Milter.P_NR_BODY))
+            self.assertFalse(protocol & (Milter.P_NOHDRS | Milter.P_NOBODY))
+            cmd, data = await mta.command(b"M", b"<spam@adv.com>\0")
+            # no reply to headers and body chunks
+            mta.send(b"L", b"Subject\0hello\0")
+            mta.send(b"B", b"line 1\r\n")
+            mta.send(b"B", b"line 2\r\n")
+            cmd, data = await mta.command(b"E")
+            self.assertEqual(cmd, b"c")
+            milter = conn.ctx.getpriv()
+            self.assertEqual(
+                milter.message, b"Subject: hello\r\n\r\nline 1\r\nline 2\r\n"
+            )
+            self.assertEqual(milter.body_file, None)
+            mta.send(b"Q")
+            await mta.writer.drain()
+
+        self.run_session(session)
+
+    def testFuture(self):
+        Milter.factory = futureMilter
+        interval = Milter.PROGRESS_INTERVAL
+        Milter.PROGRESS_INTERVAL = 0.01
+
+        async def session(mta, conn):
+            await mta.command(b"O", struct.pack("!III", 6, Milter.CURR_ACTS, 0x1FFFFF))
+            cmd, data = await mta.command(b"M", b"<spam@adv.com>\0")
+            self.assertEqual(cmd, b"c")
+            replies = []
+            mta.send(b"E")
+            while cmd != b"a":
+                cmd, data = await mta.recv()
+                replies.append(cmd)
+            # progress while waiting, then the action and reply
+            self.assertEqual(replies[0], b"p")
+            self.assertEqual(replies[-2:], [b"h", b"a"])
+            mta.send(b"Q")
+            await mta.writer.drain()
+
+        try:
+            self.run_session(session)
+        finally:
+            Milter.PROGRESS_INTERVAL = interval
+
+
+def suite():
+    return unittest.makeSuite(AsyncServerTestCase, "test")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,22 +1,40 @@
+import asyncio
+import contextlib
+import glob
+import io
 import os
+import signal
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
-# from Milter.greylist import Greylist
-from Milter.greysql import Greylist
+from Milter import greyd, greylist, greysql
 
 
 class GreylistTestCase(unittest.TestCase):
+    backend = greysql.Greylist
+    shards = 1
+    options = {}
+
     def setUp(self):
         self.fname = "test.db"
-        if os.path.isfile(self.fname):
-            os.remove(self.fname)
+        for fname in glob.glob(self.fname + "*"):
+            os.remove(fname)
+
+    def Greylist(self, fname, **kw):
+        "Open the backend with the options of the test case, unless overridden."
+        opts = dict(self.options, shards=self.shards)
+        opts.update(kw)
+        return type(self).backend(fname, **opts)
 
     def tearDown(self):
         # os.remove(self.fname)
         pass
 
     def testGrey(self):
-        grey = Greylist(self.fname)
+        grey = self.Greylist(self.fname)
         # first time
         rc = grey.check("1.2.3.4", "foo@bar.com", "baz@spat.com")
         self.assertEqual(rc, 0)
@@ -47,14 +65,433 @@ class GreylistTestCase(unittest.TestCase):
         self.assertEqual(rc, 0)
         grey.close()
         # test cleanup
-        grey = Greylist(self.fname)
+        grey = self.Greylist(self.fname)
         rc = grey.clean(timeinc=37 * 24 * 3600)
         self.assertEqual(rc, 1)
         grey.close()
 
+    def testThreads(self):
+        grey = self.Greylist(self.fname)
+        errors = []
+
+        def run(n):
+            try:
+                for i in range(50):
+                    ip = "10.%d.0.%d" % (n, i)
+                    grey.check(ip, "foo@bar.com", "baz@spat.com")
+                    rc = grey.check(ip, "foo@bar.com", "baz@spat.com", timeinc=900)
+                    if rc != 1:
+                        errors.append((ip, rc))
+            except Exception as x:
+                errors.append(x)
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        grey.close()
+
+    def testWriteBehind(self):
+        # max_pending is divided between shards
+        grey = self.Greylist(self.fname, flush_interval=60, max_pending=3 * self.shards)
+        # triples in the same shard
+        shard = lambda ip: grey._shard(ip, "foo@bar.com", "baz@spat.com")
+        i = shard("1.2.3.0")
+        ips = [ip for ip in ("1.2.3.%d" % n for n in range(256)) if shard(ip) == i]
+        grey.check(ips[0], "foo@bar.com", "baz@spat.com")
+        grey.check(ips[1], "foo@bar.com", "baz@spat.com")
+        self.assertEqual(len(grey.dirty[i]), 2)
+        # answered from pending updates
+        rc = grey.check(ips[0], "foo@bar.com", "baz@spat.com", timeinc=900)
+        self.assertEqual(rc, 1)
+        # written when max_pending is reached
+        grey.check(ips[2], "foo@bar.com", "baz@spat.com")
+        self.assertEqual(len(grey.dirty[i]), 0)
+        grey.check(ips[3], "foo@bar.com", "baz@spat.com")
+        grey.close()
+        # written on close
+        grey = self.Greylist(self.fname)
+        rc = grey.check(ips[3], "foo@bar.com", "baz@spat.com", timeinc=900)
+        self.assertEqual(rc, 1)
+        grey.close()
+
+    def testCache(self):
+        t = ("1.2.3.4", "foo@bar.com", "baz@spat.com")
+        # no flusher, so lastseen is written only on eviction
+        grey = self.Greylist(self.fname, cache_size=1, flush_interval=0)
+        i = grey._shard(*t)
+        grey.check(*t)
+        grey.check(*t, timeinc=900)
+        # answered from the cache, lastseen not written yet
+        self.assertEqual(grey.check(*t, timeinc=1000), 2)
+        r = grey._load(i, grey._key(*t))
+        self.assertEqual(r[2], 1)
+        st = grey.cache_stats()
+        self.assertEqual((st["hits"], st["misses"], st["size"]), (1, 2, 1))
+        # evicting writes lastseen
+        for n in range(5, 256):
+            u = ("1.2.3.%d" % n, "foo@bar.com", "baz@spat.com")
+            if grey._shard(*u) == i:
+                break
+        grey.check(*u)
+        grey.check(*u, timeinc=900)
+        r = grey._load(i, grey._key(*t))
+        self.assertEqual(r[2], 2)
+        grey.close()
+        grey = self.Greylist(self.fname)
+        r = grey._load(i, grey._key(*t))
+        self.assertEqual(r[2], 2)
+        self.assertTrue(r[1] > r[0] + 999)
+        grey.close()
+
+    def testUpsert(self):
+        if type(self).backend is not greysql.Greylist:
+            self.skipTest("sqlite only")
+        grey = self.Greylist(self.fname)
+        self.assertEqual(grey.upsert, greysql.HAVE_UPSERT and not self.options)
+        mode = grey.conn.execute("pragma journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+        # same answers as the state machine in python
+        ref = self.Greylist(self.fname + "ref")
+        ref.upsert = False
+        times = (0, 300, 900, 1000, 5 * 3600, 2 * 86400, 40 * 86400, 41 * 86400)
+        for n, timeinc in enumerate(times):
+            for ip in ("1.2.3.4", "1.2.3.5")[: n % 2 + 1]:
+                rc = grey.check(ip, "foo@bar.com", "baz@spat.com", timeinc)
+                ex = ref.check(ip, "foo@bar.com", "baz@spat.com", timeinc)
+                self.assertEqual(rc, ex, (ip, timeinc))
+        grey.close()
+        ref.close()
+
+    def testUpsertImport(self):
+        if type(self).backend is not greysql.Greylist:
+            self.skipTest("sqlite only")
+        grey = self.Greylist(self.fname)
+        if not grey.upsert:
+            self.skipTest("upsert not used")
+        t = ("1.2.3.4", "foo@bar.com", "baz@spat.com")
+        now = time.time()
+        res = []
+        checker = threading.Thread(target=lambda: res.append(grey.check(*t)))
+
+        def records():
+            for i in range(100):
+                yield ("10.0.0.%d" % i, "a@b.com", "c@d.com", now, now, 0, None)
+                if i == 50:
+                    # a check in the middle of the import waits for it
+                    checker.start()
+                    checker.join(0.2)
+                    self.assertTrue(checker.is_alive())
+                    self.assertFalse(grey.idle.is_set())
+            yield t + (now - 900, now - 900, 2, None)
+
+        self.assertEqual(grey.import_records(records(), batch=10), 101)
+        checker.join()
+        self.assertEqual(res, [3])
+        grey.close()
+
+    def testUpsertClean(self):
+        if type(self).backend is not greysql.Greylist:
+            self.skipTest("sqlite only")
+        grey = self.Greylist(self.fname)
+        if not grey.upsert:
+            self.skipTest("upsert not used")
+        t = ("1.2.3.4", "foo@bar.com", "baz@spat.com")
+        grey.check(*t)
+        timeinc = 37 * 24 * 3600
+        i = grey._shard(*t)
+        conn = grey.conns[i]
+
+        class Interleave(object):
+            "Check t again after the clean selects it, before it deletes."
+
+            def __getattr__(self, name):
+                return getattr(conn, name)
+
+            def execute(self, sql, *args):
+                if sql.startswith("begin"):
+                    grey.check(*t, timeinc=timeinc)
+                return conn.execute(sql, *args)
+
+        grey.conns[i] = Interleave()
+        try:
+            self.assertEqual(grey.clean(timeinc=timeinc), 0)
+        finally:
+            grey.conns[i] = conn
+        # the fresh row survived
+        self.assertEqual(grey.check(*t, timeinc=timeinc + 900), 1)
+        grey.close()
+
+    def testMigrate(self):
+        if type(self).backend is greylist.BinaryGreylist:
+            self.skipTest("addresses are hashed")
+        t = ("1.2.3.4", "foo@bar.com", ".baz@spat.com")
+        u = ("2001:db8::1", "flub@bar.com", "baz@spat.com")
+        grey = self.Greylist(self.fname)
+        grey.check(*t)
+        grey.check(*t, timeinc=900)
+        grey.check(*u)
+        dst = greylist.BinaryGreylist(self.fname + "bin", shards=self.shards)
+        self.assertEqual(dst.import_records(grey.records()), 2)
+        grey.close()
+        self.assertEqual(dst.check(*t, timeinc=1000), 2)
+        self.assertEqual(dst.check(*u, timeinc=900), 1)
+        ips = sorted(r[0] for r in dst.records())
+        self.assertEqual(ips, ["1.2.3.4", "2001:db8::1"])
+        dst.close()
+
+    def testPrefix(self):
+        grey = self.Greylist(self.fname, prefix4=24)
+        grey.check("1.2.3.4", "foo@bar.com", "baz@spat.com")
+        # retry from the same /24
+        rc = grey.check("1.2.3.77", "foo@bar.com", "baz@spat.com", timeinc=900)
+        self.assertEqual(rc, 1)
+        rc = grey.check("1.2.4.4", "foo@bar.com", "baz@spat.com", timeinc=900)
+        self.assertEqual(rc, 0)
+        grey.check("2001:db8::1", "foo@bar.com", "baz@spat.com")
+        rc = grey.check("2001:db8::2", "foo@bar.com", "baz@spat.com", timeinc=900)
+        self.assertEqual(rc, 0)
+        grey.ignoreLastByte = True
+        self.assertEqual(grey.prefix6, 64)
+        grey.check("2001:db8::1", "foo@bar.com", "baz@spat.com")
+        rc = grey.check("2001:db8::2", "foo@bar.com", "baz@spat.com", timeinc=900)
+        self.assertEqual(rc, 1)
+        grey.close()
+
+    def testCleanStep(self):
+        grey = self.Greylist(self.fname)
+        for i in range(5):
+            grey.check("1.2.3.%d" % i, "foo@bar.com", "baz@spat.com")
+        grey.check("1.2.4.1", "foo@bar.com", "baz@spat.com", timeinc=20 * 24 * 3600)
+        total = steps = 0
+        done = False
+        while not done:
+            cnt, done = grey.clean_step(batch=2, timeinc=37 * 24 * 3600)
+            self.assertTrue(cnt <= 2)
+            total += cnt
+            steps += 1
+        self.assertEqual(total, 5)
+        self.assertTrue(steps >= 3)
+        self.assertEqual(grey.clean_cursor, (0, None))
+        self.assertEqual(grey.clean(timeinc=57 * 24 * 3600), 1)
+        grey.close()
+
+    def testCleaner(self):
+        grey = self.Greylist(
+            self.fname,
+            grey_retain=0,
+            clean_rate=10000,
+            clean_batch=2,
+            clean_interval=0.01,
+        )
+        for i in range(3):
+            grey.check("1.2.3.%d" % i, "foo@bar.com", "baz@spat.com")
+        for i in range(500):
+            if grey.cleaner.deleted >= 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(grey.cleaner.deleted, 3)
+        grey.close()
+        self.assertEqual(grey.cleaner, None)
+
+
+class ShardedGreylistTestCase(GreylistTestCase):
+    shards = 4
+
+
+class WriteBehindGreylistTestCase(GreylistTestCase):
+    options = {"flush_interval": 0.01}
+
+
+class CachedGreylistTestCase(GreylistTestCase):
+    options = {"cache_size": 100, "flush_interval": 0.01}
+
+
+class ShelveGreylistTestCase(GreylistTestCase):
+    backend = greylist.Greylist
+
+
+class ShardedShelveGreylistTestCase(ShelveGreylistTestCase):
+    shards = 4
+
+
+class WriteBehindShelveGreylistTestCase(ShelveGreylistTestCase):
+    options = {"flush_interval": 0.01}
+
+
+class CachedShelveGreylistTestCase(ShelveGreylistTestCase):
+    options = {"cache_size": 100}
+
+
+class BinaryGreylistTestCase(GreylistTestCase):
+    backend = greylist.BinaryGreylist
+
+
+class ShardedBinaryGreylistTestCase(BinaryGreylistTestCase):
+    shards = 4
+
+
+class RecordTestCase(unittest.TestCase):
+    def testPack(self):
+        r = (1700000000.5, 1700000900.25, 3, None)
+        b = greylist.pack_record(r)
+        self.assertEqual(greylist.unpack_record(b), (1700000000, 1700000900, 3, None))
+        b = greylist.pack_record((1, 2, 0, "umis"))
+        self.assertEqual(len(b), greylist.RECORD.size + 4)
+        self.assertEqual(greylist.unpack_record(b)[3], "umis")
+        for ip, n in (("1.2.3.4", 4), ("2001:db8::1", 16), ("unknown", 7)):
+            b = greylist.pack_ip(ip)
+            self.assertEqual(len(b), n)
+            self.assertEqual(greylist.unpack_ip(b), ip)
+
+
+class ToolTestCase(unittest.TestCase):
+    def setUp(self):
+        for fname in glob.glob("test.db*") + glob.glob("test.dat"):
+            os.remove(fname)
+
+    def tearDown(self):
+        self.setUp()
+
+    def testFormats(self):
+        records = [
+            ("1.2.3.4", "foo@bar.com", "baz@spat.com", 1.5, 2.5, 1, None),
+            ("2001:db8::1", "", "b\u00e4z@spat.com", 3.0, 4.0, 0, "umis"),
+        ]
+        fp = io.BytesIO()
+        greylist.write_dump(fp, records)
+        fp.seek(0)
+        self.assertEqual(list(greylist.read_dump(fp)), records)
+        fp = io.StringIO()
+        greylist.write_csv(fp, records)
+        fp.seek(0)
+        self.assertEqual(list(greylist.read_csv(fp)), records)
+
+    def testMain(self):
+        grey = greylist.Greylist("test.db", shards=2)
+        grey.check("1.2.3.4", "foo@bar.com", "baz@spat.com")
+        grey.check("1.2.3.4", "foo@bar.com", "baz@spat.com", timeinc=900)
+        grey.check("1.2.3.5", "foo@bar.com", "baz@spat.com")
+        grey.close()
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            greylist.main(["export", "test.db", "test.dat", "--shards=2", "-fdump"])
+            greylist.main(["import", "test.dbsql", "test.dat", "-bsqlite", "-fdump"])
+        self.assertTrue(err.getvalue().endswith("/sec\n"), err.getvalue())
+        grey = greysql.Greylist("test.dbsql")
+        rc = grey.check("1.2.3.4", "foo@bar.com", "baz@spat.com", timeinc=1000)
+        self.assertEqual(rc, 2)
+        self.assertEqual(len(list(grey.records())), 2)
+        grey.close()
+
+
+class GreydTestCase(unittest.TestCase):
+    def setUp(self):
+        for fname in glob.glob("test.db*") + glob.glob("test.sock*"):
+            os.remove(fname)
+        self.grey = greylist.BinaryGreylist("test.db", cache_size=100)
+        self.loop = asyncio.new_event_loop()
+        server = greyd.Server(self.grey)
+        self.server = self.loop.run_until_complete(server.start("test.sock"))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        self.grey.close()
+        os.remove("test.sock")
+
+    def testCheck(self):
+        client = greyd.Client("test.sock", pool_size=2)
+        t = ("1.2.3.4", "foo@bar.com", "baz@spat.com")
+        self.assertEqual(client.check(*t), 0)
+        self.assertEqual(client.check(*t, timeinc=900), 1)
+        self.assertEqual(len(client.pool), 1)
+        # pipelined
+        triples = [("10.0.0.%d" % i, "foo@bar.com", "baz@spat.com") for i in range(50)]
+        self.assertEqual(client.check_many(triples), [0] * 50)
+        self.assertEqual(client.check_many(triples + [t], 900), [1] * 50 + [2])
+        client.close()
+        # replies read between batches
+        client = greyd.Client("test.sock", pipeline=7)
+        self.assertEqual(client.check_many(triples, 1000), [2] * 50)
+        client.close()
+
+    def testTerminate(self):
+        # a daemon with write-behind, and its own socket and database
+        cmd = [sys.executable, "-m", "Milter.greyd", "test.sock2", "test.db2"]
+        proc = subprocess.Popen(cmd + ["--flush=60"])
+        try:
+            for i in range(500):
+                if os.path.exists("test.sock2"):
+                    break
+                time.sleep(0.01)
+            client = greyd.Client("test.sock2")
+            t = ("1.2.3.4", "foo@bar.com", "baz@spat.com")
+            self.assertEqual(client.check(*t), 0)
+            # an idle connection stays open
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(proc.wait(10), 0)
+            client.close()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        self.assertFalse(os.path.exists("test.sock2"))
+        # the queued update was written
+        grey = greylist.BinaryGreylist("test.db2")
+        self.assertEqual(grey.check(*t, timeinc=900), 1)
+        grey.close()
+
+    def testThreads(self):
+        client = greyd.Client("test.sock", pool_size=2)
+        errors = []
+
+        def run(n):
+            try:
+                for i in range(20):
+                    ip = "10.%d.0.%d" % (n, i)
+                    client.check(ip, "foo@bar.com", "baz@spat.com")
+                    rc = client.check(ip, "foo@bar.com", "baz@spat.com", 900)
+                    if rc != 1:
+                        errors.append((ip, rc))
+            except Exception as x:
+                errors.append(x)
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(client.pool) <= 2)
+        client.close()
+
 
 def suite():
-    s = unittest.makeSuite(GreylistTestCase, "test")
+    s = unittest.TestSuite()
+    for t in (
+        GreylistTestCase,
+        ShardedGreylistTestCase,
+        WriteBehindGreylistTestCase,
+        CachedGreylistTestCase,
+        ShelveGreylistTestCase,
+        ShardedShelveGreylistTestCase,
+        WriteBehindShelveGreylistTestCase,
+        CachedShelveGreylistTestCase,
+        BinaryGreylistTestCase,
+        ShardedBinaryGreylistTestCase,
+        RecordTestCase,
+        ToolTestCase,
+        GreydTestCase,
+    ):
+        s.addTest(unittest.makeSuite(t, "test"))
     return s
 
 
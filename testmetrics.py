@@ -0,0 +1,76 @@
+import http.client
+import unittest
+
+import Milter.metrics
+from Milter.metrics import format_metrics, worker_socketname
+
+
+class MetricsTestCase(unittest.TestCase):
+    def testFormat(self):
+        st = {
+            "contexts": {"created": 5, "deleted": 3, "active": 2},
+            "thread_states": {"hit": 4, "miss": 1},
+            "callbacks": {
+                "eom": {
+                    "calls": 3,
+                    "errors": 1,
+                    "gil_wait": 0.5,
+                    "time": 0.25,
+                    "replies": {"accept": 2},
+                    "histogram": (1, 0, 2),
+                }
+            },
+            "buckets": (1e-6, 2e-6, float("inf")),
+        }
+        lines = format_metrics(st).splitlines()
+        self.assertEqual(lines[-1], "# EOF")
+        self.assertTrue("milter_connections_total 5" in lines)
+        self.assertTrue("milter_active_contexts 2" in lines)
+        self.assertTrue('milter_thread_states_total{result="hit"} 4' in lines)
+        # buckets are cumulative
+        bucket = 'milter_callback_seconds_bucket{callback="eom",le="%s"} %d'
+        self.assertTrue(bucket % ("1e-06", 1) in lines)
+        self.assertTrue(bucket % ("2e-06", 1) in lines)
+        self.assertTrue(bucket % ("+Inf", 3) in lines)
+        self.assertTrue('milter_callback_seconds_count{callback="eom"} 3' in lines)
+        self.assertTrue('milter_callback_seconds_sum{callback="eom"} 0.25' in lines)
+        self.assertTrue('milter_callback_errors_total{callback="eom"} 1' in lines)
+        self.assertTrue(
+            'milter_replies_total{callback="eom",reply="accept"} 2' in lines
+        )
+
+    def testServer(self):
+        st = {
+            "contexts": {"created": 1, "deleted": 0, "active": 1},
+            "thread_states": {},
+            "callbacks": {},
+            "buckets": (float("inf"),),
+        }
+        server = Milter.metrics.start("inet:0@127.0.0.1", lambda: st)
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_port)
+            conn.request("GET", "/metrics")
+            resp = conn.getresponse()
+            body = resp.read().decode("utf-8")
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader("Content-Type"), Milter.metrics.CONTENT_TYPE)
+        self.assertTrue("milter_active_contexts 1" in body.splitlines())
+        self.assertTrue(body.endswith("# EOF\n"))
+
+    def testWorkerSocket(self):
+        self.assertEqual(
+            worker_socketname("inet:9100@127.0.0.1", 2), "inet:9102@[127.0.0.1]"
+        )
+        self.assertEqual(worker_socketname("/var/run/m.sock", 1), "/var/run/m.sock.1")
+
+
+def suite():
+    return unittest.makeSuite(MetricsTestCase, "test")
+
+
+if __name__ == "__main__":
+    unittest.main()
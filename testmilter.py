@@ -0,0 +1,286 @@
+import mime
+import os
+import select
+import signal
+import time
+import unittest
+from unittest import mock
+
+import Milter
+from Milter.testctx import TestCtx
+
+
+@Milter.batch_headers
+class batchMilter(Milter.Base):
+    def __init__(self):
+        self.batches = []
+
+    def headers(self, hdrs):
+        self.batches.append(hdrs)
+        return Milter.CONTINUE
+
+    def eoh(self):
+        self.eoh_called = True
+        return Milter.CONTINUE
+
+
+class bytesMilter(batchMilter):
+    @Milter.decode("bytes")
+    def header(self, fld, val):
+        return Milter.CONTINUE
+
+
+@Milter.spool_body(max_size=512)
+class spoolMilter(Milter.Base):
+    def eom(self):
+        f = self.body_file
+        self.rolled = f.rolled
+        self.msg = mime.message_from_file(f)
+        with f.getbuffer() as buf:
+            self.body = bytes(buf[-f.size // 2 :])
+        self.spooled = f
+        return Milter.CONTINUE
+
+
+class bufferMilter(Milter.Base):
+    def __init__(self):
+        self.kept = []
+
+    @Milter.decode("buffer")
+    def body(self, chunk):
+        self.kept.append(chunk[:4])
+        return Milter.CONTINUE
+
+
+class futureMilter(Milter.Base):
+    def envfrom(self, f, *params):
+        return self.submit(lambda: Milter.CONTINUE)
+
+    async def eom(self):
+        self.checked = True
+        return Milter.ACCEPT
+
+
+class MilterBaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.factory = Milter.factory
+
+    def tearDown(self):
+        Milter.factory = self.factory
+
+    def testStats(self):
+        eom = {
+            "calls": 5,
+            "errors": 1,
+            "gil_wait": 0.5,
+            "time": 0.25,
+            "replies": {Milter.ACCEPT: 3, Milter.TEMPFAIL: 1, 99: 1},
+            "histogram": (1, 2, 0, 2),
+        }
+        diag = (10, 7, 4, 1)
+        with mock.patch.object(Milter.milter, "getdiag", return_value=diag):
+            with mock.patch.object(
+                Milter.milter, "getstats", return_value={"eom": eom}
+            ):
+                st = Milter.stats()
+        self.assertEqual(st["contexts"], {"created": 10, "deleted": 7, "active": 3})
+        self.assertEqual(st["thread_states"], {"hit": 4, "miss": 1})
+        # reply codes by name
+        eom = st["callbacks"]["eom"]
+        self.assertEqual(eom["replies"], {"accept": 3, "tempfail": 1, "99": 1})
+        self.assertEqual((eom["calls"], eom["errors"]), (5, 1))
+        # powers of 2 microseconds, then the rest
+        self.assertEqual(st["buckets"], (1e-6, 2e-6, 4e-6, float("inf")))
+
+    def testBodyChunk(self):
+        chunk = Milter.milter.BodyChunk(b"first chunk\r\n")
+        kept = chunk[6:11]
+        self.assertEqual(bytes(kept), b"chunk")
+        self.assertEqual((len(kept), kept[0], kept[-1]), (5, ord("c"), ord("k")))
+        self.assertEqual(kept[1:3].tobytes(), b"hu")
+        with memoryview(kept):
+            self.assertRaises(BufferError, chunk.release)
+        # releasing the chunk invalidates slices kept past the callback
+        chunk.release()
+        self.assertRaises(ValueError, bytes, kept)
+        self.assertRaises(ValueError, len, kept)
+        self.assertRaises(ValueError, lambda: kept[1:])
+        self.assertRaises(ValueError, chunk.tobytes)
+
+    def testBodyBuffer(self, fname="utf8"):
+        ctx = TestCtx()
+        Milter.factory = bufferMilter
+        self.assertEqual(ctx._connect(), Milter.CONTINUE)
+        with open("test/" + fname, "rb") as fp:
+            rc = ctx._feedFile(fp)
+        self.assertEqual(rc, Milter.CONTINUE)
+        milter = ctx.getpriv()
+        self.assertTrue(milter.kept)
+        self.assertRaises(ValueError, bytes, milter.kept[0])
+        ctx._close()
+
+    def testBatchHeaders(self, fname="utf8"):
+        ctx = TestCtx()
+        Milter.factory = batchMilter
+        rc = ctx._connect()
+        self.assertEqual(rc, Milter.CONTINUE)
+        p = batchMilter.protocol_mask()
+        self.assertFalse(p & Milter.P_NR_HDR)
+        self.assertTrue(p & Milter.P_NOHDRS)
+        with open("test/" + fname, "rb") as fp:
+            rc = ctx._feedFile(fp)
+        self.assertEqual(rc, Milter.CONTINUE)
+        milter = ctx.getpriv()
+        self.assertEqual(len(milter.batches), 1)
+        self.assertEqual(len(milter.batches[0]), len(ctx._msg.items()))
+        self.assertTrue(milter.eoh_called)
+        ctx._close()
+
+    def testDispatch(self):
+        t = batchMilter.dispatch_table()
+        self.assertEqual(t[2:5], ("envfrom_bytes", "envrcpt_bytes", "header_bytes"))
+        self.assertEqual(t[9], None)
+        # computed separately for each subclass
+        t = bytesMilter.dispatch_table()
+        self.assertEqual(t[4], "header")
+        self.assertEqual(bytesMilter.error_strategies()["header"], "bytes")
+        self.assertEqual(batchMilter.error_strategies()["header"], "surrogateescape")
+
+    def testSpoolBody(self, fname="spam44"):
+        p = spoolMilter.protocol_mask()
+        self.assertTrue(p & Milter.P_NOBODY)
+        self.assertFalse(p & Milter.P_NR_BODY)
+        self.assertFalse(p & Milter.P_NR_HDR)
+        ctx = TestCtx()
+        Milter.factory = spoolMilter
+        ctx._connect()
+        with open("test/" + fname, "rb") as fp:
+            rc = ctx._feedFile(fp)
+        self.assertEqual(rc, Milter.CONTINUE)
+        milter = ctx.getpriv()
+        self.assertTrue(milter.rolled)
+        self.assertEqual(milter.msg["subject"], ctx._msg["subject"])
+        self.assertEqual(milter.msg.get_content_type(), ctx._msg.get_content_type())
+        self.assertTrue(ctx._body.getvalue().endswith(milter.body))
+        # closed after eom
+        self.assertTrue(milter.spooled.closed)
+        self.assertEqual(milter.body_file, None)
+        ctx._close()
+
+    def testFuture(self, fname="utf8"):
+        ctx = TestCtx()
+        Milter.factory = futureMilter
+        ctx._connect()
+        with open("test/" + fname, "rb") as fp:
+            rc = ctx._feedFile(fp)
+        self.assertEqual(rc, Milter.ACCEPT)
+        self.assertTrue(ctx.getpriv().checked)
+        self.assertRaises(Milter.error, Milter.wait_result, "bad", "eom")
+        ctx._close()
+
+    def testPrefork(self):
+        r, w = os.pipe()
+
+        def main(worker):
+            os.write(w, b"%d %d\n" % (worker, os.getpid()))
+            while True:
+                time.sleep(1)
+
+        supervisor = os.fork()
+        if supervisor == 0:
+            rc = 1
+            try:
+                Milter.prefork(2, main)
+                # every worker was reaped
+                try:
+                    os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    rc = 0
+            finally:
+                os._exit(rc)
+        os.close(w)
+        buf = b""
+
+        def started():
+            nonlocal buf
+            while b"\n" not in buf:
+                self.assertTrue(select.select([r], [], [], 10)[0], "no worker")
+                buf += os.read(r, 100)
+            line, buf = buf.split(b"\n", 1)
+            worker, pid = line.split()
+            return int(worker), int(pid)
+
+        try:
+            workers = dict(started() for i in range(2))
+            self.assertEqual(sorted(workers), [0, 1])
+            os.kill(workers[1], signal.SIGKILL)
+            worker, pid = started()
+            # restarted with the same worker number
+            self.assertEqual(worker, 1)
+            self.assertNotEqual(pid, workers[1])
+            workers[1] = pid
+            os.kill(supervisor, signal.SIGTERM)
+            pid, status = os.waitpid(supervisor, 0)
+            self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        except:
+            os.kill(supervisor, signal.SIGKILL)
+            os.waitpid(supervisor, 0)
+            raise
+        finally:
+            os.close(r)
+        for pid in workers.values():
+            self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+
+    def testPreforkStopWhileRestarting(self):
+        r, w = os.pipe()
+        flag = "test.prefork"
+        if os.path.exists(flag):
+            os.remove(flag)
+
+        def main(worker):
+            os.write(w, b"%d\n" % os.getpid())
+            if not os.path.exists(flag):
+                # die at once the first time, so the restart is delayed
+                open(flag, "w").close()
+                return
+            while True:
+                time.sleep(1)
+
+        supervisor = os.fork()
+        if supervisor == 0:
+            try:
+                Milter.prefork(1, main)
+            finally:
+                os._exit(0)
+        os.close(w)
+        pid = 0
+        try:
+            self.assertTrue(select.select([r], [], [], 10)[0], "no worker")
+            os.read(r, 100)
+            # during the delay before the restart
+            time.sleep(0.3)
+            os.kill(supervisor, signal.SIGTERM)
+            for i in range(50):
+                pid, status = os.waitpid(supervisor, os.WNOHANG)
+                if pid:
+                    break
+                time.sleep(0.1)
+            self.assertTrue(pid, "supervisor did not stop")
+        finally:
+            if not pid:
+                os.kill(supervisor, signal.SIGKILL)
+                os.waitpid(supervisor, 0)
+                # and the worker it restarted
+                while select.select([r], [], [], 0)[0]:
+                    for worker in os.read(r, 100).split():
+                        os.kill(int(worker), signal.SIGKILL)
+            os.close(r)
+            os.remove(flag)
+
+
+def suite():
+    return unittest.makeSuite(MilterBaseTestCase, "test")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,20 @@
 import doctest
+import glob
 import os
+import random
+import sys
+import threading
+import time
 import unittest
 
 import Milter.utils
-from Milter.cache import AddrCache
+from Milter.cache import (
+    BUCKET,
+    JOURNAL,
+    AddrCache,
+    ConcurrentAddrCache,
+    write_snapshot,
+)
 
 
 class AddrCacheTestCase(unittest.TestCase):
@@ -11,8 +22,8 @@ class AddrCacheTestCase(unittest.TestCase):
         self.fname = "test.dat"
 
     def tearDown(self):
-        if os.path.exists(self.fname):
-            os.remove(self.fname)
+        for fname in glob.glob(self.fname + "*"):
+            os.remove(fname)
 
     def testAdd(self):
         cache = AddrCache(fname=self.fname)
@@ -38,6 +49,227 @@ class AddrCacheTestCase(unittest.TestCase):
         cache.load(self.fname, 30)
         self.assertTrue("spammer.com" in cache)
 
+    def testSnapshot(self):
+        ts = time.strftime(AddrCache.time_format, time.localtime())
+        with open(self.fname, "w") as fp:
+            print("old@bar.com", ts, file=fp)
+            print("spammer.com", file=fp)
+        cache = AddrCache(fname=self.fname, snapshot=True)
+        cache.load(self.fname, 30)
+        self.assertTrue("old@bar.com" in cache)
+        self.assertTrue("joe@spammer.com" in cache)
+        # converted to a snapshot
+        self.assertFalse(os.path.exists(self.fname))
+        self.assertTrue(os.path.exists(self.fname + ".snap"))
+        cache["foo@bar.com"] = None
+        cache.addperm("baz@bar.com")
+        cache["temp@bar.com"] = "testing"
+        cache.close()
+        self.assertEqual(os.path.getsize(self.fname + ".journal"), 2 * 10 + 22)
+        cache = AddrCache(fname=self.fname, snapshot=True)
+        cache.load(self.fname, 30)
+        self.assertEqual(len(cache), 4)
+        self.assertTrue("foo@bar.com" in cache)
+        self.assertFalse("temp@bar.com" in cache)
+        # compacted in the background
+        cache.compact_after = 2
+        cache["new@bar.com"] = None
+        cache.close()
+        self.assertFalse(os.path.exists(self.fname + ".journal"))
+        cache = AddrCache(fname=self.fname, snapshot=True)
+        cache.load(self.fname, 30)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.cache["baz@bar.com"], (0, None))
+        # timestamps past 2038
+        ts = 2**31 + 5
+        cache.close()
+        with open(self.fname + ".snap", "wb") as fp:
+            write_snapshot(fp, [("later@bar.com", ts)])
+        with open(self.fname + ".journal", "wb") as fp:
+            fp.write(JOURNAL.pack(ts, 11) + b"new@bar.com")
+        cache = AddrCache(fname=self.fname, snapshot=True)
+        cache.load(self.fname, 30)
+        self.assertEqual(cache.cache["later@bar.com"], (ts, None))
+        self.assertEqual(cache.cache["new@bar.com"], (ts, None))
+        self.assertEqual(len(cache), 2)
+
+    def testBuffered(self):
+        cache = AddrCache(fname=self.fname, flush_interval=60)
+        cache["foo@bar.com"] = None
+        cache.addperm("baz@bar.com")
+        self.assertFalse(os.path.exists(self.fname))
+        self.assertEqual(len(cache.pending), 2)
+        cache.flush()
+        with open(self.fname) as fp:
+            s = fp.readlines()
+        self.assertTrue(s[0].startswith("foo@bar.com "))
+        self.assertEqual(s[1].strip(), "baz@bar.com")
+        cache["new@bar.com"] = None
+        cache.close()
+        self.assertEqual(cache.writer, None)
+        with open(self.fname) as fp:
+            self.assertEqual(len(fp.readlines()), 3)
+        # written by the thread
+        cache = AddrCache(fname=self.fname, snapshot=True, flush_interval=0.01)
+        cache.load(self.fname)
+        cache["foo@bar.com"] = None
+        for i in range(500):
+            if os.path.exists(self.fname + ".journal"):
+                break
+            time.sleep(0.01)
+        cache.close()
+        self.assertEqual(os.path.getsize(self.fname + ".journal"), 10 + 11)
+
+    def testExpiry(self):
+        cache = AddrCache(renew=1, max_size=2)
+        cache["ok@bar.com"] = None
+        for i in range(3):
+            cache["cbv%d@bar.com" % i] = "fail"
+        # least recently used
+        self.assertEqual(cache.evictions, 1)
+        self.assertFalse("cbv0@bar.com" in cache)
+        self.assertEqual(cache["cbv1@bar.com"], "fail")
+        cache["cbv3@bar.com"] = "fail"
+        self.assertFalse("cbv2@bar.com" in cache)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(len(cache), 3)
+        # reaped without being looked up
+        now = time.time() + 24 * 3600 + 2 * BUCKET
+        self.assertEqual(cache.reap(now=now), 3)
+        self.assertEqual(cache.expired, 3)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.buckets, {})
+        self.assertEqual(len(cache.lru), 0)
+
+    def testWildcard(self):
+        cache = AddrCache(renew=1)
+        cache["*.example.com"] = None
+        cache["*.mail.example.com"] = "nearest"
+        cache["example.org"] = None
+        cache["joe@a.mail.example.com"] = "joe"
+        key = cache.match("Joe@A.mail.example.com")
+        self.assertEqual(key, "joe@a.mail.example.com")
+        self.assertEqual(cache["bob@a.mail.example.com"], "nearest")
+        self.assertEqual(cache.match("bob@mail.example.com"), "*.example.com")
+        self.assertEqual(cache.match("mail.example.com"), "*.example.com")
+        self.assertFalse("bob@example.com" in cache)
+        self.assertTrue("bob@example.org" in cache)
+        self.assertFalse("bob@sub.example.org" in cache)
+        self.assertFalse("bob@example.net" in cache)
+        self.assertRaises(KeyError, cache.__getitem__, "bob@example.net")
+        # expired entries leave the trie
+        cache.reap(now=time.time() + 24 * 3600 + 2 * BUCKET)
+        self.assertEqual(cache.trie, {})
+
+    def testEmptyLabel(self):
+        cache = AddrCache(renew=1)
+        cache["b"] = None
+        cache["a..b"] = None
+        cache["c."] = None
+        cache["*.d"] = None
+        self.assertTrue("a..b" in cache)
+        self.assertTrue("x@b" in cache)
+        self.assertTrue("c." in cache)
+        self.assertFalse("c" in cache)
+        self.assertEqual(cache.match("x@.d"), "*.d")
+        cache = AddrCache(renew=1)
+        cache["a..b"] = None
+        cache["b"] = None
+        self.assertTrue("a..b" in cache)
+        self.assertFalse("x@a.b" in cache)
+        cache.reap(now=time.time() + 24 * 3600 + 2 * BUCKET)
+        self.assertEqual(cache.trie, {})
+
+    def testConcurrent(self):
+        cache = ConcurrentAddrCache(renew=1, max_size=50)
+        cache.addperm("*.example.com")
+        later = time.time() + 24 * 3600 + 2 * BUCKET
+        errors = []
+
+        def work(n):
+            rnd = random.Random(n)
+            try:
+                for i in range(2000):
+                    k = rnd.randrange(200)
+                    op = rnd.random()
+                    if op < 0.2:
+                        res = k % 2 and "fail" or None
+                        cache["u%d@h%d.example.org" % (k, k % 7)] = res
+                    elif op < 0.3:
+                        cache["h%d.example.org" % (k % 7)] = None
+                    elif op < 0.32:
+                        cache.reap(now=later)
+                    else:
+                        self.assertTrue("u%d@h.example.com" % k in cache)
+                        try:
+                            cache["u%d@h%d.example.org" % (k, k % 7)]
+                        except KeyError:
+                            pass
+            except Exception as x:
+                errors.append(x)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=work, args=(n,)) for n in range(16)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        # the indexes agree with the cache
+        self.assertTrue(len(cache.lru) <= cache.max_size)
+        for key in cache.lru:
+            self.assertEqual(cache.cache[key][1], "fail")
+        for b in cache.buckets.values():
+            self.assertTrue(b <= set(cache.cache))
+        domains = set()
+
+        def walk(node, labels):
+            for label, child in node.items():
+                if label is not None:
+                    walk(child, [label] + labels)
+                else:
+                    domains.add(".".join(labels))
+
+        walk(cache.trie, [])
+        self.assertEqual(domains, {k for k in cache.cache if "@" not in k})
+
+    def testConcurrentLoad(self):
+        with open(self.fname, "w") as fp:
+            print("*.example.com", file=fp)
+            print("example.org", file=fp)
+            for i in range(200):
+                print("user%d@example.net" % i, file=fp)
+        cache = ConcurrentAddrCache(fname=self.fname)
+        cache.load(self.fname)
+        done = threading.Event()
+        misses = []
+
+        def read():
+            while not done.is_set():
+                for sender in ("x@a.example.com", "y@example.org"):
+                    if sender not in cache:
+                        misses.append(sender)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        threads = [threading.Thread(target=read) for i in range(4)]
+        try:
+            for t in threads:
+                t.start()
+            for i in range(20):
+                cache.load(self.fname)
+        finally:
+            done.set()
+            for t in threads:
+                t.join()
+            sys.setswitchinterval(interval)
+        # lookups during a load see the old entries or the new ones
+        self.assertEqual(misses, [])
+
     def testParseHeader(self):
         s = "=?UTF-8?B?TGFzdCBGZXcgQ29sZHBsYXkgQWxidW0gQXJ0d29ya3MgQXZhaWxhYmxlAA?="
         h = Milter.utils.parse_header(s)